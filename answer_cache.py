@@ -0,0 +1,193 @@
+import argparse
+import collections
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+from file_registry import file_sha256
+from retrieval import fold_diacritics
+
+# --- Shared Answer Cache ---
+# The same transit questions (Metro Line 1 hours, fares, bus route numbers...) come back from
+# many users. Answers to stand-alone questions are stored in chat_sessions.db, keyed by the
+# normalized question and the corpus key (model + system instruction + PDF contents), so a
+# corpus change invalidates every entry at once. Only questions with the same content words in
+# the same order share an answer: the normalization drops punctuation, case, diacritics and a
+# short list of politeness/filler words, nothing else. A fuzzy match is not safe here, one word
+# changes the answer ("vé lượt"/"vé tháng", "metro"/"buýt", "Bến Thành"/"Bình Thạnh");
+# data/answer_cache_pairs.tsv lists such pairs ("python answer_cache.py check").
+# Answers grounded with Google Search are never cached: they may depend on fresh web results.
+# Hit/miss counters and last-hit times are kept in memory and written in batches, so a lookup
+# never takes the write lock.
+
+ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 3600
+ANSWER_CACHE_MAX_ENTRIES = 2000
+MIN_QUESTION_CHARS = 8
+STATS_FLUSH_INTERVAL_SECONDS = 5.0
+PAIRS_DATA_PATH = Path("data") / "answer_cache_pairs.tsv"
+# Matched before folding diacritics, so "chờ" (wait) or "tới" (to) are not taken for "cho" or "tôi".
+STOP_WORDS = frozenset(["ạ", "à", "ơi", "nhé", "nhe", "nha", "nhỉ", "vậy", "xin", "hỏi", "cho", "tôi", "mình", "bạn",
+                        "giúp", "là", "thì"])
+REPLAY_CHUNK_CHARS = 24
+REPLAY_CHUNK_DELAY_SECONDS = 0.01
+
+_NON_WORD_RE = re.compile(r"[^\w]+", re.UNICODE)
+_WORD_WITH_SPACE_RE = re.compile(r"\S+\s*")
+
+_PURGED_CORPORA = set()
+_PURGE_LOCK = threading.Lock()
+_STATS_LOCK = threading.Lock()
+_PENDING_STATS = {} # pool -> {"counters": Counter, "hits": {(corpus_key, question_norm): (count, last_hit_at)}}
+_STATS_WRITER = {"thread": None}
+
+def init_answer_cache_tables(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            corpus_key TEXT NOT NULL,
+            question_norm TEXT NOT NULL,
+            question_text TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            last_hit_at INTEGER NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (corpus_key, question_norm)
+        ) ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_answer_cache_last_hit ON answer_cache (last_hit_at);''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answer_cache_stats (
+            counter TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) ''')
+
+def normalize_question(text):
+    words = _NON_WORD_RE.sub(" ", unicodedata.normalize("NFC", text or "").lower()).split()
+    return " ".join(fold_diacritics(word) for word in words if word not in STOP_WORDS)
+
+def compute_corpus_key(model, system_instruction, doc_dir, pdf_filenames):
+    digest = hashlib.sha256(f"{model}\n{system_instruction}".encode("utf-8"))
+    for filename in sorted(pdf_filenames):
+        file_path = Path(doc_dir) / filename
+        if file_path.exists():
+            digest.update(filename.encode("utf-8")); digest.update(file_sha256(file_path).encode("ascii"))
+    return digest.hexdigest()
+
+def same_question(question, other_question):
+    return normalize_question(question) == normalize_question(other_question)
+
+# --- Statistics (batched) ---
+def _record(pool, counter, hit_key=None, now=None):
+    with _STATS_LOCK:
+        pending = _PENDING_STATS.setdefault(pool, {"counters": collections.Counter(), "hits": {}})
+        pending["counters"][counter] += 1
+        if hit_key is not None:
+            count, _ = pending["hits"].get(hit_key, (0, now))
+            pending["hits"][hit_key] = (count + 1, now)
+        if _STATS_WRITER["thread"] is None or not _STATS_WRITER["thread"].is_alive():
+            _STATS_WRITER["thread"] = threading.Thread(target=_stats_writer_loop, name="answer-cache-stats", daemon=True)
+            _STATS_WRITER["thread"].start()
+
+def _stats_writer_loop():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL_SECONDS)
+        flush_stats()
+
+def flush_stats():
+    """Write the counters and last-hit times gathered since the previous flush, one transaction per pool."""
+    with _STATS_LOCK:
+        pending_stats = dict(_PENDING_STATS); _PENDING_STATS.clear()
+    for pool, pending in pending_stats.items():
+        try:
+            with pool.transaction() as conn:
+                conn.executemany("INSERT INTO answer_cache_stats (counter, value) VALUES (?, ?) ON CONFLICT(counter) DO UPDATE SET value = value + excluded.value",
+                                 list(pending["counters"].items()))
+                conn.executemany("""
+                    UPDATE answer_cache SET last_hit_at = max(last_hit_at, ?), hit_count = hit_count + ?
+                    WHERE corpus_key = ? AND question_norm = ?""",
+                    [(last_hit_at, count, corpus_key, question_norm) for (corpus_key, question_norm), (count, last_hit_at) in pending["hits"].items()])
+        except Exception:
+            pass # Statistics are best effort; the LRU order only lags behind
+
+def _purge_other_corpora(pool, corpus_key):
+    # Runs once per process and corpus: entries built from an older corpus can never match again.
+    with _PURGE_LOCK:
+        if corpus_key in _PURGED_CORPORA: return
+        _PURGED_CORPORA.add(corpus_key)
+    pool.execute("DELETE FROM answer_cache WHERE corpus_key != ? OR expires_at <= ?", (corpus_key, int(time.time())))
+
+def lookup(pool, corpus_key, question):
+    """Return the cached answer for the same question (see normalize_question), or None. Counts a hit or a miss."""
+    question_norm = normalize_question(question)
+    if len(question_norm) < MIN_QUESTION_CHARS:
+        return None
+    _purge_other_corpora(pool, corpus_key)
+    now = int(time.time())
+    row = pool.fetchone("SELECT answer FROM answer_cache WHERE corpus_key = ? AND question_norm = ? AND expires_at > ?",
+                        (corpus_key, question_norm, now))
+    if row is None:
+        _record(pool, "misses")
+        return None
+    _record(pool, "hits", (corpus_key, question_norm), now)
+    return row[0]
+
+def store(pool, corpus_key, question, answer, ttl_seconds=ANSWER_CACHE_TTL_SECONDS, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+    question_norm = normalize_question(question)
+    if len(question_norm) < MIN_QUESTION_CHARS or not (answer or "").strip():
+        return
+    now = int(time.time())
+    with pool.transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO answer_cache (corpus_key, question_norm, question_text, answer, created_at, expires_at, last_hit_at, hit_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0)""", (corpus_key, question_norm, question, answer, now, now + ttl_seconds, now))
+        conn.execute("DELETE FROM answer_cache WHERE expires_at <= ?", (now,))
+        # LRU eviction down to max_entries.
+        conn.execute("""
+            DELETE FROM answer_cache WHERE rowid IN (
+                SELECT rowid FROM answer_cache ORDER BY last_hit_at ASC
+                LIMIT max((SELECT COUNT(*) FROM answer_cache) - ?, 0))""", (max_entries,))
+
+def get_stats(pool):
+    stats = collections.Counter(dict(pool.fetchall("SELECT counter, value FROM answer_cache_stats")))
+    with _STATS_LOCK:
+        stats.update(_PENDING_STATS.get(pool, {}).get("counters", {})) # Not flushed yet
+    entries = pool.fetchone("SELECT COUNT(*) FROM answer_cache")[0]
+    return {"hits": stats["hits"], "misses": stats["misses"], "entries": entries}
+
+def replay_chunks(answer, chunk_chars=REPLAY_CHUNK_CHARS, delay_seconds=REPLAY_CHUNK_DELAY_SECONDS):
+    """Yield a cached answer in word-aligned pieces so it renders like a streamed response."""
+    buffer = ""
+    for word in _WORD_WITH_SPACE_RE.findall(answer):
+        buffer += word
+        if len(buffer) >= chunk_chars:
+            yield buffer; buffer = ""
+            if delay_seconds: time.sleep(delay_seconds)
+    if buffer:
+        yield buffer
+
+def load_pairs(path=PAIRS_DATA_PATH):
+    """(expected "same"/"different", question, other question) rows of a TSV file with a header line."""
+    with open(path, encoding="utf-8") as f:
+        rows = [line.rstrip("\n").split("\t") for line in f.readlines()[1:] if line.strip()]
+    return [(expected, question, other_question) for expected, question, other_question in rows]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared answer cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    check_parser = subparsers.add_parser("check", help="Check which question pairs share a cache entry.")
+    check_parser.add_argument("--pairs", default=str(PAIRS_DATA_PATH))
+    normalize_parser = subparsers.add_parser("normalize", help="Print the cache key of a question.")
+    normalize_parser.add_argument("question")
+    args = parser.parse_args()
+
+    if args.command == "normalize":
+        print(normalize_question(args.question))
+    else:
+        pairs = load_pairs(args.pairs)
+        wrong = [(expected, q, other) for expected, q, other in pairs if same_question(q, other) != (expected == "same")]
+        for expected, q, other in wrong:
+            print(f"expected {expected}: {q!r} / {other!r} -> {normalize_question(q)!r} / {normalize_question(other)!r}")
+        print(f"{len(pairs) - len(wrong)}/{len(pairs)} pairs as expected")
+        raise SystemExit(1 if wrong else 0)
@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hmac
+import json
+import os
+import threading
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import chat_core
+
+# --- Headless Chat API ---
+# An ASGI app serving the same chat pipeline as the Streamlit UI (chat_core) to other clients,
+# e.g. the mobile app or a load generator. One event loop handles every connection; each answer
+# runs in a worker thread (the pipeline is blocking) and its events are streamed back as
+# server-sent events, so many conversations share one process.
+#
+#   GTCC_API_KEYS="key1=user1@example.com,key2=user2@example.com" uvicorn api_server:app --port 8000
+#   (or: python api_server.py --port 8000)
+#
+# Each API key acts as the given user (their sessions and stored Gemini API key). Requests send it
+# as "Authorization: Bearer <key>" or "X-API-Key: <key>". Users without a stored Gemini key use
+# GEMINI_API_KEY from the environment.
+#
+#   GET    /health
+#   GET    /sessions?limit=30                                   -> {"sessions", "has_more"}
+#   POST   /sessions {"name"?}                                  -> 201 {"id", "name"}
+#   DELETE /sessions/{id}                                       -> 204
+#   GET    /sessions/{id}/messages?limit=40&before_seq=&before_timestamp= -> {"messages", "has_more"}
+#   POST   /sessions/{id}/messages {"content"}                  -> text/event-stream
+#
+# Stream events (data is JSON): turn {user_message, assistant_seq}, notice {level, message},
+# progress {level, message}, progress_done, answer_started {prefix}, text {delta},
+# tool {name, args}, transit_lookups {calls}, done {message} and error {message}.
+# A client that disconnects does not cancel its turn: the answer is still finished and stored.
+
+API_TURN_WORKERS = int(os.environ.get("GTCC_API_TURN_WORKERS", "32")) # Answers streamed at once; more wait for a worker
+MAX_PROMPT_CHARS = 4000
+
+def load_api_keys(spec=None):
+    spec = os.environ.get("GTCC_API_KEYS", "") if spec is None else spec
+    api_keys = {}
+    for entry in spec.split(","):
+        key, _, user_email = entry.strip().partition("=")
+        if key and user_email: api_keys[key.strip()] = user_email.strip()
+    return api_keys
+
+API_KEYS = load_api_keys()
+_TURN_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=API_TURN_WORKERS, thread_name_prefix="api-turn")
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS = {} # Gemini API key -> client, validated once per process
+_ACTIVE_SESSIONS_LOCK = threading.Lock()
+_ACTIVE_SESSIONS = set() # Sessions with an answer streaming; one turn per session at a time
+
+def _error(status_code, message):
+    return JSONResponse({"error": message}, status_code=status_code)
+
+def _authenticate(request):
+    supplied_key = request.headers.get("x-api-key") or ""
+    authorization = request.headers.get("authorization") or ""
+    if not supplied_key and authorization.lower().startswith("bearer "):
+        supplied_key = authorization[7:].strip()
+    if not supplied_key: return None
+    user_email = None
+    for key, email in API_KEYS.items(): # Every key is compared, in constant time
+        if hmac.compare_digest(key.encode(), supplied_key.encode()): user_email = email
+    return user_email
+
+def authenticated(handler):
+    @functools.wraps(handler)
+    async def wrapper(request):
+        user_email = _authenticate(request)
+        if user_email is None: return _error(401, "Thiếu hoặc sai API key.")
+        return await handler(request, user_email)
+    return wrapper
+
+async def _owned_session(request, user_email):
+    session_id = request.path_params["session_id"]
+    owner = await run_in_threadpool(chat_core.get_session_owner, session_id)
+    return session_id if owner == user_email else None
+
+async def _json_body(request):
+    try: body = await request.json()
+    except ValueError: return None
+    return body if isinstance(body, dict) else None
+
+def get_gemini_client(api_key_value):
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(api_key_value)
+    if client is None:
+        client = chat_core.create_gemini_client(api_key_value)
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.setdefault(api_key_value, client)
+    return client
+
+def _prewarm_documents(user_email):
+    api_key_value = chat_core.load_api_key(user_email) or os.environ.get("GEMINI_API_KEY")
+    if not api_key_value: return
+    try: chat_core.prewarm_documents(get_gemini_client(api_key_value), api_key_value)
+    except Exception: pass # The first turn uploads (and reports) them instead
+
+def _public_message(msg):
+    msg = dict(msg) # chat_state.Message records are not JSON-serializable themselves
+    if msg.get("gemini_grounding_metadata_json"):
+        try: msg["gemini_grounding_metadata"] = json.loads(msg.pop("gemini_grounding_metadata_json"))
+        except json.JSONDecodeError: msg["gemini_grounding_metadata"] = None
+    return msg
+
+# --- Server-Sent Events ---
+class StreamChatEvents(chat_core.ChatEvents):
+    # Called from the worker thread; each event is handed to the request's event loop.
+    def __init__(self, loop, event_queue):
+        self.loop = loop
+        self.event_queue = event_queue
+
+    def _send(self, event, data=None):
+        self.loop.call_soon_threadsafe(self.event_queue.put_nowait, (event, data or {}))
+
+    def notice(self, level, message): self._send("notice", {"level": level, "message": message})
+    def progress(self, level, message): self._send("progress", {"level": level, "message": message})
+    def progress_done(self): self._send("progress_done")
+    def turn_started(self, user_message, assistant_seq): self._send("turn", {"user_message": _public_message(user_message), "assistant_seq": assistant_seq})
+    def answer_started(self, prefix): self._send("answer_started", {"prefix": prefix})
+    def answer_text(self, delta): self._send("text", {"delta": delta})
+    def tool_suggested(self, name, args): self._send("tool", {"name": name, "args": args})
+    def transit_lookups(self, calls): self._send("transit_lookups", {"calls": [{"name": name, "args": args} for name, args in calls]})
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _run_turn(api_key_value, user_email, session_id, prompt, events):
+    try:
+        client = get_gemini_client(api_key_value)
+    except Exception as e:
+        events.notice("error", f"Lỗi khởi tạo Gemini Client: {e}. Kiểm tra API Key.")
+        raise
+    history, older_history_unloaded = chat_core.load_messages(session_id)
+    return chat_core.run_turn(client, api_key_value, user_email, session_id, prompt, history, events,
+                              older_history_unloaded=older_history_unloaded)
+
+_FINISHED = object()
+
+def _start_turn(api_key_value, user_email, session_id, prompt):
+    # Started before the response is sent, so the turn (and the session's release) never depends on the client reading it.
+    loop = asyncio.get_running_loop()
+    event_queue = asyncio.Queue()
+    future = loop.run_in_executor(_TURN_EXECUTOR, _run_turn, api_key_value, user_email, session_id, prompt,
+                                  StreamChatEvents(loop, event_queue))
+    future.add_done_callback(lambda _: event_queue.put_nowait((_FINISHED, None))) # Queued after the turn's own events
+    future.add_done_callback(lambda _: _release_session(session_id))
+    return future, event_queue
+
+async def _turn_events(future, event_queue):
+    while True:
+        event, data = await event_queue.get()
+        if event is _FINISHED: break
+        yield _sse(event, data)
+    try:
+        yield _sse("done", {"message": _public_message(future.result())})
+    except Exception as e:
+        yield _sse("error", {"message": f"{type(e).__name__}: {e}"})
+
+def _claim_session(session_id):
+    with _ACTIVE_SESSIONS_LOCK:
+        if session_id in _ACTIVE_SESSIONS: return False
+        _ACTIVE_SESSIONS.add(session_id)
+        return True
+
+def _release_session(session_id):
+    with _ACTIVE_SESSIONS_LOCK:
+        _ACTIVE_SESSIONS.discard(session_id)
+
+# --- Endpoints ---
+async def health(request):
+    return JSONResponse({"status": "ok"})
+
+@authenticated
+async def list_sessions(request, user_email):
+    try: limit = max(1, min(200, int(request.query_params.get("limit", chat_core.SESSIONS_PAGE_SIZE))))
+    except ValueError: return _error(400, "limit phải là số nguyên.")
+    sessions, has_more = await run_in_threadpool(chat_core.get_sessions, user_email, limit)
+    return JSONResponse({"sessions": sessions, "has_more": has_more})
+
+@authenticated
+async def create_session(request, user_email):
+    body = await _json_body(request) if await request.body() else {}
+    if body is None: return _error(400, "Body phải là một JSON object.")
+    name = str(body.get("name") or chat_core.DEFAULT_SESSION_NAME).strip()[:200] or chat_core.DEFAULT_SESSION_NAME
+    session_id, session_name = await run_in_threadpool(chat_core.create_session, user_email, name)
+    asyncio.get_running_loop().run_in_executor(None, _prewarm_documents, user_email) # Not awaited: the PDFs upload while the client asks
+    return JSONResponse({"id": session_id, "name": session_name}, status_code=201)
+
+@authenticated
+async def delete_session(request, user_email):
+    session_id = await _owned_session(request, user_email)
+    if session_id is None: return _error(404, "Không tìm thấy phiên trò chuyện.")
+    await run_in_threadpool(chat_core.delete_session, session_id, user_email)
+    return Response(status_code=204)
+
+@authenticated
+async def list_messages(request, user_email):
+    session_id = await _owned_session(request, user_email)
+    if session_id is None: return _error(404, "Không tìm thấy phiên trò chuyện.")
+    params = request.query_params
+    try:
+        limit = max(1, min(200, int(params.get("limit", chat_core.MESSAGES_PAGE_SIZE))))
+        before_message = None
+        if params.get("before_seq") and params.get("before_timestamp"):
+            before_message = {"seq": int(params["before_seq"]), "timestamp": int(params["before_timestamp"])}
+    except ValueError: return _error(400, "limit, before_seq và before_timestamp phải là số nguyên.")
+    messages, has_more = await run_in_threadpool(chat_core.load_messages, session_id, limit, before_message)
+    return JSONResponse({"messages": [_public_message(m) for m in messages], "has_more": has_more})
+
+@authenticated
+async def post_message(request, user_email):
+    session_id = await _owned_session(request, user_email)
+    if session_id is None: return _error(404, "Không tìm thấy phiên trò chuyện.")
+    body = await _json_body(request)
+    prompt = str((body or {}).get("content") or "").strip()
+    if not prompt: return _error(400, "Thiếu nội dung câu hỏi (content).")
+    if len(prompt) > MAX_PROMPT_CHARS: return _error(413, f"Câu hỏi dài quá {MAX_PROMPT_CHARS} ký tự.")
+    api_key_value = await run_in_threadpool(chat_core.load_api_key, user_email) or os.environ.get("GEMINI_API_KEY")
+    if not api_key_value: return _error(409, "Tài khoản chưa có Gemini API Key.")
+    if not _claim_session(session_id): return _error(409, "Phiên này đang có một câu trả lời chưa xong.")
+    future, event_queue = _start_turn(api_key_value, user_email, session_id, prompt)
+    return StreamingResponse(_turn_events(future, event_queue), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(chat_core.get_db_pool) # Opens and migrates the database before the first request
+    yield
+
+app = Starlette(routes=[
+    Route("/health", health),
+    Route("/sessions", list_sessions, methods=["GET"]),
+    Route("/sessions", create_session, methods=["POST"]),
+    Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+    Route("/sessions/{session_id}/messages", list_messages, methods=["GET"]),
+    Route("/sessions/{session_id}/messages", post_message, methods=["POST"]),
+], lifespan=lifespan)
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Headless chat API (server-sent events) over chat_core.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    if not API_KEYS: print("GTCC_API_KEYS is empty: every request will be rejected.")
+    uvicorn.run(app, host=args.host, port=args.port)
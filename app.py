@@ -1,92 +1,75 @@
+import time
+SCRIPT_STARTED_AT = time.perf_counter() # Start of this script run, for the run timing report
 import streamlit as st
 import os
 import json
-import re
 from pathlib import Path
 import sqlite3 
-import uuid 
-import time 
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-import pickle
-
-from google import genai as google_genai_sdk 
-from google.genai import types as google_genai_types
-from google.api_core.exceptions import PermissionDenied, InvalidArgument, NotFound, GoogleAPIError
+import uuid
+# google.genai, google_auth_oauthlib and google.api_core take about a second to import together.
+# They are imported inside the functions that need them, so a fresh server process renders the
+# login page and the sidebar without waiting for them.
+
+import answer_cache
+import auth_cache
+import chat_core
+import chat_state
+import gemini_hedging
+import intent_classifier
+import maintenance
+import message_search
+import metrics
+import stream_rendering
+import turn_store
 
 # --- Configuration ---
-DOC_DIR = Path("documents") 
-PDF_FILENAMES = ["tuyen_duong_sat_do_thi_hcm.pdf", "xe_dap_cong_cong_xe_dien_4_banh_va_xe_buyt_duong_song.pdf", "xe_buyt.pdf"]
+# Model, documents, database and feature flags live in chat_core, shared with api_server.py.
 GEMINI_API_KEY_FILE = Path("gemini_api_key.json")
-DATABASE_PATH = Path("chat_sessions.db") 
 GOOGLE_OAUTH_CONFIG = Path("google_oauth_config.json")
 
 # --- OAuth Configuration ---
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'  # Only for development
+OAUTH_REDIRECT_URI = os.environ.get("GTCC_OAUTH_REDIRECT_URI", "https://chatbotgtcchcm.streamlit.app/")
 
-# Get OAuth config from secrets in production, fallback to file in development
-CLIENT_CONFIG = None
-try:
-    CLIENT_CONFIG = {
-        "web": {
-            "client_id": st.secrets["oauth"]["client_id"],
-            "client_secret": st.secrets["oauth"]["client_secret"],
-            "auth_uri": st.secrets["oauth"]["auth_uri"],
-            "token_uri": st.secrets["oauth"]["token_uri"],
-            "redirect_uris": [st.secrets["oauth"]["redirect_uri"]]
+@st.cache_resource
+def load_oauth_client_config():
+    # Get OAuth config from secrets in production, fallback to file in development (read once per process)
+    try:
+        return {
+            "web": {
+                "client_id": st.secrets["oauth"]["client_id"],
+                "client_secret": st.secrets["oauth"]["client_secret"],
+                "auth_uri": st.secrets["oauth"]["auth_uri"],
+                "token_uri": st.secrets["oauth"]["token_uri"],
+                "redirect_uris": [st.secrets["oauth"]["redirect_uri"]]
+            }
         }
-    }
-except Exception:
-    # Fallback to file in development
-    if GOOGLE_OAUTH_CONFIG.exists():
-        CLIENT_CONFIG = json.loads(GOOGLE_OAUTH_CONFIG.read_text())
+    except Exception:
+        # Fallback to file in development
+        if GOOGLE_OAUTH_CONFIG.exists():
+            return json.loads(GOOGLE_OAUTH_CONFIG.read_text())
+        return None
 
-# --- Configuration ---
-DOC_DIR = Path("documents") 
-PDF_FILENAMES = ["tuyen_duong_sat_do_thi_hcm.pdf", "xe_dap_cong_cong_xe_dien_4_banh_va_xe_buyt_duong_song.pdf", "xe_buyt.pdf"]
-GEMINI_API_KEY_FILE = Path("gemini_api_key.json")
-DATABASE_PATH = Path("chat_sessions.db") 
+CLIENT_CONFIG = load_oauth_client_config()
 
-GEMINI_MODEL_ID = "gemini-2.0-flash" # Sticking to user's specified model ID
+CHAT_RENDER_WINDOW = 40 # Messages rendered in the main pane; older ones are shown on demand
+CHAT_HISTORY_WINDOW = int(os.environ.get("GTCC_CHAT_HISTORY_WINDOW", "120")) # Messages kept in session state; older ones are re-read from SQLite
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("GTCC_ADMIN_EMAILS", "").split(",") if e.strip()}
 
 GEMINI_CLIENT = None
-UPLOADED_FILES_CACHE = {} 
 
 # --- Database Helper Functions ---
-def init_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    # Add user table with api_key column
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            email TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            picture TEXT,
-            created_at INTEGER NOT NULL,
-            gemini_api_key TEXT
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            id TEXT PRIMARY KEY, 
-            name TEXT NOT NULL,
-            created_at INTEGER NOT NULL, 
-            last_updated_at INTEGER NOT NULL,
-            pdfs_uploaded INTEGER DEFAULT 0,
-            user_email TEXT,
-            FOREIGN KEY (user_email) REFERENCES users(email)
-        ) ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id TEXT PRIMARY KEY, session_id TEXT NOT NULL, role TEXT NOT NULL,
-            content TEXT NOT NULL, timestamp INTEGER NOT NULL,
-            gemini_grounding_metadata_json TEXT, 
-            FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE ) ''')
-    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_messages_session_id_timestamp ON messages (session_id, timestamp);''')
-    conn.commit(); conn.close()
-
-def create_new_session_db(session_name_prefix="Trò chuyện mới"):
+# Thin wrappers over chat_core (shared with api_server.py) for the signed-in Streamlit user.
+DB_POOL = chat_core.get_db_pool() # Opened and migrated once per process
+
+def _current_user_email():
+    user_info = st.session_state.get("user_info")
+    return user_info.get("email") if user_info else None
+
+def invalidate_sessions_cache(user_email=None):
+    chat_core.invalidate_sessions_cache(user_email or _current_user_email())
+
+def create_new_session_db(session_name_prefix=chat_core.DEFAULT_SESSION_NAME):
     if not st.session_state.user_info:
         st.error("User not authenticated")
         return None, None
@@ -95,81 +78,97 @@ def create_new_session_db(session_name_prefix="Trò chuyện mới"):
     if not user_email:
         st.error("User email not found")
         return None, None
-    
-    session_id = str(uuid.uuid4()); conn = sqlite3.connect(DATABASE_PATH); cursor = conn.cursor()
-    count = 0; session_name = f"{session_name_prefix}"
-    while True:
-        cursor.execute("SELECT COUNT(*) FROM sessions WHERE name = ? AND user_email = ?", 
-                      (session_name, user_email))
-        if cursor.fetchone()[0] == 0: break
-        count += 1; session_name = f"{session_name_prefix} ({count})"
-    current_time = int(time.time())
-    cursor.execute("""
-        INSERT INTO sessions (id, name, created_at, last_updated_at, pdfs_uploaded, user_email) 
-        VALUES (?, ?, ?, ?, ?, ?)""",
-        (session_id, session_name, current_time, current_time, 0, user_email))
-    conn.commit(); conn.close(); return session_id, session_name
-
-def get_sessions_db():
-    if not st.session_state.user_info:
-        return []
-    
-    user_email = st.session_state.user_info.get("email")
+    return chat_core.create_session(user_email, session_name_prefix)
+
+def get_sessions_db(limit=chat_core.SESSIONS_PAGE_SIZE):
+    """Return (most recent `limit` sessions, whether more exist), served from the per-user cache."""
+    user_email = _current_user_email()
     if not user_email:
-        return []
-    
-    conn = sqlite3.connect(DATABASE_PATH); cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, name, last_updated_at, pdfs_uploaded 
-        FROM sessions 
-        WHERE user_email = ? 
-        ORDER BY last_updated_at DESC""", 
-        (user_email,))
-    sessions = [{"id": r[0], "name": r[1], "last_updated_at": r[2], "pdfs_uploaded": r[3]} for r in cursor.fetchall()]
-    conn.close(); return sessions
-
-def load_messages_db(session_id):
-    conn = sqlite3.connect(DATABASE_PATH); cursor = conn.cursor()
-    cursor.execute("SELECT role, content, gemini_grounding_metadata_json FROM messages WHERE session_id = ? ORDER BY timestamp ASC", (session_id,))
-    messages = []
-    for row in cursor.fetchall():
-        msg = {"role": row[0], "content": row[1]}
-        if row[2]: # gemini_grounding_metadata_json
-            try: msg["gemini_grounding_metadata"] = json.loads(row[2]) 
-            except json.JSONDecodeError: msg["gemini_grounding_metadata_error"] = "Lỗi parse metadata"
-        messages.append(msg)
-    conn.close(); return messages
-
-def save_message_db(session_id, role, content, grounding_metadata_obj=None):
-    message_id = str(uuid.uuid4()); current_time = int(time.time())
-    conn = sqlite3.connect(DATABASE_PATH); cursor = conn.cursor()
-    grounding_metadata_json_str = None
-    if grounding_metadata_obj:
-        try: grounding_metadata_json_str = json.dumps(grounding_metadata_obj)
-        except TypeError: st.warning("Không thể serialize grounding metadata.")
-    cursor.execute("INSERT INTO messages (id, session_id, role, content, timestamp, gemini_grounding_metadata_json) VALUES (?, ?, ?, ?, ?, ?)",
-                   (message_id, session_id, role, content, current_time, grounding_metadata_json_str))
-    cursor.execute("UPDATE sessions SET last_updated_at = ? WHERE id = ?", (current_time, session_id))
-    conn.commit(); conn.close()
-
-def set_pdfs_uploaded_for_session_db(session_id):
-    conn = sqlite3.connect(DATABASE_PATH); cursor = conn.cursor()
-    cursor.execute("UPDATE sessions SET pdfs_uploaded = 1, last_updated_at = ? WHERE id = ?", (int(time.time()), session_id))
-    conn.commit(); conn.close()
+        return [], False
+    return chat_core.get_sessions(user_email, limit)
+
+def load_messages_db(session_id, limit=chat_core.MESSAGES_PAGE_SIZE, before_message=None):
+    return chat_core.load_messages(session_id, limit, before_message)
+
+def get_grounding_metadata(msg):
+    if "gemini_grounding_metadata" not in msg and msg.get("gemini_grounding_metadata_json"):
+        try: msg["gemini_grounding_metadata"] = json.loads(msg.pop("gemini_grounding_metadata_json"))
+        except json.JSONDecodeError: msg["gemini_grounding_metadata"] = None; msg["gemini_grounding_metadata_error"] = "Lỗi parse metadata"
+    return msg.get("gemini_grounding_metadata")
+
+def open_session(session_id):
+    st.session_state.current_session_id = session_id
+    if session_id: st.session_state.chat_history, st.session_state.chat_history_has_more = load_messages_db(session_id)
+    else: st.session_state.chat_history, st.session_state.chat_history_has_more = [], False
+    st.session_state.chat_render_limit = CHAT_RENDER_WINDOW
+    st.session_state.search_focus_seq = None
+
+def open_session_at(session_id, message_seq):
+    # Open a session from a search result: page back until the message is loaded, then render from it.
+    open_session(session_id)
+    history = st.session_state.chat_history
+    while history and st.session_state.chat_history_has_more and not any(m["seq"] == message_seq for m in history):
+        older, st.session_state.chat_history_has_more = load_messages_db(session_id, before_message=history[0])
+        history = older + history
+    st.session_state.chat_history = history
+    position = next((i for i, m in enumerate(history) if m["seq"] == message_seq), None)
+    if position is not None:
+        st.session_state.chat_render_limit = max(CHAT_RENDER_WINDOW, len(history) - position)
+        st.session_state.search_focus_seq = message_seq
+
+def request_resume(message_seq):
+    st.session_state.resume_message_seq = message_seq
+
+def resume_interrupted_turn(msg):
+    # Continue an interrupted answer in its own chat bubble, from the stored partial text.
+    history = st.session_state.chat_history
+    position = next((i for i, m in enumerate(history) if m is msg), None)
+    if not position or history[position - 1]["role"] != "user":
+        st.markdown(msg["content"]); return
+    resumed_msg = chat_core.resume_turn(
+        GEMINI_CLIENT, st.session_state.get("gemini_api_key"), _current_user_email(), st.session_state.current_session_id,
+        history[position - 1]["content"], msg, history[:position - 1], StreamlitChatEvents(),
+        older_history_unloaded=st.session_state.chat_history_has_more)
+    if resumed_msg is None:
+        st.info("Câu trả lời này đã được hoàn tất ở nơi khác. Mở lại phiên để xem."); return
+    msg.pop("status", None); msg.pop("heartbeat_at", None)
+    msg.update(resumed_msg)
+
+def search_history(query, load_more=False):
+    # Results of the sidebar search, accumulated page by page in session state.
+    state = st.session_state.get("history_search")
+    if not load_more or not state or state["query"] != query:
+        results, next_cursor = message_search.search_messages(DB_POOL, _current_user_email(), query)
+        state = {"query": query, "results": results, "next_cursor": next_cursor}
+    elif state["next_cursor"]:
+        results, state["next_cursor"] = message_search.search_messages(DB_POOL, _current_user_email(), query, after=state["next_cursor"])
+        state["results"] = state["results"] + results
+    st.session_state.history_search = state
+    return state
+
+def load_older_messages():
+    # Reveal messages already in memory first, then fetch the next page from the DB.
+    history = st.session_state.chat_history
+    if len(history) <= st.session_state.chat_render_limit and st.session_state.chat_history_has_more and history:
+        older, st.session_state.chat_history_has_more = load_messages_db(st.session_state.current_session_id, before_message=history[0])
+        st.session_state.chat_history = older + history
+    st.session_state.chat_render_limit += chat_core.MESSAGES_PAGE_SIZE
+
+def trim_chat_history():
+    # Keep the most recent window (or what is rendered, if more) in session state; the rest is paged back in on demand.
+    keep = max(CHAT_HISTORY_WINDOW, st.session_state.chat_render_limit)
+    if len(st.session_state.chat_history) > keep:
+        st.session_state.chat_history = st.session_state.chat_history[-keep:]
+        st.session_state.chat_history_has_more = True
+    chat_state.track_chat_state(st.session_state.chat_state_id, st.session_state.chat_history)
 
 def rename_session_db(session_id, new_name):
-    conn=sqlite3.connect(DATABASE_PATH);cursor=conn.cursor()
-    try: cursor.execute("UPDATE sessions SET name = ?, last_updated_at = ? WHERE id = ?", (new_name, int(time.time()), session_id)); conn.commit(); return True
+    try: chat_core.rename_session(session_id, new_name, _current_user_email()); return True
     except sqlite3.Error as e: st.error(f"Lỗi DB rename: {e}"); return False
-    finally: conn.close()
 
 def delete_session_db(session_id):
-    conn=sqlite3.connect(DATABASE_PATH);cursor=conn.cursor()
-    try: cursor.execute("DELETE FROM sessions WHERE id = ?", (session_id,)); conn.commit(); return True
+    try: chat_core.delete_session(session_id, _current_user_email()); return True
     except sqlite3.Error as e: st.error(f"Lỗi DB delete: {e}"); return False
-    finally: conn.close()
-
-init_db()
 
 def load_api_key():
     if not st.session_state.user_info:
@@ -178,16 +177,7 @@ def load_api_key():
     user_email = st.session_state.user_info.get('email')
     if not user_email:
         return None
-        
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT gemini_api_key FROM users WHERE email = ?", (user_email,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result and result[0]:
-        return result[0]
-    return None
+    return chat_core.load_api_key(user_email)
 
 def save_api_key(api_key_value):
     if not st.session_state.user_info:
@@ -196,167 +186,58 @@ def save_api_key(api_key_value):
     user_email = st.session_state.user_info.get('email')
     if not user_email:
         return False
-        
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET gemini_api_key = ? WHERE email = ?", 
-                  (api_key_value, user_email))
-    conn.commit()
-    conn.close()
+    chat_core.save_api_key(user_email, api_key_value)
     return True
 
 @st.cache_resource
 def get_gemini_client(api_key_value):
     try:
-        client = google_genai_sdk.Client(api_key=api_key_value)
-        client.models.list() 
+        client = chat_core.create_gemini_client(api_key_value)
         st.success("Gemini Client đã khởi tạo thành công!")
         return client
     except Exception as e:
         st.error(f"Lỗi khởi tạo Gemini Client: {e}. Kiểm tra API Key.")
         return None
 
-def upload_files_to_gemini(client, pdf_filenames_list, current_session_id):
-    if current_session_id in UPLOADED_FILES_CACHE and UPLOADED_FILES_CACHE[current_session_id]:
-        st.info(f"Sử dụng file đã upload cho session {current_session_id} từ cache.")
-        return UPLOADED_FILES_CACHE[current_session_id]
-
-    uploaded_file_objects = []
-    st.write("Đang upload tài liệu PDF lên Gemini...")
-    for filename in pdf_filenames_list:
-        file_path_obj = DOC_DIR / filename
-        if file_path_obj.exists():
-            try:
-                with st.spinner(f"Uploading {filename}..."):
-                    st.write(f"Đang upload: {file_path_obj.name}")
-                    gemini_file_obj = client.files.upload(file=file_path_obj) 
-                    uploaded_file_objects.append(gemini_file_obj)
-                    st.success(f"Đã upload: {filename} (ID: {gemini_file_obj.name})")
-            except Exception as e:
-                st.error(f"Lỗi upload file {filename}: {e}")
-                st.error(f"Chi tiết lỗi: {type(e).__name__} - {e}")
-        else:
-            st.error(f"Không tìm thấy file: {file_path_obj}")
-    
-    if uploaded_file_objects:
-        UPLOADED_FILES_CACHE[current_session_id] = uploaded_file_objects
-        set_pdfs_uploaded_for_session_db(current_session_id)
-    else:
-        st.warning("Không có file PDF nào được upload thành công.")
-    return uploaded_file_objects
+# --- Turn Rendering ---
+class StreamlitChatEvents(chat_core.ChatEvents):
+    # Renders chat_core's turn events in the current container (the assistant's chat bubble).
+    def __init__(self):
+        self.status_placeholder = None
+        self.renderer = None
 
-def generate_gemini_response_stream(client, user_prompt_text, current_session_id, existing_chat_history):
-    global UPLOADED_FILES_CACHE
-    model_to_use = GEMINI_MODEL_ID 
-    
-    system_instruction_string = """bạn là một trợ lý về giao thông công cộng khu vực nội thành thành phố hồ chí minh. Nhiệm vụ của bạn là trả lời các thông tin về giao thông công cộng một cách chi tiết, nếu thông tin liên quan cho câu hỏi không có thì hãy thực hiện google search, đừng tự tạo ra thông tin. Nếu câu hỏi lạc đề, hãy nhấn mạnh lại vai trò của bạn và dẫn dắt người dùng hỏi những câu hỏi liên quan"""
-    
-    system_parts_for_config = [google_genai_types.Part.from_text(text=system_instruction_string)]
+    def notice(self, level, message):
+        getattr(st, level)(message)
 
-    gemini_contents = []
-    for msg in existing_chat_history:
-        role = "user" if msg["role"] == "user" else "model"
-        msg_content_str = str(msg.get("content", "")) 
-        gemini_contents.append(google_genai_types.Content(role=role, parts=[google_genai_types.Part.from_text(text=msg_content_str)]))
+    def progress(self, level, message):
+        if self.status_placeholder is None: self.status_placeholder = st.empty()
+        getattr(self.status_placeholder, level)(message)
 
-    current_user_parts = [google_genai_types.Part.from_text(text=user_prompt_text)]
+    def progress_done(self):
+        if self.status_placeholder is not None: self.status_placeholder.empty()
 
-    session_info = next((s for s in st.session_state.get("sessions_list", []) if s["id"] == current_session_id), None)
-    pdfs_already_uploaded_for_session = False
-    if session_info: pdfs_already_uploaded_for_session = session_info.get("pdfs_uploaded", 0) == 1
-    else:
-        conn = sqlite3.connect(DATABASE_PATH); cursor = conn.cursor()
-        cursor.execute("SELECT pdfs_uploaded FROM sessions WHERE id = ?", (current_session_id,))
-        db_row = cursor.fetchone(); conn.close()
-        if db_row: pdfs_already_uploaded_for_session = db_row[0] == 1
-    
-    needs_pdf_upload_this_turn = not pdfs_already_uploaded_for_session
+    def turn_started(self, user_message, assistant_seq):
+        st.session_state.chat_history.append(user_message)
 
-    if needs_pdf_upload_this_turn:
-        st.info("Tin nhắn đầu/file chưa up cho phiên này. Đính kèm PDFs...")
-        pdf_file_objects_for_this_turn = [] 
-        if current_session_id not in UPLOADED_FILES_CACHE or not UPLOADED_FILES_CACHE[current_session_id]:
-            pdf_file_objects_for_this_turn = upload_files_to_gemini(client, PDF_FILENAMES, current_session_id)
-        else:
-            pdf_file_objects_for_this_turn = UPLOADED_FILES_CACHE[current_session_id]; st.info("Dùng PDF cache cho Gemini.")
-        
-        if pdf_file_objects_for_this_turn:
-            for file_obj in pdf_file_objects_for_this_turn:
-                file_part = google_genai_types.Part(
-                    file_data=google_genai_types.FileData(
-                        mime_type=file_obj.mime_type, file_uri=file_obj.uri
-                    ))
-                current_user_parts.append(file_part)
-            st.success(f"Đã chuẩn bị {len(pdf_file_objects_for_this_turn)} PDF parts để đính kèm.")
-        else: st.warning("Không PDF nào được chuẩn bị để đính kèm.")
-            
-    elif current_session_id in UPLOADED_FILES_CACHE and UPLOADED_FILES_CACHE[current_session_id]:
-        st.info("Đính kèm lại các file PDF đã upload vào prompt (từ cache).")
-        pdf_file_objects_from_cache = UPLOADED_FILES_CACHE[current_session_id]
-        for file_obj in pdf_file_objects_from_cache:
-            file_part = google_genai_types.Part(
-                file_data=google_genai_types.FileData(
-                    mime_type=file_obj.mime_type, file_uri=file_obj.uri
-                ))
-            current_user_parts.append(file_part)
-        if pdf_file_objects_from_cache : st.success(f"Đã chuẩn bị {len(pdf_file_objects_from_cache)} PDF parts từ cache.")
-
-    gemini_contents.append(google_genai_types.Content(role="user", parts=current_user_parts))
-    tools_for_gemini = [google_genai_types.Tool(google_search=google_genai_types.GoogleSearch())]
-    
-    generation_config_for_stream = google_genai_types.GenerateContentConfig(
-        tools=tools_for_gemini,
-        response_mime_type="text/plain",
-        system_instruction=system_parts_for_config 
-    )
-    
-    full_response_text = ""; captured_grounding_metadata_dict = None; raw_tool_calls_from_stream = []
-    try:
-        st.info(f"Gọi Gemini API ({model_to_use}) với stream...")
-        response_stream = client.models.generate_content_stream(
-            model=model_to_use, contents=gemini_contents, config=generation_config_for_stream,
-        )
-        placeholder = st.empty()
-        for chunk in response_stream: # chunk is a GenerateContentResponse
-            if hasattr(chunk, 'text') and chunk.text: # Check if chunk.text exists and is not empty
-                full_response_text += chunk.text
-                placeholder.markdown(full_response_text + "▌")
-            
-            # Correctly check for function calls
-            if hasattr(chunk, 'candidates') and chunk.candidates:
-                for candidate in chunk.candidates:
-                    if hasattr(candidate, 'content') and candidate.content and \
-                       hasattr(candidate.content, 'parts') and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            if hasattr(part, 'function_call') and part.function_call:
-                                fc = part.function_call
-                                args_dict = {}
-                                if hasattr(fc, 'args') and fc.args:
-                                    try: args_dict = dict(fc.args)
-                                    except TypeError: 
-                                        args_dict = {"error": "Could not parse fc.args to dict"}
-                                        st.warning(f"Không thể convert fc.args sang dict: {type(fc.args)}")
-                                raw_tool_calls_from_stream.append({"name": fc.name, "args": args_dict})
-                                st.caption(f"Gemini đề xuất dùng tool: {fc.name} với args: {args_dict}")
-        placeholder.markdown(full_response_text)
-
-        if any(tc['name'].lower() in ['googlesearch', 'google_search'] for tc in raw_tool_calls_from_stream):
-            st.info("Google Search được Gemini sử dụng (chi tiết metadata đầy đủ cần non-streaming call).")
-            search_queries = []
-            for tc in raw_tool_calls_from_stream:
-                if tc['name'].lower() in ['googlesearch', 'google_search'] and tc.get('args'):
-                    query_arg = tc['args'].get('query', tc['args'].get('q', 'Không rõ query'))
-                    search_queries.append(str(query_arg))
-            captured_grounding_metadata_dict = {"search_performed": True, "queries_used_by_gemini": search_queries if search_queries else ["Không rõ query cụ thể."]}
-        
-        return full_response_text, captured_grounding_metadata_dict
-    except GoogleAPIError as e:
-        st.error(f"Lỗi API từ Gemini: {getattr(e, 'message', str(e))} (Code: {getattr(e, 'code', 'N/A')})")
-        if hasattr(e, 'summary'): st.error(f"Tóm tắt lỗi: {getattr(e, 'summary', '')}")
-        return f"[Lỗi Gemini API: {getattr(e, 'message', str(e))}]", None
-    except Exception as e: 
-        st.error(f"Lỗi không xác định khi gọi Gemini API: {e}")
-        return f"[Lỗi Gemini: {e}]", None
+    def answer_started(self, prefix):
+        # Queue and retry status above the answer; text goes to a throttled renderer.
+        self.progress_done()
+        self.status_placeholder = st.empty()
+        self.renderer = stream_rendering.StreamRenderer(st.empty())
+        self.renderer.append(prefix)
+
+    def answer_text(self, delta):
+        self.renderer.append(delta)
+
+    def answer_finished(self, text):
+        self.renderer.finish()
+        metrics.set_attributes(render_flushes=self.renderer.flush_count)
+
+    def tool_suggested(self, name, args):
+        st.caption(f"Gemini đề xuất dùng tool: {name} với args: {args}")
+
+    def transit_lookups(self, calls):
+        st.caption("Tra cứu dữ liệu giao thông: " + ", ".join(f"{name}({', '.join(str(v) for v in args.values())})" for name, args in calls))
 
 # --- Authentication Functions ---
 def init_google_auth():
@@ -364,19 +245,21 @@ def init_google_auth():
         st.error("Google OAuth configuration not found. Please set up google_oauth_config.json")
         return None
     
+    from google_auth_oauthlib.flow import Flow
     flow = Flow.from_client_config(
         CLIENT_CONFIG,
         scopes=['openid', 'https://www.googleapis.com/auth/userinfo.profile', 'https://www.googleapis.com/auth/userinfo.email'],
-        redirect_uri="https://chatbotgtcchcm.streamlit.app/"
+        redirect_uri=OAUTH_REDIRECT_URI
     )
     return flow
 
 def get_user_info(creds_dict=None):
-    import google.auth.transport.requests
-    import requests
-    
+    # Accepts a credentials dict, a Credentials object, or nothing (the session's credentials).
+    # The profile is served from auth_cache while the access token is unchanged, and tokens are
+    # refreshed in the background before they expire.
     try:
-        if creds_dict:
+        if isinstance(creds_dict, dict):
+            from google.oauth2.credentials import Credentials
             credentials = Credentials(
                 token=creds_dict.get('token'),
                 refresh_token=creds_dict.get('refresh_token'),
@@ -386,23 +269,14 @@ def get_user_info(creds_dict=None):
                 scopes=creds_dict.get('scopes')
             )
         else:
-            credentials = st.session_state.user_credentials
-            
-        if not credentials or not credentials.valid:
-            if credentials and credentials.expired and credentials.refresh_token:
-                request = google.auth.transport.requests.Request()
-                credentials.refresh(request)
-                # Update stored credentials if they were refreshed
-                if hasattr(st.session_state, 'user_credentials'):
-                    st.session_state.user_credentials = credentials
-        
-        userinfo_endpoint = "https://www.googleapis.com/oauth2/v3/userinfo"
-        response = requests.get(
-            userinfo_endpoint,
-            headers={'Authorization': f'Bearer {credentials.token}'}
-        )
-        if response.ok:
-            return response.json()
+            credentials = creds_dict or st.session_state.user_credentials
+        if not credentials:
+            return None
+
+        auth_cache.keep_fresh(credentials)
+        user_info = auth_cache.get_userinfo(credentials)
+        if user_info:
+            return user_info
         else:
             st.error("Failed to get user info")
             return None
@@ -410,6 +284,24 @@ def get_user_info(creds_dict=None):
         st.error(f"Error getting user info: {e}")
         return None
 
+# --- Document Upload Progress ---
+@st.fragment(run_every=1.0)
+def show_document_upload_progress():
+    # Polls the background PDF uploads once a second without rerunning the rest of the page.
+    upload_status = chat_core.documents_upload_status(st.session_state.gemini_api_key)
+    if upload_status["uploading"]:
+        st.caption(f"📄 Đang tải tài liệu PDF lên Gemini: {upload_status['ready']}/{len(chat_core.PDF_FILENAMES)} đã sẵn sàng...")
+    elif upload_status["failed"]:
+        st.caption(f"⚠️ {upload_status['failed']} tài liệu PDF chưa tải lên được, sẽ thử lại khi bạn đặt câu hỏi.")
+    else:
+        st.caption("📄 Tài liệu PDF đã sẵn sàng.")
+
+# --- Script Run Timing ---
+def record_script_run_time():
+    # Called at the end of the script and before the login page's st.stop(). Runs cut short by
+    # st.rerun() are not counted: the run they trigger is.
+    metrics.record_script_run(time.perf_counter() - SCRIPT_STARTED_AT)
+
 # --- Initialization and Authentication ---
 def initialize_auth_and_session():
     # Initialize basic session state
@@ -417,6 +309,11 @@ def initialize_auth_and_session():
     if "user_credentials" not in st.session_state: st.session_state.user_credentials = None
     if "current_session_id" not in st.session_state: st.session_state.current_session_id = None
     if "chat_history" not in st.session_state: st.session_state.chat_history = []
+    if "chat_history_has_more" not in st.session_state: st.session_state.chat_history_has_more = False
+    if "chat_state_id" not in st.session_state: st.session_state.chat_state_id = uuid.uuid4().hex
+    if "chat_render_limit" not in st.session_state: st.session_state.chat_render_limit = CHAT_RENDER_WINDOW
+    if "search_focus_seq" not in st.session_state: st.session_state.search_focus_seq = None
+    if "resume_message_seq" not in st.session_state: st.session_state.resume_message_seq = None
     if "gemini_api_key" not in st.session_state: st.session_state.gemini_api_key = load_api_key()
 
     # Try to refresh existing credentials if present
@@ -437,39 +334,22 @@ def initialize_auth_and_session():
                     
                     [![Login with Google](https://img.shields.io/badge/Login_with_Google-4285F4?style=for-the-badge&logo=google&logoColor=white)]({auth_url})
                     """)
+                record_script_run_time()
                 st.stop()
             else:
                 try:
                     code = st.query_params["code"]
-                    flow.fetch_token(code=code)
+                    flow.fetch_token(code=code, timeout=auth_cache.HTTP_TIMEOUT_SECONDS)
                     credentials = flow.credentials
                     st.session_state.user_credentials = credentials
                     
                     user_info = get_user_info()
                     if user_info:
                         st.session_state.user_info = user_info
-                        # Store user in database
-                        conn = sqlite3.connect(DATABASE_PATH)
-                        cursor = conn.cursor()                        # Only update user info, preserve API key
-                        cursor.execute("""
-                            INSERT INTO users (email, name, picture, created_at, gemini_api_key)
-                            VALUES (?, ?, ?, ?, NULL)
-                            ON CONFLICT(email) DO UPDATE SET
-                                name = excluded.name,
-                                picture = excluded.picture,
-                                created_at = excluded.created_at
-                                -- Intentionally not updating gemini_api_key to preserve it
-                        """, (user_info['email'], user_info['name'], 
-                             user_info.get('picture', ''), int(time.time())))
-                        conn.commit()
-
-                        # Load the API key for this user
-                        cursor.execute("SELECT gemini_api_key FROM users WHERE email = ?", (user_info['email'],))
-                        api_key_row = cursor.fetchone()
-                        if api_key_row and api_key_row[0]:
-                            st.session_state.gemini_api_key = api_key_row[0]
+                        stored_api_key = chat_core.upsert_user_if_changed(user_info)
+                        if stored_api_key:
+                            st.session_state.gemini_api_key = stored_api_key
                         
-                        conn.close()
                         st.rerun()
                 except Exception as e:
                     st.error(f"Error during authentication: {e}")
@@ -478,11 +358,9 @@ def initialize_auth_and_session():
                     st.stop()
 
     # After authentication, load sessions
+    if "sessions_page_limit" not in st.session_state: st.session_state.sessions_page_limit = chat_core.SESSIONS_PAGE_SIZE
     if "sessions_list" not in st.session_state:
-        st.session_state.sessions_list = get_sessions_db()
-
-# Initialize database tables
-init_db()
+        st.session_state.sessions_list, _ = get_sessions_db(st.session_state.sessions_page_limit)
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="Chatbot GTCC HCM (Gemini)", layout="wide")
@@ -498,10 +376,11 @@ with st.sidebar:
             st.write(f"👤 Xin chào, {st.session_state.user_info.get('name', 'User')}")
         with col2:
             if st.button("Đăng xuất", key="logout_button"):
+                auth_cache.forget(st.session_state.get('user_credentials'))
                 # Clear query parameters first
                 st.query_params.clear()
                 # Clear all session state
-                for key in ['user_credentials', 'user_info', 'current_session_id', 'chat_history', 'sessions_list', 'gemini_api_key']:
+                for key in ['user_credentials', 'user_info', 'current_session_id', 'chat_history', 'chat_history_has_more', 'chat_render_limit', 'search_focus_seq', 'resume_message_seq', 'history_search', 'history_search_query', 'sessions_list', 'sessions_page_limit', 'gemini_api_key']:
                     if key in st.session_state:
                         del st.session_state[key]
                 st.rerun()
@@ -511,15 +390,34 @@ with st.sidebar:
         
     st.header("Phiên trò chuyện")
     if st.button("➕ Trò chuyện mới", use_container_width=True):
-        new_id, _ = create_new_session_db(); st.session_state.current_session_id = new_id
-        st.session_state.chat_history = []; 
-        if new_id in UPLOADED_FILES_CACHE: del UPLOADED_FILES_CACHE[new_id] 
-        st.session_state.sessions_list = get_sessions_db(); st.rerun()
+        new_id, _ = create_new_session_db(); open_session(new_id)
+        chat_core.prewarm_documents(GEMINI_CLIENT, st.session_state.gemini_api_key) # Uploads while the user types
+        st.rerun()
+    if st.session_state.gemini_api_key:
+        document_upload_status = chat_core.documents_upload_status(st.session_state.gemini_api_key)
+        if document_upload_status["uploading"] or document_upload_status["failed"]: show_document_upload_progress()
+
+    history_search_query = st.text_input("🔎 Tìm trong lịch sử trò chuyện", key="history_search_query", placeholder="vd: giá vé tuyến 19").strip()
+    if history_search_query and _current_user_email():
+        search_state = st.session_state.get("history_search")
+        if not search_state or search_state["query"] != history_search_query:
+            search_state = search_history(history_search_query)
+        if not search_state["results"]:
+            st.caption("Không tìm thấy tin nhắn phù hợp.")
+        for hit in search_state["results"]:
+            hit_label = f"{hit['session_name']} · {time.strftime('%d/%m/%Y', time.localtime(hit['timestamp']))}"
+            if st.button(hit_label, key=f"search_hit_{hit['message_rowid']}", use_container_width=True):
+                open_session_at(hit["session_id"], hit["message_rowid"]); st.rerun()
+            st.caption(("🧑 " if hit["role"] == "user" else "🤖 ") + hit["snippet"])
+        if search_state["next_cursor"] and st.button("Xem thêm kết quả", key="more_search_results_button", use_container_width=True):
+            search_history(history_search_query, load_more=True); st.rerun()
+        st.divider()
     
-    st.session_state.sessions_list = get_sessions_db() # Refresh list
+    session_lookup_started_at = time.perf_counter()
+    st.session_state.sessions_list, has_more_sessions = get_sessions_db(st.session_state.sessions_page_limit) # Cached, invalidated on writes
+    session_lookup_seconds = time.perf_counter() - session_lookup_started_at
     if not st.session_state.current_session_id and st.session_state.sessions_list:
-        st.session_state.current_session_id = st.session_state.sessions_list[0]["id"]
-        st.session_state.chat_history = load_messages_db(st.session_state.current_session_id)
+        open_session(st.session_state.sessions_list[0]["id"])
     
     for session_item in st.session_state.sessions_list:
         cols = st.columns([0.7, 0.15, 0.15]); 
@@ -527,17 +425,17 @@ with st.sidebar:
         btn_label = f"{'➡️ ' if is_curr else ''}{session_item['name']}"
         if cols[0].button(btn_label, key=f"session_{session_item['id']}", use_container_width=True):
             if not is_curr: 
-                st.session_state.current_session_id = session_item['id']; 
-                st.session_state.chat_history = load_messages_db(session_item['id']); 
+                open_session(session_item['id'])
                 st.rerun()
         if cols[1].button("✏️", key=f"rename_{session_item['id']}", help="Đổi tên"): 
             st.session_state.renaming_session_id = session_item['id']; st.rerun()
         if cols[2].button("🗑️", key=f"delete_{session_item['id']}", help="Xoá"):
             if delete_session_db(session_item['id']):
                 if st.session_state.current_session_id == session_item['id']: 
-                    st.session_state.current_session_id = None; st.session_state.chat_history = []
-                if session_item['id'] in UPLOADED_FILES_CACHE: del UPLOADED_FILES_CACHE[session_item['id']]
-                st.session_state.sessions_list = get_sessions_db(); st.rerun()
+                    open_session(None)
+                st.rerun()
+    if has_more_sessions and st.button("Xem thêm phiên cũ hơn", key="more_sessions_button", use_container_width=True):
+        st.session_state.sessions_page_limit += chat_core.SESSIONS_PAGE_SIZE; st.rerun()
                 
     if st.session_state.get('renaming_session_id'):
         with st.form(key="rename_form"):
@@ -548,7 +446,7 @@ with st.sidebar:
                 if new_session_name.strip():
                     if rename_session_db(st.session_state.renaming_session_id, new_session_name.strip()):
                         del st.session_state.renaming_session_id; 
-                        st.session_state.sessions_list = get_sessions_db(); st.rerun()
+                        st.rerun()
                 else: 
                     st.warning("Tên không được để trống.")
     st.divider()
@@ -571,10 +469,50 @@ with st.sidebar:
                         if save_api_key(new_key):
                             st.session_state.gemini_api_key = new_key
                             GEMINI_CLIENT = client_test
+                            chat_core.prewarm_documents(client_test, new_key)
                             st.success(f"Đã lưu API Key cho tài khoản {st.session_state.user_info.get('email')}!")
                             st.rerun()
                 else: 
                     st.warning("Vui lòng nhập API Key.")
+    if chat_core.METRICS_ENABLED and _current_user_email() and _current_user_email().lower() in ADMIN_EMAILS:
+        st.divider()
+        if st.toggle("📊 Hiệu năng (quản trị)", key="admin_metrics_toggle"): # Queried only while open
+            stage_summary = metrics.stage_percentiles(DB_POOL)
+            if stage_summary:
+                st.caption(f"p50/p95 (ms) trên {metrics.PERCENTILE_WINDOW} lượt gần nhất")
+                st.table([{"Giai đoạn": stage, "Số lượt": s["count"], "p50": s["p50_ms"], "p95": s["p95_ms"]} for stage, s in stage_summary.items()])
+            else:
+                st.caption("Chưa có số liệu.")
+            script_runs = metrics.script_run_summary()
+            if script_runs["runs"]:
+                st.caption(f"Khởi động tiến trình: {script_runs['cold_start_ms']} ms · Chạy lại script: p50 {script_runs.get('p50_ms', '–')} ms, "
+                           f"p95 {script_runs.get('p95_ms', '–')} ms ({script_runs['runs']} lượt)")
+            memory = chat_core.memory_report()
+            rss_mb = f"{memory['process']['rss_bytes'] / 2**20:.0f} MB" if memory["process"]["rss_bytes"] else "–"
+            st.caption(f"Bộ nhớ tiến trình: {rss_mb} · Lịch sử trò chuyện: {memory['chat_state']['sessions']} phiên trình duyệt, "
+                       f"{memory['chat_state']['messages']} tin nhắn (~{memory['chat_state']['bytes'] / 2**20:.1f} MB) · "
+                       f"File PDF theo phiên: {memory['uploaded_files_cache']['entries']}/{memory['uploaded_files_cache']['max_entries']}")
+            db_report = maintenance.database_report(DB_POOL)
+            last_maintenance = time.strftime('%d/%m/%Y %H:%M', time.localtime(db_report["last_maintenance_at"])) if db_report["last_maintenance_at"] else "chưa chạy"
+            st.caption(f"Cơ sở dữ liệu: {db_report['file_bytes'] / 2**20:.1f} MB (trống {db_report['free_ratio']:.0%}, WAL {db_report['wal_bytes'] / 2**20:.1f} MB) · "
+                       f"Lưu trữ: {db_report['archive']['sessions']} phiên, {db_report['archive']['messages']} tin nhắn "
+                       f"(nén còn {db_report['archive']['compressed_bytes'] / 2**20:.1f} MB) · Bảo trì lần cuối: {last_maintenance}")
+            if chat_core.INTENT_ROUTER_ENABLED:
+                intent_stats = intent_classifier.routing_stats()
+                routed_summary = ", ".join(f"{label} {n}" for label, n in sorted(intent_stats["routed"].items())) or "0"
+                st.caption(f"Phân loại câu hỏi: {intent_stats['classified']} lượt, trả lời mẫu: {routed_summary}, "
+                           f"chuyển Gemini: {sum(intent_stats['passed'].values())} · p50 {intent_stats.get('p50_ms', '–')} ms, "
+                           f"p95 {intent_stats.get('p95_ms', '–')} ms" + ("" if intent_stats["classified"] or not intent_stats["no_model"] else " (mô hình đang được huấn luyện)"))
+            if chat_core.HEDGE_REQUESTS_ENABLED:
+                hedge_stats = gemini_hedging.hedging_stats()
+                deadlines = ", ".join(f"{model} {m['hedge_delay_ms']:.0f} ms" for model, m in sorted(hedge_stats["models"].items())) or "–"
+                st.caption(f"Yêu cầu dự phòng Gemini: {hedge_stats.get('hedges', 0)}/{hedge_stats.get('requests', 0)} lượt gọi, "
+                           f"thắng {hedge_stats.get('hedge_wins', 0)}, bỏ qua do hết hạn mức {hedge_stats.get('skipped_budget', 0) + hedge_stats.get('skipped_quota', 0)} · "
+                           f"ngưỡng chờ: {deadlines}")
+            if chat_core.ANSWER_CACHE_ENABLED:
+                answer_cache_stats = answer_cache.get_stats(DB_POOL)
+                st.caption(f"Bộ nhớ đệm câu trả lời: {answer_cache_stats['hits']} lượt dùng lại, {answer_cache_stats['misses']} lượt gọi mới, "
+                           f"{answer_cache_stats['entries']} câu hỏi đã lưu.")
 
 st.title("Chatbot GTCC TP.HCM (Gemini API)")
 current_session_name = "Chưa chọn phiên"
@@ -584,33 +522,50 @@ if st.session_state.current_session_id:
 st.subheader(f"Phiên: {current_session_name}")
 
 if st.session_state.current_session_id:
-    for msg in st.session_state.chat_history:
+    # Only the most recent window is rendered; older messages are revealed (or paged in) on demand.
+    visible_messages = st.session_state.chat_history[-st.session_state.chat_render_limit:]
+    if len(visible_messages) < len(st.session_state.chat_history) or st.session_state.chat_history_has_more:
+        st.button("Tải tin nhắn cũ hơn", key="load_older_messages_button", on_click=load_older_messages, use_container_width=True)
+    for msg_index, msg in enumerate(visible_messages):
         with st.chat_message(msg["role"]):
-            st.markdown(msg["content"])
-            if msg.get("gemini_grounding_metadata"):
-                meta = msg["gemini_grounding_metadata"]
-                with st.expander("Thông tin tìm kiếm Google (từ Gemini)", expanded=False):
-                    if meta.get("search_performed"): st.caption("Gemini đã sử dụng Google Search.")
-                    if meta.get("queries_used_by_gemini"): st.write("Truy vấn có thể đã dùng:", meta.get("queries_used_by_gemini"))
-                    if not meta.get("queries_used_by_gemini") and meta.get("search_performed"): st.write("Không có chi tiết truy vấn từ stream.")
-                    elif not meta.get("search_performed"): st.write("Không có tìm kiếm nào được thực hiện.")
+            if msg.get("seq") is not None and msg.get("seq") == st.session_state.search_focus_seq: st.caption("🔎 Kết quả tìm kiếm")
+            if msg.get("status") and msg.get("seq") == st.session_state.resume_message_seq and GEMINI_CLIENT and turn_store.is_resumable(msg):
+                st.session_state.resume_message_seq = None
+                resume_interrupted_turn(msg)
+            else:
+                st.markdown(msg["content"])
+            if turn_store.is_resumable(msg):
+                st.warning("Câu trả lời này bị gián đoạn giữa chừng.")
+                st.button("Tiếp tục trả lời", key=f"resume_{msg['seq']}", on_click=request_resume, args=(msg["seq"],))
+            elif msg.get("status") == turn_store.STATUS_STREAMING:
+                st.caption("⏳ Đang trả lời...")
+            if msg.get("gemini_grounding_metadata") or msg.get("gemini_grounding_metadata_json"):
+                # A toggle instead of st.expander: the body (and the JSON decode) only runs once it is opened.
+                if st.toggle("Thông tin tìm kiếm Google (từ Gemini)", key=f"grounding_{msg.get('seq', msg_index)}"):
+                    meta = get_grounding_metadata(msg) or {}
+                    with st.container(border=True):
+                        if msg.get("gemini_grounding_metadata_error"): st.write(msg["gemini_grounding_metadata_error"])
+                        elif meta.get("search_performed"): st.caption("Gemini đã sử dụng Google Search.")
+                        if meta.get("queries_used_by_gemini"): st.write("Truy vấn có thể đã dùng:", meta.get("queries_used_by_gemini"))
+                        if not meta.get("queries_used_by_gemini") and meta.get("search_performed"): st.write("Không có chi tiết truy vấn từ stream.")
+                        elif not meta.get("search_performed"): st.write("Không có tìm kiếm nào được thực hiện.")
 
 
 user_prompt = st.chat_input("Câu hỏi về giao thông công cộng TP.HCM:")
 if user_prompt and st.session_state.current_session_id:
     if not GEMINI_CLIENT: st.error("Client Gemini chưa sẵn sàng. Kiểm tra API Key.")
     else:
-        st.session_state.chat_history.append({"role": "user", "content": user_prompt})
-        save_message_db(st.session_state.current_session_id, "user", user_prompt)
         with st.chat_message("user"): st.markdown(user_prompt)
         with st.chat_message("assistant"):
-            full_response, grounding_meta_dict = generate_gemini_response_stream(
-                GEMINI_CLIENT, user_prompt, st.session_state.current_session_id,
-                st.session_state.chat_history[:-1] # Pass history *before* this user's current message
-            )
-            assistant_msg_obj = {"role": "assistant", "content": full_response}
-            if grounding_meta_dict: assistant_msg_obj["gemini_grounding_metadata"] = grounding_meta_dict
+            assistant_msg_obj = chat_core.run_turn(
+                GEMINI_CLIENT, st.session_state.get("gemini_api_key"), _current_user_email(), st.session_state.current_session_id,
+                user_prompt, list(st.session_state.chat_history), StreamlitChatEvents(), # History *before* this user's current message
+                older_history_unloaded=st.session_state.chat_history_has_more, timings={"session_lookup": session_lookup_seconds})
             st.session_state.chat_history.append(assistant_msg_obj)
-            save_message_db(st.session_state.current_session_id, "assistant", full_response, grounding_metadata_obj=grounding_meta_dict)
+            # A new answer brings the view back to the bottom: messages paged in while scrolling back are released.
+            st.session_state.chat_render_limit = min(st.session_state.chat_render_limit, CHAT_HISTORY_WINDOW)
 elif user_prompt and not st.session_state.current_session_id:
     st.warning("Vui lòng chọn hoặc tạo phiên trò chuyện mới.")
+
+trim_chat_history()
+record_script_run_time()
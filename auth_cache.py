@@ -0,0 +1,146 @@
+import datetime
+import functools
+import hashlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+# --- Google Sign-In Cache ---
+# A Google profile only changes when the user edits their account, so the userinfo response is
+# cached per access token (keyed by its hash, the token itself is not kept) for a few minutes.
+# Calls to Google (userinfo, token refresh) share one pooled requests.Session with timeouts, and a
+# background thread refreshes access tokens shortly before they expire, so a script run never
+# waits on a refresh. The endpoints are configurable, which lets the whole sign-in flow run
+# against a local stub server (benchmarks/stub_oauth_server.py).
+
+USERINFO_ENDPOINT = os.environ.get("GTCC_USERINFO_ENDPOINT", "https://www.googleapis.com/oauth2/v3/userinfo")
+USERINFO_CACHE_TTL_SECONDS = 600
+USERINFO_CACHE_MAX_ENTRIES = 1000
+HTTP_TIMEOUT_SECONDS = (3.05, 10)  # (connect, read)
+HTTP_POOL_SIZE = 10
+REFRESH_MARGIN_SECONDS = 300  # Tokens expiring within this window are refreshed in the background
+REFRESH_CHECK_INTERVAL_SECONDS = 30
+
+_HTTP_LOCK = threading.Lock()
+_HTTP = {"session": None}
+_USERINFO_LOCK = threading.Lock()
+_USERINFO_CACHE = OrderedDict()  # sha256(access token) -> (expires_at, profile)
+_REFRESH_LOCK = threading.Lock()  # One refresh at a time; a token is never refreshed twice concurrently
+_WATCH_LOCK = threading.Lock()
+_WATCHED = weakref.WeakValueDictionary()  # id(credentials) -> credentials; dropped with the browser session
+_REFRESHER = {"thread": None}
+_STATS = {"userinfo_requests": 0, "userinfo_cache_hits": 0, "refreshes": 0, "refresh_failures": 0}
+
+def get_http_session():
+    with _HTTP_LOCK:
+        if _HTTP["session"] is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter); session.mount("http://", adapter)
+            _HTTP["session"] = session
+        return _HTTP["session"]
+
+def auth_request():
+    """A google.auth transport Request on the pooled session, with our timeouts."""
+    from google.auth.transport.requests import Request
+    return functools.partial(Request(session=get_http_session()), timeout=HTTP_TIMEOUT_SECONDS)
+
+def _token_key(token):
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()
+
+def _utcnow():
+    # google.auth keeps credentials.expiry as a naive UTC datetime.
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+# --- Token refresh ---
+def refresh_credentials(credentials):
+    """Refresh in place; the cached profile follows the token to its new value."""
+    with _REFRESH_LOCK:
+        old_key = _token_key(credentials.token)
+        try:
+            credentials.refresh(auth_request())
+        except Exception:
+            _STATS["refresh_failures"] += 1
+            raise
+        _STATS["refreshes"] += 1
+    new_key = _token_key(credentials.token)
+    with _USERINFO_LOCK:
+        cached = _USERINFO_CACHE.pop(old_key, None)
+        if cached: _USERINFO_CACHE[new_key] = cached
+
+def ensure_valid(credentials):
+    # Normally the background refresher got there first; this covers a token that expired anyway.
+    if credentials is not None and not credentials.valid and credentials.refresh_token:
+        refresh_credentials(credentials)
+    return credentials
+
+def _expires_soon(credentials, now):
+    expiry = getattr(credentials, "expiry", None)
+    return expiry is not None and (expiry - now).total_seconds() <= REFRESH_MARGIN_SECONDS
+
+def refresh_due_credentials():
+    """Refresh every watched credential that expires within REFRESH_MARGIN_SECONDS; return how many were refreshed."""
+    now = _utcnow(); refreshed = 0
+    with _WATCH_LOCK:
+        due = [c for c in _WATCHED.values() if c.refresh_token and _expires_soon(c, now)]
+    for credentials in due:
+        try:
+            refresh_credentials(credentials); refreshed += 1
+        except Exception:
+            pass  # Retried on the next pass; ensure_valid() still covers the request path
+    return refreshed
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_CHECK_INTERVAL_SECONDS)
+        refresh_due_credentials()
+
+def keep_fresh(credentials):
+    """Register credentials for background refresh (idempotent; held weakly)."""
+    if credentials is None or not getattr(credentials, "refresh_token", None):
+        return
+    with _WATCH_LOCK:
+        _WATCHED[id(credentials)] = credentials
+        if _REFRESHER["thread"] is None or not _REFRESHER["thread"].is_alive():
+            _REFRESHER["thread"] = threading.Thread(target=_refresh_loop, name="oauth-token-refresher", daemon=True)
+            _REFRESHER["thread"].start()
+
+# --- Userinfo ---
+def get_userinfo(credentials, endpoint=None):
+    """Return the Google profile for these credentials (cached per access token), or None on an HTTP error."""
+    ensure_valid(credentials)
+    key = _token_key(credentials.token)
+    now = time.time()
+    with _USERINFO_LOCK:
+        cached = _USERINFO_CACHE.get(key)
+        if cached and cached[0] > now:
+            _USERINFO_CACHE.move_to_end(key)
+            _STATS["userinfo_cache_hits"] += 1
+            return dict(cached[1])
+    response = get_http_session().get(endpoint or USERINFO_ENDPOINT, headers={"Authorization": f"Bearer {credentials.token}"},
+                                      timeout=HTTP_TIMEOUT_SECONDS)
+    _STATS["userinfo_requests"] += 1
+    if not response.ok:
+        return None
+    profile = response.json()
+    with _USERINFO_LOCK:
+        _USERINFO_CACHE[key] = (now + USERINFO_CACHE_TTL_SECONDS, profile)
+        _USERINFO_CACHE.move_to_end(key)
+        while len(_USERINFO_CACHE) > USERINFO_CACHE_MAX_ENTRIES:
+            _USERINFO_CACHE.popitem(last=False)
+    return dict(profile)
+
+def forget(credentials):
+    """Drop the cached profile and stop refreshing (logout)."""
+    if credentials is None: return
+    with _USERINFO_LOCK:
+        _USERINFO_CACHE.pop(_token_key(getattr(credentials, "token", None)), None)
+    with _WATCH_LOCK:
+        _WATCHED.pop(id(credentials), None)
+
+def get_stats():
+    return dict(_STATS, watched_credentials=len(_WATCHED), cached_profiles=len(_USERINFO_CACHE))
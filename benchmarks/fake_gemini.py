@@ -0,0 +1,134 @@
+import itertools
+import random
+import threading
+import time
+import types
+
+from google.genai import types as google_genai_types
+
+# --- Fake Gemini Client ---
+# Local stand-in for google.genai.Client with the parts of the API the app uses (files, caches,
+# models.list / generate_content / generate_content_stream / count_tokens). Latencies and chunk
+# sizes are configurable so the app can be benchmarked offline; every streamed call records when
+# it started and when its first chunk was handed to the app. Tail latency can be injected: a
+# fraction of the streams (slow_rate) waits slow_first_token_latency_s before the first chunk.
+# model_first_token_latency_s sets a fixed latency per model instead (e.g. a lighter fallback
+# model served by a less loaded backend).
+
+DEFAULT_ANSWER = (
+    "Tuyến Metro số 1 (Bến Thành - Suối Tiên) dài khoảng 19,7 km với 14 nhà ga, gồm 3 ga ngầm và 11 ga trên cao. "
+    "Tàu hoạt động từ 5 giờ 30 đến 22 giờ mỗi ngày, tần suất khoảng 8 đến 12 phút một chuyến vào giờ cao điểm. "
+    "Giá vé lượt từ 7.000 đến 20.000 đồng tuỳ quãng đường; vé ngày 40.000 đồng, vé 3 ngày 90.000 đồng và vé tháng 300.000 đồng "
+    "(150.000 đồng cho học sinh, sinh viên). Người dùng có thể thanh toán bằng thẻ ngân hàng không tiếp xúc, ví điện tử hoặc mua vé tại ga. "
+    "Từ ga Bến Thành có thể chuyển sang nhiều tuyến xe buýt như số 03, 18, 19, 36, 65 và 152 để đi tiếp vào trung tâm hoặc tới sân bay Tân Sơn Nhất."
+)
+
+class FakeGeminiConfig:
+    def __init__(self, answer_text=DEFAULT_ANSWER, chunk_chars=40, first_token_latency_s=0.3, chunk_latency_s=0.03,
+                 upload_latency_s=0.2, summary_latency_s=0.5, slow_rate=0.0, slow_first_token_latency_s=5.0,
+                 model_first_token_latency_s=None, seed=0):
+        self.answer_text = answer_text
+        self.chunk_chars = chunk_chars
+        self.first_token_latency_s = first_token_latency_s
+        self.chunk_latency_s = chunk_latency_s
+        self.upload_latency_s = upload_latency_s
+        self.summary_latency_s = summary_latency_s
+        self.slow_rate = slow_rate
+        self.slow_first_token_latency_s = slow_first_token_latency_s
+        self.model_first_token_latency_s = model_first_token_latency_s or {}
+        self.random = random.Random(seed)
+
+CONFIG = FakeGeminiConfig()
+STREAM_CALLS = []  # {"model", "started_at", "first_chunk_at", "finished_at", "chars", "closed_early"} per generate_content_stream call
+UPLOAD_CALLS = []
+_LOCK = threading.Lock()
+_NAMES = itertools.count(1)
+
+def reset_records():
+    with _LOCK:
+        del STREAM_CALLS[:]; del UPLOAD_CALLS[:]
+
+def _text_response(text, usage=None):
+    return google_genai_types.GenerateContentResponse(
+        candidates=[google_genai_types.Candidate(content=google_genai_types.Content(role="model", parts=[google_genai_types.Part(text=text)]))],
+        usage_metadata=usage)
+
+class FakeFiles:
+    def upload(self, file, config=None):
+        time.sleep(CONFIG.upload_latency_s)
+        number = next(_NAMES)
+        with _LOCK: UPLOAD_CALLS.append({"file": str(file), "at": time.perf_counter()})
+        return types.SimpleNamespace(name=f"files/fake-{number}", uri=f"https://fake.invalid/files/fake-{number}",
+                                     mime_type="application/pdf", expiration_time=None, state="ACTIVE")
+
+    def get(self, name):
+        return types.SimpleNamespace(name=name, state="ACTIVE")
+
+    def delete(self, name):
+        return None
+
+class FakeCaches:
+    def create(self, model, config=None):
+        return types.SimpleNamespace(name=f"cachedContents/fake-{next(_NAMES)}", expire_time=None)
+
+    def update(self, name, config=None):
+        return types.SimpleNamespace(name=name, expire_time=None)
+
+    def delete(self, name):
+        return None
+
+class FakeModels:
+    def list(self):
+        return iter([types.SimpleNamespace(name="models/gemini-2.0-flash")])
+
+    def count_tokens(self, model=None, contents=None, config=None):
+        return types.SimpleNamespace(total_tokens=max(1, len(str(contents)) // 3))
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(CONFIG.summary_latency_s)
+        return _text_response("Tóm tắt: người dùng hỏi về tuyến Metro số 1 và giá vé xe buýt.")
+
+    def generate_content_stream(self, model, contents, config=None):
+        record = {"model": model, "started_at": time.perf_counter(), "first_chunk_at": None, "finished_at": None, "chars": 0,
+                  "closed_early": False}
+        with _LOCK:
+            STREAM_CALLS.append(record)
+            first_token_latency_s = CONFIG.model_first_token_latency_s.get(model)
+            if first_token_latency_s is None:
+                slow = CONFIG.random.random() < CONFIG.slow_rate
+                first_token_latency_s = CONFIG.slow_first_token_latency_s if slow else CONFIG.first_token_latency_s
+        text = CONFIG.answer_text
+        pieces = [text[i:i + CONFIG.chunk_chars] for i in range(0, len(text), CONFIG.chunk_chars)]
+        time.sleep(first_token_latency_s)
+        try:
+            for index, piece in enumerate(pieces):
+                if index:
+                    time.sleep(CONFIG.chunk_latency_s)
+                usage = None
+                if index == len(pieces) - 1:
+                    usage = google_genai_types.GenerateContentResponseUsageMetadata(
+                        prompt_token_count=1000, candidates_token_count=len(text) // 3, total_token_count=1000 + len(text) // 3)
+                if record["first_chunk_at"] is None:
+                    record["first_chunk_at"] = time.perf_counter()
+                record["chars"] += len(piece)
+                yield _text_response(piece, usage)
+        except GeneratorExit:
+            record["closed_early"] = True  # Cancelled by the caller (e.g. the losing stream of a hedged call)
+            raise
+        record["finished_at"] = time.perf_counter()
+
+class FakeClient:
+    def __init__(self, api_key=None, **kwargs):
+        self.api_key = api_key
+        self.files = FakeFiles()
+        self.caches = FakeCaches()
+        self.models = FakeModels()
+
+def install(config=None):
+    """Replace google.genai.Client with FakeClient for everything imported afterwards."""
+    global CONFIG
+    if config is not None:
+        CONFIG = config
+    from google import genai as google_genai_sdk
+    google_genai_sdk.Client = FakeClient
+    return FakeClient
@@ -0,0 +1,548 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# --- Offline Benchmark Suite ---
+# Runs the app against benchmarks/fake_gemini.py in a throwaway copy of the project (its own
+# chat_sessions.db), so results do not depend on the network or touch real data. Each phase runs
+# in a fresh subprocess because process-wide singletons (DB pool, caches) live per process:
+#   startup - cold start of a new server process (login page) and the reruns after it, plus which
+#             heavy SDKs that page had to import
+#   turns   - chat turns through Streamlit's AppTest: time-to-first-token and full-turn latency
+#   rerun   - script rerun latency as the number of sessions / messages of a user grows
+#   sqlite  - the app's DB helpers called directly (ops/sec, single thread and concurrent writers)
+#   auth    - Google sign-in calls against benchmarks/stub_oauth_server.py: userinfo with and
+#             without connection reuse / the profile cache, and background token refresh
+#   planner - journey_planner on the full transit network: network build time and query latency
+#             over every pair of named stops at several departure times
+#   intent  - intent_classifier: per-message classification latency and routing precision on the
+#             labeled evaluation set (data/intent_eval.tsv)
+#   hedging - time to first chunk of Gemini streams with a slow tail injected into the fake client,
+#             sent plainly and through gemini_hedging (hedges sent, wins, cancelled streams)
+# Results are written as JSON; --compare prints the change against an earlier results file.
+#
+#   python benchmarks/run_benchmarks.py [--quick] [--phases startup turns rerun sqlite auth planner intent hedging] [--compare old.json]
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCHMARKS_DIR.parent
+RESULTS_DIR = BENCHMARKS_DIR / "results"
+PHASES = ("startup", "turns", "rerun", "sqlite", "auth", "planner", "intent", "hedging", "maintenance")
+HEDGING_WORKERS = 8
+ARCHIVE_MESSAGES_PER_SESSION = 20
+PLANNER_DEPARTURES = ("06:00", "07:30", "12:00", "17:30", "21:30")
+AUTH_ITERATIONS = 20
+HEAVY_MODULES = ("google.genai", "google_auth_oauthlib", "google.api_core")
+APP_TIMEOUT_SECONDS = 120
+BENCH_API_KEY = "fake-benchmark-key"
+
+QUESTIONS = [
+    "Giờ hoạt động của tuyến Metro số 1 là khi nào?",
+    "Giá vé xe buýt số 19 bao nhiêu?",
+    "Làm sao đi từ Bến Thành đến Suối Tiên bằng metro?",
+    "Xe đạp công cộng TNGO thuê thế nào?",
+    "Tuyến buýt đường sông có những bến nào?",
+    "Có tuyến xe buýt nào từ sân bay Tân Sơn Nhất vào trung tâm không?",
+    "Vé tháng metro cho sinh viên giá bao nhiêu?",
+    "Xe buýt điện VinBus chạy những tuyến nào?",
+]
+
+# Overrides applied to every phase: no quota waits and no answer cache, so each turn reaches the model.
+BENCH_ENVIRONMENT = {
+    "GEMINI_RPM_LIMIT": "1000000",
+    "GEMINI_TPM_LIMIT": "1000000000",
+    "GEMINI_RPD_LIMIT": "1000000000",
+    "GTCC_ANSWER_CACHE": "0",
+}
+
+def summarize(values_seconds):
+    if not values_seconds:
+        return None
+    values_ms = sorted(v * 1000.0 for v in values_seconds)
+    def percentile(p):
+        return values_ms[min(len(values_ms) - 1, int(round(p / 100.0 * (len(values_ms) - 1))))]
+    return {"n": len(values_ms), "mean_ms": round(statistics.fmean(values_ms), 2), "p50_ms": round(percentile(50), 2),
+            "p95_ms": round(percentile(95), 2), "min_ms": round(values_ms[0], 2), "max_ms": round(values_ms[-1], 2)}
+
+# --- Workspace ---
+def prepare_workspace(workspace, context_mode):
+    workspace.mkdir(parents=True, exist_ok=True)
+    for source in REPO_ROOT.glob("*.py"):
+        shutil.copy2(source, workspace / source.name)
+    try: os.symlink(REPO_ROOT / "documents", workspace / "documents", target_is_directory=True)
+    except OSError: shutil.copytree(REPO_ROOT / "documents", workspace / "documents")
+    if context_mode == "retrieval":
+        if (REPO_ROOT / "index").is_dir():
+            shutil.copytree(REPO_ROOT / "index", workspace / "index")
+        else:
+            # Built up front so the background index build does not compete with the measurements.
+            subprocess.run([sys.executable, "retrieval.py", "build"], cwd=workspace, check=True)
+    if not (workspace / "index" / "transit_kb.db").exists():
+        subprocess.run([sys.executable, "transit_kb.py", "build"], cwd=workspace, check=True)
+    shutil.copytree(REPO_ROOT / "data", workspace / "data")
+    if not (workspace / "index" / "intent_classifier.json.gz").exists():
+        subprocess.run([sys.executable, "intent_classifier.py", "train"], cwd=workspace, check=True)
+
+def new_app_test(workspace, user_email):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(str(workspace / "app.py"), default_timeout=APP_TIMEOUT_SECONDS)
+    at.session_state.user_info = {"email": user_email, "name": "Benchmark"}
+    at.session_state.gemini_api_key = BENCH_API_KEY
+    return at
+
+def run_app(at):
+    started = time.perf_counter()
+    at.run()
+    elapsed = time.perf_counter() - started
+    if at.exception:
+        raise RuntimeError(f"App raised during benchmark: {[e.value for e in at.exception]}")
+    return elapsed
+
+def click_button(at, label_fragment):
+    for button in at.button:
+        if label_fragment in (button.label or ""):
+            button.click(); return run_app(at)
+    raise RuntimeError(f"Button not found: {label_fragment}")
+
+def seed_user(workspace, user_email, session_count, messages_in_latest):
+    # Seeded with plain SQL: the seeding itself is not what is being measured.
+    conn = sqlite3.connect(workspace / "chat_sessions.db")
+    now = int(time.time())
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO users (email, name, created_at) VALUES (?, ?, ?)", (user_email, "Benchmark", now))
+        session_ids = [str(uuid.uuid4()) for _ in range(session_count)]
+        conn.executemany("INSERT INTO sessions (id, name, user_email, created_at, last_updated_at, pdfs_uploaded) VALUES (?, ?, ?, ?, ?, 0)",
+                         [(sid, f"Phiên {i}", user_email, now - session_count + i, now - session_count + i) for i, sid in enumerate(session_ids)])
+        latest_session_id = session_ids[-1]
+        conn.executemany("INSERT INTO messages (id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                         [(str(uuid.uuid4()), latest_session_id, "user" if i % 2 == 0 else "assistant",
+                           QUESTIONS[i % len(QUESTIONS)] if i % 2 == 0 else "Câu trả lời mẫu. " * 40, now - messages_in_latest + i)
+                          for i in range(messages_in_latest)])
+    conn.close()
+
+# --- Phases (each runs in its own subprocess, with the workspace as cwd) ---
+def phase_startup(workspace, args):
+    # Runs without fake_gemini installed: importing it would import google.genai up front.
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(str(workspace / "app.py"), default_timeout=APP_TIMEOUT_SECONDS)
+    cold_seconds = run_app(at)  # Logged-out visitor, first run of the process
+    warm_seconds = [run_app(at) for _ in range(args.reruns)]
+    import metrics  # The app's own per-process report
+    return {"cold_start_ms": round(cold_seconds * 1000.0, 2), "warm": summarize(warm_seconds),
+            "app_reported": metrics.script_run_summary(),
+            "heavy_modules_imported": {name: name in sys.modules for name in HEAVY_MODULES}}
+
+def phase_turns(workspace, args):
+    import fake_gemini
+    at = new_app_test(workspace, "bench-turns@example.com")
+    startup_seconds = run_app(at)
+    click_button(at, "Trò chuyện mới")
+    turns = []
+    for index in range(args.turns):
+        fake_gemini.reset_records()
+        question = QUESTIONS[index % len(QUESTIONS)]
+        started = time.perf_counter()
+        at.chat_input[0].set_value(question)
+        run_app(at)
+        finished = time.perf_counter()
+        call = fake_gemini.STREAM_CALLS[-1] if fake_gemini.STREAM_CALLS else None
+        turns.append({
+            "turn": index + 1,
+            "full_turn_s": finished - started,
+            "ttft_s": (call["first_chunk_at"] - started) if call and call["first_chunk_at"] else None,
+            "before_request_s": (call["started_at"] - started) if call else None,
+            "uploads": len(fake_gemini.UPLOAD_CALLS),
+        })
+    warm = turns[1:] or turns
+    return {
+        "startup_first_run": summarize([startup_seconds]),
+        "first_turn": {(k[:-2] + "_ms" if k.endswith("_s") else k): (round(v * 1000.0, 2) if isinstance(v, float) else v)
+                       for k, v in turns[0].items()},
+        "ttft": summarize([t["ttft_s"] for t in warm if t["ttft_s"] is not None]),
+        "full_turn": summarize([t["full_turn_s"] for t in warm]),
+        "before_request": summarize([t["before_request_s"] for t in warm if t["before_request_s"] is not None]),
+    }
+
+def phase_rerun(workspace, args):
+    bootstrap = new_app_test(workspace, "bench-bootstrap@example.com")
+    run_app(bootstrap)  # Creates the schema
+    results = {"by_session_count": {}, "by_message_count": {}}
+    for axis, sizes in (("by_session_count", args.session_counts), ("by_message_count", args.message_counts)):
+        for size in sizes:
+            user_email = f"bench-{axis}-{size}@example.com"
+            if axis == "by_session_count": seed_user(workspace, user_email, size, 10)
+            else: seed_user(workspace, user_email, 1, size)
+            at = new_app_test(workspace, user_email)
+            cold_seconds = run_app(at)  # New browser session: loads the session list and the latest messages
+            warm_seconds = [run_app(at) for _ in range(args.reruns)]
+            results[axis][str(size)] = {"cold_ms": round(cold_seconds * 1000.0, 2), "warm": summarize(warm_seconds)}
+    return results
+
+def _ops_per_second(operation, iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        operation(i)
+    elapsed = time.perf_counter() - started
+    return {"iterations": iterations, "ops_per_sec": round(iterations / elapsed, 1), "mean_ms": round(elapsed * 1000.0 / iterations, 3)}
+
+def phase_sqlite(workspace, args):
+    import chat_core
+    import message_search
+    import turn_store
+    user_email = "bench-sqlite@example.com"
+    pool = chat_core.get_db_pool()
+    chat_core.upsert_user_if_changed({"email": user_email, "name": "Benchmark"})
+
+    iterations = args.sqlite_iterations
+    session_id, _ = chat_core.create_session(user_email)
+    answer = "Câu trả lời mẫu về giao thông công cộng. " * 30
+    results = {
+        "create_new_session_db": _ops_per_second(lambda i: chat_core.create_session(user_email), max(10, iterations // 10)),
+        "save_message_db": _ops_per_second(lambda i: chat_core.save_message(session_id, "user" if i % 2 == 0 else "assistant", answer, user_email=user_email), iterations),
+        "load_messages_db_first_page": _ops_per_second(lambda i: chat_core.load_messages(session_id), iterations),
+        "get_sessions_db_cached": _ops_per_second(lambda i: chat_core.get_sessions(user_email), iterations),
+        "get_sessions_db_invalidated": _ops_per_second(lambda i: (chat_core.invalidate_sessions_cache(user_email), chat_core.get_sessions(user_email)), iterations),
+        "rename_session_db": _ops_per_second(lambda i: chat_core.rename_session(session_id, f"Phiên {i}", user_email), iterations),
+        "search_messages": _ops_per_second(lambda i: message_search.search_messages(
+            pool, user_email, QUESTIONS[i % len(QUESTIONS)].split()[0] + " giao thong"), iterations),
+    }
+
+    # A whole turn as the chat handler stores it: begin() (user message + placeholder) and finish().
+    def persist_turn(i):
+        turn_writer = turn_store.TurnWriter(pool, session_id)
+        turn_writer.begin(QUESTIONS[i % len(QUESTIONS)])
+        turn_writer.finish(answer)
+    results["persist_turn"] = _ops_per_second(persist_turn, max(10, iterations // 2))
+
+    # Local answers to the transit function-calling tools (one per tool call in a turn).
+    transit_kb = chat_core.get_transit_kb()
+    if transit_kb is not None:
+        route_codes = ["01", "152", "1", "19", "156"]; places = ["Bến Thành", "suoi tien", "Sân bay Tân Sơn Nhất", "Chợ Lớn"]
+        results["transit_lookup_route"] = _ops_per_second(lambda i: transit_kb.call("lookup_route", {"route_code": route_codes[i % len(route_codes)]}), iterations)
+        results["transit_find_routes"] = _ops_per_second(lambda i: transit_kb.call("find_routes", {"place": places[i % len(places)]}), iterations)
+        results["transit_get_fares"] = _ops_per_second(lambda i: transit_kb.call("get_fares", {"mode": "bus", "route_code": route_codes[i % len(route_codes)]}), iterations)
+
+    # Concurrent writers, as with several users chatting at once in one server process.
+    def writer(count):
+        for i in range(count):
+            chat_core.save_message(session_id, "user", answer, user_email=user_email)
+    per_thread = max(1, iterations // args.writer_threads)
+    threads = [threading.Thread(target=writer, args=(per_thread,)) for _ in range(args.writer_threads)]
+    started = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.perf_counter() - started
+    results[f"save_message_db_{args.writer_threads}_threads"] = {
+        "iterations": per_thread * args.writer_threads, "ops_per_sec": round(per_thread * args.writer_threads / elapsed, 1)}
+    return results
+
+def phase_auth(workspace, args):
+    import datetime
+    import requests
+    import stub_oauth_server
+    from google.oauth2.credentials import Credentials
+    import auth_cache
+    server, state, base_url = stub_oauth_server.start(latency_s=args.auth_latency_ms / 1000.0)
+    userinfo_url = f"{base_url}/userinfo"
+    auth_cache.USERINFO_ENDPOINT = userinfo_url
+
+    def new_credentials(expires_in_seconds):
+        return Credentials(token=state.issue_token(), refresh_token="stub-refresh-token", token_uri=f"{base_url}/token",
+                           client_id="stub-client-id", client_secret="stub-client-secret",
+                           expiry=auth_cache._utcnow() + datetime.timedelta(seconds=expires_in_seconds))
+
+    def timed(operation):
+        started = time.perf_counter(); operation(); return time.perf_counter() - started
+
+    # Before: a new connection per call, no cache.
+    unpooled = [timed(lambda: requests.get(userinfo_url, headers={"Authorization": f"Bearer {state.issue_token()}"}, timeout=10))
+                for _ in range(AUTH_ITERATIONS)]
+    pooled_uncached = [timed(lambda: auth_cache.get_userinfo(new_credentials(3600))) for _ in range(AUTH_ITERATIONS)]
+    credentials = new_credentials(3600)
+    auth_cache.get_userinfo(credentials)
+    cached = [timed(lambda: auth_cache.get_userinfo(credentials)) for _ in range(AUTH_ITERATIONS)]
+
+    # A token about to expire is refreshed off the request path; its cached profile carries over.
+    expiring = new_credentials(auth_cache.REFRESH_MARGIN_SECONDS - 1)
+    auth_cache.get_userinfo(expiring)
+    auth_cache.keep_fresh(expiring)
+    token_before, userinfo_requests_before = expiring.token, state.counts["userinfo"]
+    refresh_seconds = timed(auth_cache.refresh_due_credentials)
+    after_refresh = timed(lambda: auth_cache.get_userinfo(expiring))
+    server.shutdown()
+    return {
+        "userinfo_unpooled_uncached": summarize(unpooled),
+        "userinfo_pooled_uncached": summarize(pooled_uncached),
+        "userinfo_cached": summarize(cached),
+        "background_refresh_ms": round(refresh_seconds * 1000.0, 2),
+        "userinfo_after_refresh_ms": round(after_refresh * 1000.0, 3),
+        "token_refreshed": expiring.token != token_before,
+        "userinfo_requests_after_refresh": state.counts["userinfo"] - userinfo_requests_before,
+        "stub_requests": dict(state.counts),
+    }
+
+def phase_planner(workspace, args):
+    import journey_planner
+    import transit_kb
+    kb = transit_kb.load_kb(workspace / "index")
+    started = time.perf_counter()
+    network = journey_planner.Network(kb.export_network())
+    build_seconds = time.perf_counter() - started
+    names = sorted({row["name"] for row in network.stops})
+    pairs = [(origin, destination) for origin in names for destination in names if origin != destination]
+    if args.quick: pairs = pairs[::7]
+    departures = [journey_planner.parse_clock(d) for d in PLANNER_DEPARTURES]
+    plan_seconds = []; with_itinerary = 0; itineraries = 0
+    for i, (origin, destination) in enumerate(pairs):
+        started = time.perf_counter()
+        result = journey_planner.plan(network, origin, destination, departures[i % len(departures)])
+        plan_seconds.append(time.perf_counter() - started)
+        with_itinerary += bool(result["itineraries"]); itineraries += len(result["itineraries"])
+    # What the app adds to a journey question: parsing it, planning and formatting the prompt context.
+    question_seconds = []
+    for i, (origin, destination) in enumerate(pairs[:200]):
+        question = f"Làm sao đi từ {origin} đến {destination} lúc {PLANNER_DEPARTURES[i % len(PLANNER_DEPARTURES)]}?"
+        started = time.perf_counter()
+        journey_query = journey_planner.parse_journey_question(question)
+        journey_planner.plan_for_prompt(kb, *journey_query)
+        question_seconds.append(time.perf_counter() - started)
+    return {
+        "network": {"stops": len(network.stops), "route_patterns": len(network.patterns),
+                    "transfer_edges": sum(len(edges) for edges in network.transfers), "build_ms": round(build_seconds * 1000.0, 2)},
+        "pairs": len(pairs), "pairs_with_itinerary": with_itinerary, "itineraries": itineraries,
+        "plan": summarize(plan_seconds), "question_to_context": summarize(question_seconds),
+    }
+
+def phase_intent(workspace, args):
+    import intent_classifier
+    started = time.perf_counter()
+    model = intent_classifier.load_model(workspace / "index")
+    load_seconds = time.perf_counter() - started
+    examples = intent_classifier.load_labeled(workspace / intent_classifier.EVAL_DATA_PATH)
+    classify_seconds = []
+    for _ in range(3 if args.quick else 20):
+        for _, text in examples:
+            started = time.perf_counter()
+            model.classify(text)
+            classify_seconds.append(time.perf_counter() - started)
+    report = intent_classifier.evaluate(model, examples)
+    return {"load_ms": round(load_seconds * 1000.0, 2), "classify": summarize(classify_seconds),
+            "over_budget": sum(s * 1000.0 > intent_classifier.LATENCY_BUDGET_MS for s in classify_seconds),
+            "accuracy": report["accuracy"], "routing": report["routing"], "labels": report["labels"]}
+
+def phase_hedging(workspace, args):
+    import chat_core
+    import fake_gemini
+    import gemini_hedging
+    import gemini_scheduler
+    from google.genai import types as google_genai_types
+    pool = chat_core.get_db_pool()
+    client = fake_gemini.FakeClient(api_key=BENCH_API_KEY)
+    fake_gemini.CONFIG.slow_rate = args.slow_rate
+    fake_gemini.CONFIG.slow_first_token_latency_s = args.slow_latency_ms / 1000.0
+    if chat_core.HEDGE_FALLBACK_MODEL: # A separate, less loaded backend; a same-model hedge can be slow too
+        fake_gemini.CONFIG.model_first_token_latency_s = {chat_core.HEDGE_FALLBACK_MODEL: args.first_token_latency_ms / 1000.0}
+    contents = [google_genai_types.Content(role="user", parts=[google_genai_types.Part.from_text(text=QUESTIONS[0])])]
+
+    def first_chunk_seconds(stream_call):
+        started = time.perf_counter(); first_chunk_at = None
+        for chunk_text, _ in stream_call():
+            if chunk_text and first_chunk_at is None: first_chunk_at = time.perf_counter()
+        return first_chunk_at - started
+
+    def run_pass(stream_call):
+        fake_gemini.CONFIG.random.seed(0) # Both passes draw the same slow requests
+        with concurrent.futures.ThreadPoolExecutor(max_workers=HEDGING_WORKERS) as executor:
+            return list(executor.map(lambda _: first_chunk_seconds(stream_call), range(args.hedge_requests)))
+
+    plain = run_pass(lambda: gemini_scheduler.stream_generate_content(
+        client, pool, BENCH_API_KEY, chat_core.GEMINI_MODEL_ID, contents, None))
+    # The plain pass stands in for the traffic a running server has already seen: it seeds the p95 deadline.
+    for seconds in plain: gemini_hedging.record_first_chunk(chat_core.GEMINI_MODEL_ID, seconds)
+    fake_gemini.reset_records()
+    hedged = run_pass(lambda: gemini_hedging.hedged_stream_generate_content(
+        client, pool, BENCH_API_KEY, chat_core.GEMINI_MODEL_ID, contents, None, fallback_model=chat_core.HEDGE_FALLBACK_MODEL))
+    # Losing streams are closed when their first chunk finally arrives; wait for them before counting.
+    wait_until = time.perf_counter() + args.slow_latency_ms / 1000.0 + 2.0
+    while time.perf_counter() < wait_until and any(c["finished_at"] is None and not c["closed_early"] for c in fake_gemini.STREAM_CALLS):
+        time.sleep(0.05)
+    stats = gemini_hedging.hedging_stats()
+    return {"requests": args.hedge_requests, "slow_rate": args.slow_rate, "plain_first_chunk": summarize(plain),
+            "hedged_first_chunk": summarize(hedged), "hedge_delay_ms": round(gemini_hedging.hedge_delay(chat_core.GEMINI_MODEL_ID) * 1000.0, 1),
+            "stream_calls": len(fake_gemini.STREAM_CALLS), "closed_early": sum(c["closed_early"] for c in fake_gemini.STREAM_CALLS),
+            "stats": {key: value for key, value in stats.items() if key != "models"}}
+
+def phase_maintenance(workspace, args):
+    import chat_core
+    import maintenance
+    user_email = "bench-maintenance@example.com"
+    pool = chat_core.get_db_pool()
+    chat_core.upsert_user_if_changed({"email": user_email, "name": "Benchmark"})
+    # Old sessions (idle for a year) and as many recent ones, all with the same number of messages.
+    now = int(time.time()); old_before = now - 365 * 86400
+    answer = "Câu trả lời mẫu về giao thông công cộng. " * 30
+    session_ids = [str(uuid.uuid4()) for _ in range(2 * args.archive_sessions)]
+    with pool.transaction() as conn:
+        conn.executemany("INSERT INTO sessions (id, name, user_email, created_at, last_updated_at, pdfs_uploaded) VALUES (?, ?, ?, ?, ?, 0)",
+                         [(sid, f"Phiên {i}", user_email, old_before if i % 2 else now, old_before if i % 2 else now) for i, sid in enumerate(session_ids)])
+        conn.executemany("INSERT INTO messages (id, session_id, role, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                         [(str(uuid.uuid4()), sid, "user" if j % 2 == 0 else "assistant", QUESTIONS[j % len(QUESTIONS)] if j % 2 == 0 else answer,
+                           (old_before if i % 2 else now) + j) for i, sid in enumerate(session_ids) for j in range(ARCHIVE_MESSAGES_PER_SESSION)])
+    recent_session_id, old_session_ids = session_ids[0], session_ids[1::2]
+    before = maintenance.database_report(pool, detailed=True)
+    load_before = _ops_per_second(lambda i: chat_core.load_messages(recent_session_id), args.sqlite_iterations)
+
+    started = time.perf_counter()
+    archived_sessions, archived_messages = maintenance.archive_idle_sessions(pool, archive_after_days=30, limit=len(old_session_ids))
+    archive_seconds = time.perf_counter() - started
+    run = maintenance.run_maintenance(pool, archive_after_days=30)
+    after = maintenance.database_report(pool, detailed=True)
+    load_after = _ops_per_second(lambda i: chat_core.load_messages(recent_session_id), args.sqlite_iterations)
+
+    restore_seconds = []
+    for sid in old_session_ids[:min(50, len(old_session_ids))]:
+        started = time.perf_counter()
+        messages, _ = chat_core.load_messages(sid)
+        restore_seconds.append(time.perf_counter() - started)
+        if len(messages) != ARCHIVE_MESSAGES_PER_SESSION: raise RuntimeError(f"Restored {len(messages)} messages")
+    return {"sessions": len(session_ids), "archived_sessions": archived_sessions, "archived_messages": archived_messages,
+            "archive_ms_per_session": round(archive_seconds * 1000.0 / max(1, archived_sessions), 3), "maintenance_pass": run,
+            "archive_compression_ratio": round(after["archive"]["raw_bytes"] / max(1, after["archive"]["compressed_bytes"]), 1),
+            "file_bytes_before": before["file_bytes"], "file_bytes_after": after["file_bytes"],
+            "messages_before": before["messages"], "messages_after": after["messages"],
+            "load_messages_recent_before": load_before, "load_messages_recent_after": load_after,
+            "restore_on_open": summarize(restore_seconds)}
+
+PHASE_FUNCTIONS = {"startup": phase_startup, "turns": phase_turns, "rerun": phase_rerun, "sqlite": phase_sqlite, "auth": phase_auth,
+                   "planner": phase_planner, "intent": phase_intent, "hedging": phase_hedging,
+                   "maintenance": phase_maintenance}
+
+# --- Orchestration ---
+def run_phase_subprocess(phase, workspace, args):
+    output_path = workspace / f"phase-{phase}.json"
+    command = [sys.executable, str(Path(__file__).resolve()), "--phase", phase, "--workspace", str(workspace),
+               "--phase-output", str(output_path)] + args.passthrough
+    environment = dict(os.environ, **BENCH_ENVIRONMENT, GTCC_CONTEXT_MODE=args.context_mode)
+    completed = subprocess.run(command, cwd=workspace, env=environment, capture_output=True, text=True)
+    if completed.returncode != 0 or not output_path.exists():
+        sys.stderr.write(completed.stdout[-4000:] + completed.stderr[-4000:])
+        raise SystemExit(f"Benchmark phase '{phase}' failed")
+    return json.loads(output_path.read_text(encoding="utf-8"))
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def _flatten(value, prefix=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(item, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+def print_comparison(baseline, current):
+    baseline_values = dict(_flatten(baseline.get("results", {})))
+    print(f"\n{'metric':<72} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key, value in _flatten(current.get("results", {})):
+        if not (key.endswith("_ms") or key.endswith("ops_per_sec")) or key not in baseline_values:
+            continue
+        old = baseline_values[key]
+        change = f"{(value - old) / old * 100.0:+.1f}%" if old else "n/a"
+        print(f"{key:<72} {old:>12} {value:>12} {change:>9}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the GTCC chatbot (fake Gemini client).")
+    parser.add_argument("--phases", nargs="+", choices=PHASES, default=list(PHASES))
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes, for a fast sanity run.")
+    parser.add_argument("--context-mode", choices=("retrieval", "full"), default="retrieval")
+    parser.add_argument("--turns", type=int, default=None)
+    parser.add_argument("--reruns", type=int, default=None)
+    parser.add_argument("--session-counts", type=int, nargs="+", default=None)
+    parser.add_argument("--message-counts", type=int, nargs="+", default=None)
+    parser.add_argument("--sqlite-iterations", type=int, default=None)
+    parser.add_argument("--writer-threads", type=int, default=4)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--first-token-latency-ms", type=float, default=300.0)
+    parser.add_argument("--chunk-latency-ms", type=float, default=30.0)
+    parser.add_argument("--upload-latency-ms", type=float, default=200.0)
+    parser.add_argument("--auth-latency-ms", type=float, default=50.0, help="Latency of the stub OAuth/userinfo server.")
+    parser.add_argument("--hedge-requests", type=int, default=None)
+    parser.add_argument("--slow-rate", type=float, default=0.04, help="Fraction of fake streams with a slow first chunk (hedging phase).")
+    parser.add_argument("--slow-latency-ms", type=float, default=5000.0)
+    parser.add_argument("--archive-sessions", type=int, default=None, help="Idle sessions seeded for the maintenance phase.")
+    parser.add_argument("--output", type=Path, default=None, help="Results file (default: benchmarks/results/<timestamp>.json).")
+    parser.add_argument("--compare", type=Path, default=None, help="Earlier results file to compare against.")
+    parser.add_argument("--phase", choices=PHASES, help=argparse.SUPPRESS)
+    parser.add_argument("--workspace", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--phase-output", type=Path, help=argparse.SUPPRESS)
+    return parser
+
+def apply_defaults(args):
+    defaults = {"turns": (3, 8), "reruns": (3, 5), "session_counts": ([10, 100], [10, 100, 1000]),
+                "message_counts": ([10, 100], [10, 100, 1000]), "sqlite_iterations": (200, 1000),
+                "hedge_requests": (48, 200), "archive_sessions": (200, 2000)}
+    for name, (quick_value, full_value) in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, quick_value if args.quick else full_value)
+    args.passthrough = [
+        "--turns", str(args.turns), "--reruns", str(args.reruns), "--sqlite-iterations", str(args.sqlite_iterations),
+        "--writer-threads", str(args.writer_threads), "--chunk-chars", str(args.chunk_chars),
+        "--first-token-latency-ms", str(args.first_token_latency_ms), "--chunk-latency-ms", str(args.chunk_latency_ms),
+        "--upload-latency-ms", str(args.upload_latency_ms), "--auth-latency-ms", str(args.auth_latency_ms), "--context-mode", args.context_mode,
+        "--hedge-requests", str(args.hedge_requests), "--slow-rate", str(args.slow_rate), "--slow-latency-ms", str(args.slow_latency_ms),
+        "--archive-sessions", str(args.archive_sessions),
+        "--session-counts", *map(str, args.session_counts), "--message-counts", *map(str, args.message_counts)]
+    return args
+
+def main():
+    args = apply_defaults(build_parser().parse_args())
+
+    if args.phase:
+        sys.path.insert(0, str(BENCHMARKS_DIR)); sys.path.insert(0, str(args.workspace))
+        if args.phase != "startup":
+            import fake_gemini
+            fake_gemini.install(fake_gemini.FakeGeminiConfig(
+                chunk_chars=args.chunk_chars, first_token_latency_s=args.first_token_latency_ms / 1000.0,
+                chunk_latency_s=args.chunk_latency_ms / 1000.0, upload_latency_s=args.upload_latency_ms / 1000.0))
+        result = PHASE_FUNCTIONS[args.phase](args.workspace, args)
+        args.phase_output.write_text(json.dumps(result, ensure_ascii=False), encoding="utf-8")
+        return
+
+    report = {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "git_commit": _git_commit(),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("passthrough", "output", "compare", "phase", "workspace", "phase_output")},
+        },
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory(prefix="gtcc-bench-") as temp_dir:
+        workspace = Path(temp_dir)
+        prepare_workspace(workspace, args.context_mode)
+        for phase in args.phases:
+            print(f"Running phase: {phase}...", flush=True)
+            report["results"][phase] = run_phase_subprocess(phase, workspace, args)
+
+    output_path = args.output or RESULTS_DIR / f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(json.dumps(report, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+    print(json.dumps(report["results"], ensure_ascii=False, indent=2))
+    print(f"\nSaved results to {output_path}")
+    if args.compare:
+        print_comparison(json.loads(args.compare.read_text(encoding="utf-8")), report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import itertools
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+# --- Stub Google OAuth / userinfo server ---
+# Local stand-in for Google's authorization, token and userinfo endpoints, with a configurable
+# latency and per-endpoint request counters. Used by the "auth" benchmark phase, and to click
+# through the sign-in flow of the app without a Google account:
+#
+#   python benchmarks/stub_oauth_server.py --port 8765 --write-config google_oauth_config.json
+#   GTCC_USERINFO_ENDPOINT=http://127.0.0.1:8765/userinfo GTCC_OAUTH_REDIRECT_URI=http://localhost:8501/ streamlit run app.py
+
+SCOPES = "openid https://www.googleapis.com/auth/userinfo.profile https://www.googleapis.com/auth/userinfo.email"
+TOKEN_EXPIRES_IN_SECONDS = 3600
+PROFILE = {"sub": "100000000000000000001", "email": "stub.user@example.com", "email_verified": True,
+           "name": "Stub User", "picture": "https://example.com/stub-user.png"}
+
+class StubState:
+    def __init__(self, latency_s=0.0, expires_in=TOKEN_EXPIRES_IN_SECONDS, profile=None):
+        self.latency_s = latency_s
+        self.expires_in = expires_in
+        self.profile = dict(profile or PROFILE)
+        self.counts = {"auth": 0, "token": 0, "userinfo": 0}
+        self.issued_tokens = set()
+        self._numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def issue_token(self):
+        with self._lock:
+            token = f"stub-access-{next(self._numbers)}"
+            self.issued_tokens.add(token)
+            return token
+
+    def count(self, endpoint):
+        with self._lock:
+            self.counts[endpoint] += 1
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, so pooled clients can reuse connections
+
+        def setup(self):
+            super().setup()
+            # Headers and body go out in separate writes; without this, Nagle's algorithm plus delayed
+            # ACKs add ~40 ms to every response on a reused connection.
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers(); self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            time.sleep(state.latency_s)
+            if url.path == "/auth":
+                state.count("auth")
+                query = parse_qs(url.query)
+                redirect_uri = query.get("redirect_uri", [""])[0]
+                params = {"code": "stub-code", "state": query.get("state", [""])[0], "scope": SCOPES}
+                self.send_response(302)
+                self.send_header("Location", f"{redirect_uri}?{urlencode(params)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif url.path == "/userinfo":
+                state.count("userinfo")
+                token = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+                if token not in state.issued_tokens:
+                    self._send_json(401, {"error": "invalid_token"}); return
+                self._send_json(200, state.profile)
+            else:
+                self._send_json(404, {"error": "not_found"})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode("utf-8"))
+            time.sleep(state.latency_s)
+            if url.path != "/token":
+                self._send_json(404, {"error": "not_found"}); return
+            state.count("token")
+            grant_type = form.get("grant_type", [""])[0]
+            if grant_type not in ("authorization_code", "refresh_token"):
+                self._send_json(400, {"error": "unsupported_grant_type"}); return
+            self._send_json(200, {"access_token": state.issue_token(), "expires_in": state.expires_in, "token_type": "Bearer",
+                                  "refresh_token": "stub-refresh-token", "scope": SCOPES})
+    return StubHandler
+
+def start(host="127.0.0.1", port=0, **state_options):
+    """Serve in a daemon thread; returns (server, state, base_url)."""
+    state = StubState(**state_options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-oauth-server", daemon=True).start()
+    return server, state, f"http://{host}:{server.server_address[1]}"
+
+def client_config(base_url, redirect_uri="http://localhost:8501/"):
+    """google_oauth_config.json content pointing the app at the stub."""
+    return {"web": {"client_id": "stub-client-id", "client_secret": "stub-client-secret", "auth_uri": f"{base_url}/auth",
+                    "token_uri": f"{base_url}/token", "redirect_uris": [redirect_uri]}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub Google OAuth/userinfo server for local testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--expires-in", type=int, default=TOKEN_EXPIRES_IN_SECONDS)
+    parser.add_argument("--write-config", default=None, help="Write a google_oauth_config.json for the app to this path.")
+    args = parser.parse_args()
+    server, state, base_url = start(args.host, args.port, latency_s=args.latency_ms / 1000.0, expires_in=args.expires_in)
+    if args.write_config:
+        with open(args.write_config, "w", encoding="utf-8") as config_file:
+            json.dump(client_config(base_url), config_file, indent=2)
+    print(f"Stub OAuth server on {base_url} (auth: /auth, token: /token, userinfo: /userinfo)")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,751 @@
+import contextlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import answer_cache
+import chat_state
+import context_cache
+import db
+import file_registry
+import gemini_hedging
+import gemini_scheduler
+import history_manager
+import intent_classifier
+import journey_planner
+import maintenance
+import message_search
+import metrics
+import retrieval
+import stream_rendering
+import transit_kb
+import turn_store
+
+# --- Chat Core ---
+# The chat pipeline without any UI: configuration, the database helpers and one answer turn
+# (history, retrieval, tools, the streamed Gemini call and its persistence). Progress is reported
+# through a ChatEvents object instead of st.* calls, so the same code serves the Streamlit app
+# (app.py renders the events) and the HTTP API (api_server.py streams them as server-sent events).
+# State kept here is per process: Streamlit reruns reuse this module, so nothing is reset between them.
+
+# --- Configuration ---
+DOC_DIR = Path("documents")
+PDF_FILENAMES = ["tuyen_duong_sat_do_thi_hcm.pdf", "xe_dap_cong_cong_xe_dien_4_banh_va_xe_buyt_duong_song.pdf", "xe_buyt.pdf"]
+DATABASE_PATH = Path("chat_sessions.db")
+
+GEMINI_MODEL_ID = "gemini-2.0-flash" # Sticking to user's specified model ID
+GEMINI_CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE", "1") != "0"
+GTCC_CONTEXT_MODE = os.environ.get("GTCC_CONTEXT_MODE", "retrieval") # "retrieval" (top-k passages) or "full" (whole PDFs)
+RETRIEVAL_TOP_K = int(os.environ.get("GTCC_RETRIEVAL_TOP_K", "6"))
+TRANSIT_TOOLS_ENABLED = os.environ.get("GTCC_TRANSIT_TOOLS", "1") != "0" # Route/station/fare lookups answered from transit_kb
+TRANSIT_TOOL_MAX_ROUNDS = 3 # Follow-up requests carrying local tool results, per answer
+JOURNEY_PLANNER_ENABLED = os.environ.get("GTCC_JOURNEY_PLANNER", "1") != "0" # Itineraries for "từ A đến B" questions
+HISTORY_TOKEN_BUDGET = int(os.environ.get("GTCC_HISTORY_TOKEN_BUDGET", str(history_manager.HISTORY_TOKEN_BUDGET)))
+HISTORY_VERBATIM_TURNS = int(os.environ.get("GTCC_HISTORY_VERBATIM_TURNS", str(history_manager.HISTORY_VERBATIM_TURNS)))
+SESSIONS_PAGE_SIZE = 30
+SESSION_LIST_CACHE_TTL_SECONDS = 60 # Safety net for writes made by other worker processes
+MESSAGES_PAGE_SIZE = 40 # Messages loaded per page when opening a session or scrolling back
+DEFAULT_SESSION_NAME = "Trò chuyện mới"
+ANSWER_CACHE_ENABLED = os.environ.get("GTCC_ANSWER_CACHE", "1") != "0"
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("GTCC_ANSWER_CACHE_TTL_SECONDS", str(answer_cache.ANSWER_CACHE_TTL_SECONDS)))
+UPLOADED_FILES_CACHE_MAX_ENTRIES = int(os.environ.get("GTCC_UPLOADED_FILES_CACHE_SIZE", "256")) # Sessions whose file list is kept in memory
+UPLOADED_FILES_CACHE_TTL_SECONDS = 2 * 3600 # Evicted sessions look their files up in file_registry again
+INTENT_ROUTER_ENABLED = os.environ.get("GTCC_INTENT_ROUTER", "1") != "0" # Templated replies for greetings, off-topic and abuse
+INTENT_THRESHOLD = float(os.environ.get("GTCC_INTENT_THRESHOLD", str(intent_classifier.CONFIDENCE_THRESHOLD)))
+gemini_scheduler.configure( # Per-API-key quota (free tier of gemini-2.0-flash by default)
+    rpm=int(os.environ.get("GEMINI_RPM_LIMIT", str(gemini_scheduler.GEMINI_RPM_LIMIT))),
+    tpm=int(os.environ.get("GEMINI_TPM_LIMIT", str(gemini_scheduler.GEMINI_TPM_LIMIT))),
+    rpd=int(os.environ.get("GEMINI_RPD_LIMIT", str(gemini_scheduler.GEMINI_RPD_LIMIT))),
+    max_queued=int(os.environ.get("GEMINI_MAX_QUEUED_REQUESTS", str(gemini_scheduler.MAX_QUEUED_REQUESTS))))
+HEDGE_REQUESTS_ENABLED = os.environ.get("GTCC_HEDGE_REQUESTS", "0") == "1" # Second request when the first chunk is late
+# None: hedge on the same model. A lighter model must support every tool in the config (Flash-Lite has no Google Search grounding).
+HEDGE_FALLBACK_MODEL = os.environ.get("GTCC_HEDGE_FALLBACK_MODEL", "") or None
+gemini_hedging.configure(
+    percentile=float(os.environ.get("GTCC_HEDGE_PERCENTILE", str(gemini_hedging.HEDGE_PERCENTILE))),
+    budget_ratio=float(os.environ.get("GTCC_HEDGE_BUDGET_RATIO", str(gemini_hedging.HEDGE_BUDGET_RATIO))))
+MAINTENANCE_ENABLED = os.environ.get("GTCC_MAINTENANCE", "1") != "0" # Background archive, cleanup, VACUUM and ANALYZE
+ARCHIVE_AFTER_DAYS = int(os.environ.get("GTCC_ARCHIVE_AFTER_DAYS", str(maintenance.ARCHIVE_AFTER_DAYS))) # 0: never archive
+METRICS_ENABLED = os.environ.get("GTCC_METRICS", "1") != "0"
+METRICS_EXPOSITION_FILE = os.environ.get("GTCC_METRICS_FILE", "metrics/gtcc.prom") or None # Prometheus textfile, "" to disable
+
+SYSTEM_INSTRUCTION = """bạn là một trợ lý về giao thông công cộng khu vực nội thành thành phố hồ chí minh. Nhiệm vụ của bạn là trả lời các thông tin về giao thông công cộng một cách chi tiết, nếu thông tin liên quan cho câu hỏi không có thì hãy thực hiện google search, đừng tự tạo ra thông tin. Nếu câu hỏi lạc đề, hãy nhấn mạnh lại vai trò của bạn và dẫn dắt người dùng hỏi những câu hỏi liên quan"""
+
+# session_id -> Gemini file objects attached to that session's turns
+UPLOADED_FILES_CACHE = chat_state.BoundedCache(UPLOADED_FILES_CACHE_MAX_ENTRIES, UPLOADED_FILES_CACHE_TTL_SECONDS)
+
+# --- Events ---
+class ChatEvents:
+    """Receives a turn's progress. Every method is a no-op here; front ends override what they show."""
+
+    def notice(self, level, message):
+        # A message kept on screen; level is "info", "success", "warning" or "error".
+        pass
+
+    def progress(self, level, message):
+        # A transient status (upload, queue position, retry) replacing the previous one.
+        pass
+
+    def progress_done(self):
+        pass
+
+    def turn_started(self, user_message, assistant_seq):
+        # The question is stored; the answer will be written to message assistant_seq.
+        pass
+
+    def answer_started(self, prefix):
+        # A (new) attempt at the answer starts; prefix is the resumed text, usually "".
+        pass
+
+    def answer_text(self, delta):
+        pass
+
+    def answer_finished(self, text):
+        pass
+
+    def tool_suggested(self, name, args):
+        pass
+
+    def transit_lookups(self, calls):
+        # calls: [(tool name, args dict)] answered locally from the transit knowledge base.
+        pass
+
+# --- Database ---
+_POOL_LOCK = threading.Lock()
+_POOL = {"pool": None}
+
+def _migration_001_initial_schema(cursor):
+    # Add user table with api_key column
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            picture TEXT,
+            created_at INTEGER NOT NULL,
+            gemini_api_key TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_updated_at INTEGER NOT NULL,
+            pdfs_uploaded INTEGER DEFAULT 0,
+            user_email TEXT,
+            FOREIGN KEY (user_email) REFERENCES users(email)
+        ) ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY, session_id TEXT NOT NULL, role TEXT NOT NULL,
+            content TEXT NOT NULL, timestamp INTEGER NOT NULL,
+            gemini_grounding_metadata_json TEXT,
+            FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE ) ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_messages_session_id_timestamp ON messages (session_id, timestamp);''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_sessions_user_name ON sessions (user_email, name);''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_sessions_user_updated ON sessions (user_email, last_updated_at DESC, id DESC);''')
+    file_registry.init_file_registry_table(cursor)
+    context_cache.init_context_cache_table(cursor)
+    history_manager.init_history_columns(cursor)
+    answer_cache.init_answer_cache_tables(cursor)
+    gemini_scheduler.init_usage_table(cursor)
+    metrics.init_metrics_table(cursor)
+
+# Each entry runs once per database file (db.migrate records the version in PRAGMA user_version);
+# append new (version, function) pairs instead of editing applied ones.
+def _migration_002_message_search(cursor):
+    message_search.init_search_index(cursor)
+
+def _migration_003_turn_status(cursor):
+    turn_store.init_turn_columns(cursor)
+    message_search.skip_streaming_updates(cursor)
+
+def _migration_004_maintenance(cursor):
+    maintenance.init_maintenance_tables(cursor)
+    # Foreign keys are enforced from now on: give sessions of users never stored (API users) a users row.
+    cursor.execute("""
+        INSERT OR IGNORE INTO users (email, name, created_at)
+        SELECT user_email, user_email, MIN(created_at) FROM sessions
+        WHERE user_email IS NOT NULL AND user_email NOT IN (SELECT email FROM users)
+        GROUP BY user_email""")
+
+def _migration_005_archive_search(cursor):
+    message_search.init_archive_search(cursor)
+    maintenance.index_archived_sessions(cursor)
+
+def _migration_006_metric_totals(cursor):
+    metrics.init_metric_totals_table(cursor)
+
+def _migration_007_turn_owner(cursor):
+    turn_store.init_owner_columns(cursor)
+
+SCHEMA_MIGRATIONS = [
+    (1, _migration_001_initial_schema),
+    (2, _migration_002_message_search),
+    (3, _migration_003_turn_status),
+    (4, _migration_004_maintenance),
+    (5, _migration_005_archive_search),
+    (6, _migration_006_metric_totals),
+    (7, _migration_007_turn_owner),
+]
+
+def get_db_pool():
+    # One pooled set of WAL connections per process, shared by every session, rerun and request.
+    # The schema is migrated when the pool is first opened; later calls skip even the user_version check.
+    with _POOL_LOCK:
+        if _POOL["pool"] is None:
+            pool = db.ConnectionPool(DATABASE_PATH)
+            db.migrate(pool, SCHEMA_MIGRATIONS)
+            message_search.ensure_backfill_async(pool) # Indexes messages stored before migration 2, in the background
+            if MAINTENANCE_ENABLED: maintenance.ensure_maintenance_async(pool, ARCHIVE_AFTER_DAYS)
+            _POOL["pool"] = pool
+        return _POOL["pool"]
+
+# --- Session List Cache ---
+# Per-user cache of the session list, filled page by page with keyset queries and invalidated
+# explicitly by every helper that creates, renames, deletes or touches a session.
+_SESSION_LIST_CACHE = {"lock": threading.Lock(), "entries": {}} # user_email -> {"sessions", "has_more", "loaded_at"}
+
+def invalidate_sessions_cache(user_email=None):
+    # Without an email (a write that only knows the session id) every user's list is dropped.
+    with _SESSION_LIST_CACHE["lock"]:
+        if user_email is None: _SESSION_LIST_CACHE["entries"].clear()
+        else: _SESSION_LIST_CACHE["entries"].pop(user_email, None)
+
+def _allocate_session_name(cursor, user_email, session_name_prefix):
+    # One range scan on idx_sessions_user_name covers the prefix and every "prefix (n)" variant.
+    cursor.execute("SELECT name FROM sessions WHERE user_email = ? AND name >= ? AND name < ?",
+                   (user_email, session_name_prefix, f"{session_name_prefix} )"))
+    used_numbers = set()
+    for (name,) in cursor.fetchall():
+        if name == session_name_prefix: used_numbers.add(0)
+        elif name.startswith(f"{session_name_prefix} (") and name.endswith(")"):
+            suffix = name[len(session_name_prefix) + 2:-1]
+            if suffix.isdigit(): used_numbers.add(int(suffix))
+    count = 0
+    while count in used_numbers: count += 1
+    return session_name_prefix if count == 0 else f"{session_name_prefix} ({count})"
+
+def create_session(user_email, session_name_prefix=DEFAULT_SESSION_NAME):
+    session_id = str(uuid.uuid4())
+    with get_db_pool().transaction() as conn:
+        cursor = conn.cursor()
+        session_name = _allocate_session_name(cursor, user_email, session_name_prefix)
+        current_time = int(time.time())
+        if user_email: # sessions.user_email references users; API users may never have logged in to the app
+            cursor.execute("INSERT OR IGNORE INTO users (email, name, created_at) VALUES (?, ?, ?)", (user_email, user_email, current_time))
+        cursor.execute("""
+            INSERT INTO sessions (id, name, created_at, last_updated_at, pdfs_uploaded, user_email)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (session_id, session_name, current_time, current_time, 0, user_email))
+    invalidate_sessions_cache(user_email)
+    return session_id, session_name
+
+def get_session_owner(session_id):
+    row = get_db_pool().fetchone("SELECT user_email FROM sessions WHERE id = ?", (session_id,))
+    return row[0] if row else None
+
+def _fetch_sessions_page(user_email, after_session, page_size):
+    if after_session is None:
+        rows = get_db_pool().fetchall("""
+            SELECT id, name, last_updated_at, pdfs_uploaded
+            FROM sessions
+            WHERE user_email = ?
+            ORDER BY last_updated_at DESC, id DESC LIMIT ?""",
+            (user_email, page_size))
+    else:
+        rows = get_db_pool().fetchall("""
+            SELECT id, name, last_updated_at, pdfs_uploaded
+            FROM sessions
+            WHERE user_email = ? AND (last_updated_at, id) < (?, ?)
+            ORDER BY last_updated_at DESC, id DESC LIMIT ?""",
+            (user_email, after_session["last_updated_at"], after_session["id"], page_size))
+    return [{"id": r[0], "name": r[1], "last_updated_at": r[2], "pdfs_uploaded": r[3]} for r in rows]
+
+def get_sessions(user_email, limit=SESSIONS_PAGE_SIZE):
+    """Return (most recent `limit` sessions, whether more exist), served from the per-user cache."""
+    with _SESSION_LIST_CACHE["lock"]:
+        entry = _SESSION_LIST_CACHE["entries"].get(user_email)
+        if entry is None or time.time() - entry["loaded_at"] > SESSION_LIST_CACHE_TTL_SECONDS:
+            entry = {"sessions": [], "has_more": True, "loaded_at": time.time()}
+        while entry["has_more"] and len(entry["sessions"]) < limit:
+            page_size = limit - len(entry["sessions"])
+            after_session = entry["sessions"][-1] if entry["sessions"] else None
+            page = _fetch_sessions_page(user_email, after_session, page_size + 1)
+            entry["has_more"] = len(page) > page_size
+            entry["sessions"] = entry["sessions"] + page[:page_size]
+        _SESSION_LIST_CACHE["entries"][user_email] = entry
+        return entry["sessions"][:limit], entry["has_more"] or len(entry["sessions"]) > limit
+
+def load_messages(session_id, limit=MESSAGES_PAGE_SIZE, before_message=None):
+    """Return (up to `limit` messages older than before_message in chronological order, whether more exist)."""
+    # Keyset pagination newest-first on idx_messages_session_id_timestamp (rowid breaks timestamp ties).
+    if before_message is None:
+        rows = get_db_pool().fetchall("""
+            SELECT role, content, gemini_grounding_metadata_json, rowid, timestamp, status, heartbeat_at FROM messages
+            WHERE session_id = ? ORDER BY timestamp DESC, rowid DESC LIMIT ?""", (session_id, limit + 1))
+    else:
+        rows = get_db_pool().fetchall("""
+            SELECT role, content, gemini_grounding_metadata_json, rowid, timestamp, status, heartbeat_at FROM messages
+            WHERE session_id = ? AND (timestamp, rowid) < (?, ?)
+            ORDER BY timestamp DESC, rowid DESC LIMIT ?""", (session_id, before_message["timestamp"], before_message["seq"], limit + 1))
+    if not rows and before_message is None and maintenance.restore_session(get_db_pool(), session_id):
+        return load_messages(session_id, limit) # The session had been archived
+    messages = []
+    for row in reversed(rows[:limit]):
+        msg = chat_state.Message(row[0], row[1], seq=row[3], timestamp=row[4])
+        if row[2]: msg["gemini_grounding_metadata_json"] = row[2] # Decoded on demand by the front end
+        if row[5] != turn_store.STATUS_COMPLETE: msg["status"] = row[5]; msg["heartbeat_at"] = row[6]
+        messages.append(msg)
+    return messages, len(rows) > limit
+
+def serialize_grounding_metadata(grounding_metadata_obj):
+    if not grounding_metadata_obj: return None
+    try: return json.dumps(grounding_metadata_obj)
+    except TypeError: return None # The answer is stored without it
+
+def save_message(session_id, role, content, grounding_metadata_obj=None, user_email=None):
+    """Insert a message and return (rowid, timestamp), the keyset position used for paging."""
+    message_id = str(uuid.uuid4()); current_time = int(time.time())
+    grounding_metadata_json_str = serialize_grounding_metadata(grounding_metadata_obj)
+    with get_db_pool().transaction() as conn:
+        cursor = conn.execute("INSERT INTO messages (id, session_id, role, content, timestamp, gemini_grounding_metadata_json) VALUES (?, ?, ?, ?, ?, ?)",
+                              (message_id, session_id, role, content, current_time, grounding_metadata_json_str))
+        message_seq = cursor.lastrowid
+        conn.execute("UPDATE sessions SET last_updated_at = ? WHERE id = ?", (current_time, session_id))
+    invalidate_sessions_cache(user_email)
+    return message_seq, current_time
+
+def set_pdfs_uploaded(session_id):
+    get_db_pool().execute("UPDATE sessions SET pdfs_uploaded = 1, last_updated_at = ? WHERE id = ?", (int(time.time()), session_id))
+    invalidate_sessions_cache()
+
+def rename_session(session_id, new_name, user_email=None):
+    get_db_pool().execute("UPDATE sessions SET name = ?, last_updated_at = ? WHERE id = ?", (new_name, int(time.time()), session_id))
+    invalidate_sessions_cache(user_email)
+
+def delete_session(session_id, user_email=None):
+    get_db_pool().execute("DELETE FROM sessions WHERE id = ?", (session_id,)) # Cascades to its messages and archive
+    UPLOADED_FILES_CACHE.pop(session_id, None)
+    invalidate_sessions_cache(user_email)
+
+def upsert_user_if_changed(user_info):
+    # Store the user's profile, writing only when it is new or changed (most logins are returning
+    # users with the same name and picture). Returns the stored Gemini API key, if any.
+    pool = get_db_pool()
+    user_row = pool.fetchone("SELECT name, picture, gemini_api_key FROM users WHERE email = ?", (user_info['email'],))
+    if user_row and (user_row[0], user_row[1] or '') == (user_info['name'], user_info.get('picture', '')):
+        return user_row[2]
+    with pool.transaction() as conn:
+        cursor = conn.cursor()  # Only update user info, preserve API key
+        cursor.execute("""
+            INSERT INTO users (email, name, picture, created_at, gemini_api_key)
+            VALUES (?, ?, ?, ?, NULL)
+            ON CONFLICT(email) DO UPDATE SET
+                name = excluded.name,
+                picture = excluded.picture,
+                created_at = excluded.created_at
+                -- Intentionally not updating gemini_api_key to preserve it
+        """, (user_info['email'], user_info['name'],
+             user_info.get('picture', ''), int(time.time())))
+    return user_row[2] if user_row else None
+
+def load_api_key(user_email):
+    result = get_db_pool().fetchone("SELECT gemini_api_key FROM users WHERE email = ?", (user_email,))
+    return result[0] if result and result[0] else None
+
+def save_api_key(user_email, api_key_value):
+    get_db_pool().execute("UPDATE users SET gemini_api_key = ? WHERE email = ?", (api_key_value, user_email))
+
+def memory_report():
+    """Memory held by this process: resident size, the tracked chat state of browser sessions and the in-memory caches."""
+    with _SESSION_LIST_CACHE["lock"]:
+        session_list_entries = len(_SESSION_LIST_CACHE["entries"])
+    return {"process": metrics.process_memory(), "chat_state": chat_state.chat_state_summary(),
+            "uploaded_files_cache": UPLOADED_FILES_CACHE.stats(), "session_list_cache_entries": session_list_entries}
+
+# --- Gemini ---
+def create_gemini_client(api_key_value):
+    from google import genai as google_genai_sdk
+    client = google_genai_sdk.Client(api_key=api_key_value)
+    client.models.list() # Fails here on an invalid key
+    return client
+
+def upload_files(client, api_key_value, pdf_filenames_list, current_session_id, events=None):
+    events = events or ChatEvents()
+    cached_files = UPLOADED_FILES_CACHE.get(current_session_id)
+    if cached_files and all(f.expires_at - file_registry.EXPIRY_SAFETY_MARGIN_SECONDS > time.time() for f in cached_files):
+        return cached_files
+
+    if not api_key_value:
+        events.notice("error", "Chưa có Gemini API Key để upload tài liệu.")
+        return []
+
+    # Uploads started by prewarm_documents() are reused; only files still in flight are waited for.
+    file_paths = []
+    for filename in pdf_filenames_list:
+        file_path_obj = DOC_DIR / filename
+        if file_path_obj.exists(): file_paths.append(file_path_obj)
+        else: events.notice("error", f"Không tìm thấy file: {file_path_obj}")
+    def show_upload_progress(ready_count, total_count):
+        events.progress("info", f"Đang chuẩn bị tài liệu PDF ({ready_count}/{total_count})...")
+
+    uploaded_file_objects = []
+    for file_path_obj, registered_file, uploaded_now, error in file_registry.wait_for_files(
+            client, get_db_pool(), api_key_value, file_paths, on_progress=show_upload_progress):
+        if error is None:
+            uploaded_file_objects.append(registered_file)
+            if uploaded_now: events.notice("success", f"Đã upload: {file_path_obj.name} (ID: {registered_file.name})")
+        else:
+            events.notice("error", f"Lỗi upload file {file_path_obj.name}: {error}")
+            events.notice("error", f"Chi tiết lỗi: {type(error).__name__} - {error}")
+    events.progress_done()
+
+    if uploaded_file_objects:
+        UPLOADED_FILES_CACHE[current_session_id] = uploaded_file_objects
+        set_pdfs_uploaded(current_session_id)
+    else:
+        events.notice("warning", "Không có file PDF nào được upload thành công.")
+    return uploaded_file_objects
+
+def prewarm_documents(client, api_key_value):
+    """Start uploading the PDFs in the background if turns will attach them; returns without waiting."""
+    if not client or not api_key_value: return False
+    if GTCC_CONTEXT_MODE == "retrieval" and get_retrieval_index() is not None: return False # Only passages are sent
+    file_paths = [DOC_DIR / filename for filename in PDF_FILENAMES if (DOC_DIR / filename).exists()]
+    file_registry.prewarm_files(client, get_db_pool(), api_key_value, file_paths)
+    return True
+
+def documents_upload_status(api_key_value):
+    return file_registry.prewarm_status(api_key_value, [DOC_DIR / filename for filename in PDF_FILENAMES])
+
+def get_retrieval_index():
+    corpus_signature = retrieval.compute_corpus_signature(DOC_DIR, PDF_FILENAMES)
+    retrieval_index = retrieval.load_index(expected_signature=corpus_signature)
+    if retrieval_index is None:
+        retrieval.ensure_index_built_async(DOC_DIR, PDF_FILENAMES)
+    return retrieval_index
+
+def get_transit_kb():
+    kb_signature = transit_kb.compute_kb_signature(DOC_DIR, PDF_FILENAMES)
+    kb = transit_kb.load_kb(expected_signature=kb_signature)
+    if kb is None:
+        transit_kb.ensure_kb_built_async(DOC_DIR, PDF_FILENAMES)
+    return kb
+
+def get_intent_classifier():
+    intent_model = intent_classifier.load_model(expected_signature=intent_classifier.compute_training_signature())
+    if intent_model is None:
+        intent_classifier.ensure_model_built_async()
+    return intent_model
+
+def generate_response(client, api_key_value, user_prompt_text, current_session_id, existing_chat_history, events=None,
+                      older_history_unloaded=False, resume_from="", turn_writer=None):
+    """Stream one answer through `events`; returns (answer text, grounding metadata dict or None)."""
+    # resume_from: partial answer of an interrupted turn, continued instead of regenerated.
+    # turn_writer: turn_store.TurnWriter receiving checkpoints of the partial answer while it streams.
+    from google.genai import types as google_genai_types
+    events = events or ChatEvents()
+    pool = get_db_pool()
+    model_to_use = GEMINI_MODEL_ID
+
+    system_parts_for_config = [google_genai_types.Part.from_text(text=SYSTEM_INSTRUCTION)]
+
+    # "Từ A đến B" questions: ranked itineraries from the local planner, sent as grounded context.
+    # Only a question the planner has an itinerary for counts as a journey; "từ mấy giờ đến mấy
+    # giờ" or two places it does not know stay ordinary questions (router, answer cache). While the
+    # knowledge base is still being built the places cannot be checked, and the question is kept
+    # out of the answer cache so a plain answer does not shadow the planned ones later.
+    journey_context = None; is_journey = False
+    journey_query = journey_planner.parse_journey_question(user_prompt_text) if JOURNEY_PLANNER_ENABLED else None
+    if journey_query:
+        with metrics.span("journey_planner"):
+            journey_kb = get_transit_kb()
+            if journey_kb is not None: journey_context = journey_planner.plan_for_prompt(journey_kb, *journey_query)
+            is_journey = journey_kb is None or journey_context is not None
+        metrics.set_attributes(journey_planned=journey_context is not None)
+
+    # Greetings, thanks, off-topic and abusive messages are answered from a template, without a Gemini request.
+    if INTENT_ROUTER_ENABLED and not resume_from and not is_journey:
+        with metrics.span("intent"):
+            intent_decision = intent_classifier.route(get_intent_classifier(), user_prompt_text,
+                                                      has_history=bool(existing_chat_history), threshold=INTENT_THRESHOLD)
+        if intent_decision:
+            metrics.set_attributes(outcome=f"intent_{intent_decision.label}", intent_confidence=round(intent_decision.confidence, 3),
+                                   prompt_chars=len(user_prompt_text), response_chars=len(intent_decision.response))
+            events.answer_started("")
+            events.answer_text(intent_decision.response)
+            events.answer_finished(intent_decision.response)
+            return intent_decision.response, None
+
+    # Stand-alone questions (first turn of a session) may be served from the shared answer cache.
+    # Journey answers depend on the departure time and are not shared.
+    answer_cache_key = None
+    if ANSWER_CACHE_ENABLED and not existing_chat_history and not resume_from and not is_journey:
+        try:
+            with metrics.span("answer_cache"):
+                answer_cache_key = answer_cache.compute_corpus_key(model_to_use, SYSTEM_INSTRUCTION, DOC_DIR, PDF_FILENAMES)
+                cached_answer = answer_cache.lookup(pool, answer_cache_key, user_prompt_text)
+        except sqlite3.Error:
+            answer_cache_key = None; cached_answer = None
+        if cached_answer:
+            metrics.set_attributes(outcome="answer_cache_hit", prompt_chars=len(user_prompt_text), response_chars=len(cached_answer))
+            events.answer_started("")
+            for piece in answer_cache.replay_chunks(cached_answer):
+                events.answer_text(piece)
+            events.answer_finished(cached_answer)
+            return cached_answer, None
+
+    # Older turns are folded into a per-session running summary; only a bounded tail is sent verbatim.
+    with metrics.span("history"):
+        history_summary, history_tail = history_manager.build_history(
+            client, model_to_use, pool, current_session_id, existing_chat_history,
+            token_budget=HISTORY_TOKEN_BUDGET, verbatim_turns=HISTORY_VERBATIM_TURNS, older_history_unloaded=older_history_unloaded,
+            api_key_value=api_key_value)
+    gemini_contents = []
+    if history_summary:
+        gemini_contents.append(google_genai_types.Content(role="user", parts=[google_genai_types.Part.from_text(text=f"Tóm tắt phần trước của cuộc trò chuyện:\n{history_summary}")]))
+        gemini_contents.append(google_genai_types.Content(role="model", parts=[google_genai_types.Part.from_text(text="Đã ghi nhận phần tóm tắt.")]))
+    for msg in history_tail:
+        role = "user" if msg["role"] == "user" else "model"
+        msg_content_str = str(msg.get("content", ""))
+        if not msg_content_str: continue # Interrupted before any text
+        gemini_contents.append(google_genai_types.Content(role=role, parts=[google_genai_types.Part.from_text(text=msg_content_str)]))
+
+    tools_for_gemini = [google_genai_types.Tool(google_search=google_genai_types.GoogleSearch())]
+    # Route, station and fare questions can be answered by local lookups in the transit knowledge base.
+    transit_kb_for_turn = None; transit_tool = None
+    if TRANSIT_TOOLS_ENABLED and model_to_use not in transit_kb.REJECTED_BY_MODELS:
+        transit_kb_for_turn = get_transit_kb()
+        if transit_kb_for_turn is not None:
+            transit_tool = transit_kb.gemini_tool(); tools_for_gemini.append(transit_tool)
+
+    # Retrieval mode sends only the top-k passages; without a ready index the full PDFs are used.
+    retrieved_passages = []; retrieval_index = None
+    if GTCC_CONTEXT_MODE == "retrieval":
+        with metrics.span("retrieval"):
+            retrieval_index = get_retrieval_index()
+            if retrieval_index:
+                previous_user_prompts = [m["content"] for m in existing_chat_history if m["role"] == "user"][-1:]
+                retrieved_passages = retrieval_index.search(
+                    " ".join(previous_user_prompts + [user_prompt_text]), RETRIEVAL_TOP_K,
+                    embed_client=client if retrieval_index.vectors is not None else None,
+                    limiter=gemini_scheduler.get_limiter(get_db_pool(), api_key_value))
+        metrics.set_attributes(passages=len(retrieved_passages))
+
+    pdf_file_objects_for_this_turn = []
+    if retrieval_index is None:
+        # Uploads are shared across sessions through the file registry, so the PDFs are available on every turn.
+        with metrics.span("upload"):
+            pdf_file_objects_for_this_turn = upload_files(client, api_key_value, PDF_FILENAMES, current_session_id, events)
+        if not pdf_file_objects_for_this_turn: events.notice("warning", "Không PDF nào được chuẩn bị để đính kèm.")
+
+    # Prefer the cached system instruction + PDF prefix; fall back to attaching the files directly.
+    cached_content_name = None
+    if GEMINI_CONTEXT_CACHE_ENABLED and pdf_file_objects_for_this_turn:
+        with metrics.span("context_cache"):
+            cached_content_name = context_cache.get_or_create_context_cache(
+                client, pool, api_key_value, model_to_use,
+                SYSTEM_INSTRUCTION, pdf_file_objects_for_this_turn, tools_for_gemini)
+
+    def build_request(use_context_cache):
+        current_user_parts = [google_genai_types.Part.from_text(text=user_prompt_text)]
+        if retrieved_passages:
+            current_user_parts.append(google_genai_types.Part.from_text(text=retrieval.format_passages_for_prompt(retrieved_passages)))
+        if journey_context:
+            current_user_parts.append(google_genai_types.Part.from_text(text=journey_context))
+        if use_context_cache:
+            config = google_genai_types.GenerateContentConfig(
+                cached_content=cached_content_name,
+                response_mime_type="text/plain"
+            )
+        else:
+            for file_obj in pdf_file_objects_for_this_turn:
+                file_part = google_genai_types.Part(
+                    file_data=google_genai_types.FileData(
+                        mime_type=file_obj.mime_type, file_uri=file_obj.uri
+                    ))
+                current_user_parts.append(file_part)
+            config = google_genai_types.GenerateContentConfig(
+                tools=tools_for_gemini,
+                response_mime_type="text/plain",
+                system_instruction=system_parts_for_config
+            )
+        return gemini_contents + [google_genai_types.Content(role="user", parts=current_user_parts)], config
+
+    # Rate limited per API key, queued, and retried with backoff (resuming a stream cut mid-answer).
+    def show_queue_position(position, wait_seconds):
+        events.progress("info", f"Đang chờ lượt gọi Gemini: vị trí {position} trong hàng đợi (khoảng {max(1, round(wait_seconds))} giây)...")
+    def show_retry(attempt, delay_seconds, error):
+        events.progress("warning", f"Gemini tạm thời quá tải ({getattr(error, 'code', None) or type(error).__name__}), thử lại lần {attempt} sau {delay_seconds:.0f} giây...")
+    def show_hedge(event, hedge_model):
+        if event == "launched":
+            metrics.set_attributes(hedged=True)
+            events.progress("info", f"Gemini phản hồi chậm, đang gửi thêm một yêu cầu tới {hedge_model}...")
+        else:
+            metrics.set_attributes(answered_model=hedge_model)
+            events.progress_done()
+
+    attempts = [True, False] if cached_content_name else [False]
+    for use_context_cache in attempts:
+        contents_for_request, generation_config_for_stream = build_request(use_context_cache)
+        full_response_text = ""; captured_grounding_metadata_dict = None; raw_tool_calls_from_stream = []; grounding_search_queries = []
+        first_token_at = None; answer_text = None
+        metrics.set_attributes(context_cache=use_context_cache, prompt_chars=sum(
+            len(part.text or "") for content in contents_for_request for part in (content.parts or []) if getattr(part, "text", None)))
+        try:
+            events.notice("info", f"Gọi Gemini API ({model_to_use}) với stream{' (context cache)' if use_context_cache else ''}...")
+            # Text is forwarded chunk by chunk; tool calls and search queries are collected separately.
+            events.answer_started(resume_from)
+            answer_text = resume_from
+            # Calls to the transit tools are answered locally and sent back in a follow-up request,
+            # streamed into the same answer, until Gemini answers without calling them.
+            for tool_round in range(TRANSIT_TOOL_MAX_ROUNDS + 1):
+                round_text_start = len(answer_text) if tool_round else 0; transit_call_parts = []
+                stream_options = {"on_wait": show_queue_position, "on_retry": show_retry, "resume_from": resume_from if tool_round == 0 else ""}
+                if HEDGE_REQUESTS_ENABLED:
+                    # A context cache belongs to one model, so hedges that use it stay on that model.
+                    response_stream = gemini_hedging.hedged_stream_generate_content(
+                        client, pool, api_key_value, model_to_use, contents_for_request, generation_config_for_stream,
+                        fallback_model=None if use_context_cache else HEDGE_FALLBACK_MODEL, on_hedge=show_hedge, **stream_options)
+                else:
+                    response_stream = gemini_scheduler.stream_generate_content(
+                        client, pool, api_key_value, model_to_use, contents_for_request, generation_config_for_stream, **stream_options)
+                for chunk_text, chunk in response_stream: # chunk is a GenerateContentResponse (None for resumed text)
+                    if chunk_text:
+                        if first_token_at is None:
+                            metrics.mark("ttft"); first_token_at = time.perf_counter()
+                        answer_text += chunk_text
+                        events.answer_text(chunk_text)
+                        if turn_writer is not None: turn_writer.checkpoint(answer_text)
+                    if chunk is None: continue
+                    if getattr(chunk, 'usage_metadata', None): metrics.set_usage(chunk.usage_metadata)
+                    chunk_parts = stream_rendering.collect_chunk_parts(chunk)
+                    grounding_search_queries.extend(chunk_parts.search_queries)
+                    for tool_call, call_part in zip(chunk_parts.function_calls, chunk_parts.function_call_parts):
+                        if transit_kb_for_turn is not None and tool_call['name'] in transit_kb.TOOL_NAMES:
+                            transit_call_parts.append(call_part); continue
+                        raw_tool_calls_from_stream.append(tool_call)
+                        events.tool_suggested(tool_call['name'], tool_call['args'])
+                if not transit_call_parts or tool_round == TRANSIT_TOOL_MAX_ROUNDS: break
+                with metrics.span("transit_tools"):
+                    response_parts = [google_genai_types.Part.from_function_response(
+                        name=part.function_call.name, response=transit_kb_for_turn.call(part.function_call.name, part.function_call.args))
+                        for part in transit_call_parts]
+                events.transit_lookups([(part.function_call.name, dict(part.function_call.args or {})) for part in transit_call_parts])
+                round_text = answer_text[round_text_start:]
+                contents_for_request = contents_for_request + [
+                    google_genai_types.Content(role="model", parts=([google_genai_types.Part.from_text(text=round_text)] if round_text else []) + transit_call_parts),
+                    google_genai_types.Content(role="user", parts=response_parts)]
+                if answer_text and not answer_text.endswith("\n"):
+                    answer_text += "\n\n"; events.answer_text("\n\n")
+            full_response_text = answer_text
+            events.answer_finished(full_response_text)
+            events.progress_done()
+            if first_token_at is not None: metrics.record("stream", time.perf_counter() - first_token_at)
+            metrics.set_attributes(response_chars=len(full_response_text))
+
+            if any(tc['name'].lower() in ['googlesearch', 'google_search'] for tc in raw_tool_calls_from_stream):
+                events.notice("info", "Google Search được Gemini sử dụng (chi tiết metadata đầy đủ cần non-streaming call).")
+                search_queries = []
+                for tc in raw_tool_calls_from_stream:
+                    if tc['name'].lower() in ['googlesearch', 'google_search'] and tc.get('args'):
+                        query_arg = tc['args'].get('query', tc['args'].get('q', 'Không rõ query'))
+                        search_queries.append(str(query_arg))
+                captured_grounding_metadata_dict = {"search_performed": True, "queries_used_by_gemini": search_queries if search_queries else ["Không rõ query cụ thể."]}
+            elif grounding_search_queries:
+                # The built-in google_search tool reports its queries as grounding metadata, not as function calls.
+                captured_grounding_metadata_dict = {"search_performed": True, "queries_used_by_gemini": list(dict.fromkeys(grounding_search_queries))}
+
+            if answer_cache_key and not captured_grounding_metadata_dict and full_response_text.strip():
+                try: answer_cache.store(pool, answer_cache_key, user_prompt_text, full_response_text, ttl_seconds=ANSWER_CACHE_TTL_SECONDS)
+                except sqlite3.Error: pass
+            return full_response_text, captured_grounding_metadata_dict
+        except Exception as e:
+            if answer_text is not None: full_response_text = answer_text
+            metrics.set_attributes(outcome="error", error=type(e).__name__)
+            if turn_writer is not None and full_response_text:
+                turn_writer.interrupt(full_response_text) # Kept as a resumable answer instead of the error text
+            if isinstance(e, gemini_scheduler.SchedulerError):
+                events.notice("error", str(e))
+                return f"[{e}]", None
+            if transit_tool is not None and first_token_at is None and getattr(e, 'code', None) == 400:
+                # Some models refuse function declarations next to google_search: answer with Google Search only.
+                if re.search(r"function|tool", str(e), re.IGNORECASE): transit_kb.REJECTED_BY_MODELS.add(model_to_use)
+                tools_for_gemini.remove(transit_tool); transit_tool = None; transit_kb_for_turn = None
+                metrics.set_attributes(outcome="ok", transit_tools_rejected=True)
+                if use_context_cache: context_cache.invalidate_context_cache(pool, cached_content_name)
+                else: attempts.append(False)
+                continue
+            if use_context_cache and first_token_at is None:
+                # Cache expired or rejected by the model: drop it and retry with the PDFs attached.
+                context_cache.invalidate_context_cache(pool, cached_content_name)
+                metrics.set_attributes(outcome="ok", context_cache_fallback=True)
+                continue
+            from google.api_core.exceptions import GoogleAPIError
+            from google.genai import errors as google_genai_errors
+            if isinstance(e, (GoogleAPIError, google_genai_errors.APIError)):
+                events.notice("error", f"Lỗi API từ Gemini: {getattr(e, 'message', str(e))} (Code: {getattr(e, 'code', 'N/A')})")
+                if hasattr(e, 'summary'): events.notice("error", f"Tóm tắt lỗi: {getattr(e, 'summary', '')}")
+                return f"[Lỗi Gemini API: {getattr(e, 'message', str(e))}]", None
+            events.notice("error", f"Lỗi không xác định khi gọi Gemini API: {e}")
+            return f"[Lỗi Gemini: {e}]", None
+
+# --- Turns ---
+def _turn_trace(session_id, user_email):
+    if not METRICS_ENABLED: return contextlib.nullcontext()
+    return metrics.turn(get_db_pool(), session_id, user_email, GEMINI_MODEL_ID, exposition_path=METRICS_EXPOSITION_FILE)
+
+def _assistant_message(turn_writer, grounding_meta_dict):
+    assistant_message = chat_state.Message("assistant", turn_writer.final_text, seq=turn_writer.assistant_seq, timestamp=turn_writer.assistant_timestamp)
+    if turn_writer.status != turn_store.STATUS_COMPLETE: assistant_message["status"] = turn_writer.status
+    elif grounding_meta_dict: assistant_message["gemini_grounding_metadata"] = grounding_meta_dict
+    return assistant_message
+
+def run_turn(client, api_key_value, user_email, session_id, user_prompt_text, existing_chat_history, events=None,
+             older_history_unloaded=False, timings=None):
+    """Store a question, stream its answer through `events` and store the answer; returns the assistant message."""
+    # The user message and an empty assistant message are stored together up front; the answer
+    # is checkpointed while it streams and finalized with one UPDATE (see turn_store).
+    # timings: {stage: seconds} measured by the caller before the turn, recorded with it.
+    events = events or ChatEvents()
+    turn_writer = turn_store.TurnWriter(get_db_pool(), session_id)
+    with _turn_trace(session_id, user_email):
+        try:
+            for stage, seconds in (timings or {}).items(): metrics.record(stage, seconds)
+            with metrics.span("save_user_message"):
+                user_msg_seq, user_msg_timestamp = turn_writer.begin(user_prompt_text)
+                invalidate_sessions_cache(user_email)
+            events.turn_started(chat_state.Message("user", user_prompt_text, seq=user_msg_seq, timestamp=user_msg_timestamp),
+                                turn_writer.assistant_seq)
+            full_response, grounding_meta_dict = generate_response(
+                client, api_key_value, user_prompt_text, session_id, existing_chat_history, events,
+                older_history_unloaded=older_history_unloaded, turn_writer=turn_writer)
+            with metrics.span("save_assistant_message"):
+                turn_writer.finish(full_response, serialize_grounding_metadata(grounding_meta_dict))
+        finally:
+            turn_writer.close() # A turn cut short keeps its partial answer as an interrupted message
+    return _assistant_message(turn_writer, grounding_meta_dict)
+
+def resume_turn(client, api_key_value, user_email, session_id, user_prompt_text, interrupted_message, existing_chat_history,
+                events=None, older_history_unloaded=False):
+    """Continue an interrupted answer in place; returns the updated assistant message, or None if it was finished elsewhere."""
+    events = events or ChatEvents()
+    turn_writer = turn_store.TurnWriter(get_db_pool(), session_id)
+    if not turn_writer.resume(interrupted_message["seq"], interrupted_message["timestamp"], interrupted_message["content"]):
+        return None
+    with _turn_trace(session_id, user_email):
+        try:
+            metrics.set_attributes(resumed=True)
+            full_response, grounding_meta_dict = generate_response(
+                client, api_key_value, user_prompt_text, session_id, existing_chat_history, events,
+                older_history_unloaded=older_history_unloaded, resume_from=interrupted_message["content"], turn_writer=turn_writer)
+            with metrics.span("save_assistant_message"):
+                turn_writer.finish(full_response, serialize_grounding_metadata(grounding_meta_dict))
+        finally:
+            turn_writer.close()
+    return _assistant_message(turn_writer, grounding_meta_dict)
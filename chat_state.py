@@ -0,0 +1,150 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# --- Bounded Chat State ---
+# What one server process keeps per connected user has to stay bounded when hundreds of users
+# share it. Messages are compact records (__slots__, no per-message dict) that still read like the
+# dicts the rest of the code uses; each browser session keeps only a recent window of them, the
+# rest is paged back in from SQLite on demand; and process-wide caches keyed by session are LRUs
+# with a size cap and a time-to-live instead of dicts that only grow. The chat state of every
+# browser session is tracked (message count and approximate size) for the admin panel.
+
+CHAT_STATE_TRACKING_TTL_SECONDS = 1800 # Browser sessions not seen for this long are no longer counted
+CHAT_STATE_TRACKING_MAX_ENTRIES = 10000
+
+_MISSING = object()
+
+class Message:
+    """A chat message with dict-style access; a field that was never set reads as a missing key."""
+    __slots__ = ("role", "content", "seq", "timestamp", "status", "heartbeat_at",
+                 "gemini_grounding_metadata_json", "gemini_grounding_metadata", "gemini_grounding_metadata_error")
+
+    def __init__(self, role, content, seq=None, timestamp=None, **fields):
+        self.role = role; self.content = content; self.seq = seq; self.timestamp = timestamp
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING: raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__: raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def pop(self, key, default=_MISSING):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING: raise KeyError(key)
+            return default
+        delattr(self, key)
+        return value
+
+    def update(self, other):
+        for key in other.keys():
+            self[key] = other[key]
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"Message({dict(self.items())!r})"
+
+def estimate_bytes(messages):
+    """Approximate memory held by the messages: the records and their string fields."""
+    total = 0
+    for message in messages:
+        total += sys.getsizeof(message)
+        for _, value in message.items():
+            if isinstance(value, str): total += sys.getsizeof(value)
+    return total
+
+# --- Bounded caches ---
+class BoundedCache:
+    """A thread-safe LRU mapping holding at most max_entries values, each for at most ttl_seconds."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # key -> (stored_at, value), least recently used first
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                del self._entries[key]; self._stats["expirations"] += 1; entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False); self._stats["evictions"] += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def values(self):
+        # Live values, without touching their recency; expired entries are dropped on the way.
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (stored_at, _) in self._entries.items() if now - stored_at > self.ttl_seconds]
+            for key in expired: del self._entries[key]
+            self._stats["expirations"] += len(expired)
+            return [value for _, value in self._entries.values()]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), max_entries=self.max_entries)
+
+# --- Chat state tracking ---
+_TRACKED_CHAT_STATE = BoundedCache(CHAT_STATE_TRACKING_MAX_ENTRIES, CHAT_STATE_TRACKING_TTL_SECONDS)
+
+def track_chat_state(state_id, messages):
+    # Called once per script run with the browser session's messages; only the totals are kept.
+    _TRACKED_CHAT_STATE[state_id] = (len(messages), estimate_bytes(messages))
+
+def chat_state_summary():
+    """Return {"sessions", "messages", "bytes"} over the browser sessions seen recently by this process."""
+    tracked = _TRACKED_CHAT_STATE.values()
+    return {"sessions": len(tracked), "messages": sum(count for count, _ in tracked),
+            "bytes": sum(size for _, size in tracked)}
@@ -0,0 +1,160 @@
+import hashlib
+import threading
+import time
+
+from file_registry import hash_api_key
+
+# --- Gemini Context Cache ---
+# The system instruction, the tools and the PDF corpus form the same large prompt prefix on
+# every turn. It is stored once as a Gemini cached-content handle (shared by all sessions and
+# worker processes through chat_sessions.db) and its TTL is extended in the background while
+# it keeps being used. Any failure makes callers fall back to attaching the PDFs directly.
+
+CONTEXT_CACHE_TTL_SECONDS = 60 * 60
+REFRESH_BEFORE_EXPIRY_SECONDS = 10 * 60
+REFRESH_CHECK_INTERVAL_SECONDS = 60
+IDLE_RELEASE_SECONDS = 30 * 60  # Handles unused for this long are left to expire
+CREATE_FAILURE_BACKOFF_SECONDS = 15 * 60
+CACHE_DISPLAY_NAME = "gtcc-hcm-corpus"
+
+_HANDLES = {}  # (api_key_hash, model, corpus_key) -> {"name", "expires_at", "last_used_at", "client", "pool"}
+_CREATE_FAILED_UNTIL = {}
+_CREATING = {}  # key -> threading.Event set when the thread creating that cache is done
+_LOCK = threading.Lock()
+_REFRESHER_STARTED = threading.Event()
+
+def init_context_cache_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gemini_context_caches (
+            corpus_key TEXT NOT NULL,
+            api_key_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            cache_name TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            PRIMARY KEY (corpus_key, api_key_hash, model)
+        ) ''')
+
+def compute_corpus_key(system_instruction, file_records, tools=()):
+    digest = hashlib.sha256(system_instruction.encode("utf-8"))
+    for tool in tools or ():
+        # Tools are baked into the cache: a changed tool set (e.g. the transit tools switched on) needs its own.
+        digest.update(tool.model_dump_json(exclude_none=True).encode("utf-8"))
+    for record in sorted(file_records, key=lambda r: r.content_sha256):
+        digest.update(record.content_sha256.encode("ascii"))
+        digest.update(record.uri.encode("utf-8"))  # A re-upload gets a new URI and needs a new cache
+    return digest.hexdigest()
+
+def _expiry_timestamp(cached_content):
+    expire_time = getattr(cached_content, "expire_time", None)
+    if expire_time is not None:
+        try: return int(expire_time.timestamp())
+        except (AttributeError, OverflowError, ValueError): pass
+    return int(time.time()) + CONTEXT_CACHE_TTL_SECONDS
+
+def _load_shared_handle(pool, key):
+    return pool.fetchone("SELECT cache_name, expires_at FROM gemini_context_caches WHERE api_key_hash = ? AND model = ? AND corpus_key = ?", key)
+
+def _store_shared_handle(pool, key, cache_name, expires_at):
+    pool.execute("""
+        INSERT OR REPLACE INTO gemini_context_caches (api_key_hash, model, corpus_key, cache_name, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)""", (*key, cache_name, int(time.time()), expires_at))
+
+def _update_shared_expiry(pool, cache_name, expires_at):
+    pool.execute("UPDATE gemini_context_caches SET expires_at = ? WHERE cache_name = ?", (expires_at, cache_name))
+
+def _delete_shared_handle(pool, cache_name):
+    pool.execute("DELETE FROM gemini_context_caches WHERE cache_name = ?", (cache_name,))
+
+def get_or_create_context_cache(client, pool, api_key_value, model, system_instruction, file_records, tools):
+    """Return the cached-content name for this corpus, or None when caching is unavailable."""
+    if not file_records:
+        return None
+    from google.genai import types as google_genai_types  # Deferred: the SDK is slow to import
+    key = (hash_api_key(api_key_value), model, compute_corpus_key(system_instruction, file_records, tools))
+    while True:
+        now = time.time()
+        with _LOCK:
+            handle = _HANDLES.get(key)
+            if handle and handle["expires_at"] - REFRESH_CHECK_INTERVAL_SECONDS > now:
+                handle["last_used_at"] = now; handle["client"] = client
+                return handle["name"]
+            if _CREATE_FAILED_UNTIL.get(key, 0) > now:
+                return None
+            creating = _CREATING.get(key)
+            if creating is None:
+                creating = _CREATING[key] = threading.Event()
+                break
+        creating.wait()  # Another thread is creating this cache; use its result
+
+    # Only this thread creates the cache for the key; other keys and the refresher do not wait for it.
+    try:
+        shared_row = _load_shared_handle(pool, key)
+        if shared_row and shared_row[1] - REFRESH_CHECK_INTERVAL_SECONDS > now:
+            cache_name, expires_at = shared_row
+        else:
+            file_parts = [google_genai_types.Part(file_data=google_genai_types.FileData(mime_type=r.mime_type, file_uri=r.uri))
+                          for r in file_records]
+            try:
+                cached_content = client.caches.create(
+                    model=model,
+                    config=google_genai_types.CreateCachedContentConfig(
+                        display_name=CACHE_DISPLAY_NAME,
+                        system_instruction=system_instruction,
+                        contents=[google_genai_types.Content(role="user", parts=file_parts)],
+                        tools=tools,
+                        ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                    ))
+            except Exception:
+                # Model without caching support, corpus below the minimum size, quota... use attachments.
+                with _LOCK: _CREATE_FAILED_UNTIL[key] = time.time() + CREATE_FAILURE_BACKOFF_SECONDS
+                return None
+            cache_name, expires_at = cached_content.name, _expiry_timestamp(cached_content)
+            _store_shared_handle(pool, key, cache_name, expires_at)
+        with _LOCK:
+            _HANDLES[key] = {"name": cache_name, "expires_at": expires_at, "last_used_at": time.time(), "client": client, "pool": pool}
+    finally:
+        with _LOCK: del _CREATING[key]
+        creating.set()
+    _ensure_refresher_started()
+    return cache_name
+
+def invalidate_context_cache(pool, cache_name):
+    # Called when a request using the handle fails (expired or deleted on the server side).
+    with _LOCK:
+        for key in [k for k, h in _HANDLES.items() if h["name"] == cache_name]:
+            del _HANDLES[key]
+    _delete_shared_handle(pool, cache_name)
+
+def _refresh_due_handles():
+    from google.genai import types as google_genai_types
+    now = time.time()
+    with _LOCK:
+        due = [(k, dict(h)) for k, h in _HANDLES.items()
+               if h["expires_at"] - REFRESH_BEFORE_EXPIRY_SECONDS <= now and now - h["last_used_at"] < IDLE_RELEASE_SECONDS]
+        for key in [k for k, h in _HANDLES.items() if h["expires_at"] <= now]:
+            del _HANDLES[key]
+    for key, handle in due:
+        try:
+            updated = handle["client"].caches.update(
+                name=handle["name"],
+                config=google_genai_types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s"))
+            expires_at = _expiry_timestamp(updated)
+            _update_shared_expiry(handle["pool"], handle["name"], expires_at)
+            with _LOCK:
+                if key in _HANDLES: _HANDLES[key]["expires_at"] = expires_at
+        except Exception:
+            pass  # Left to expire; the next turn recreates it or falls back to attachments
+
+def _refresher_loop():
+    while True:
+        time.sleep(REFRESH_CHECK_INTERVAL_SECONDS)
+        _refresh_due_handles()
+
+def _ensure_refresher_started():
+    if _REFRESHER_STARTED.is_set():
+        return
+    with _LOCK:
+        if _REFRESHER_STARTED.is_set(): return
+        threading.Thread(target=_refresher_loop, name="gemini-context-cache-refresher", daemon=True).start()
+        _REFRESHER_STARTED.set()
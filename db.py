@@ -0,0 +1,139 @@
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# --- SQLite Connection Pool ---
+# One pool per process (chat_core.get_db_pool). Connections stay open, so
+# the pragmas below are applied once per connection and sqlite3's per-connection statement cache
+# keeps every helper's SQL prepared across Streamlit reruns. WAL lets readers proceed while a
+# writer commits, and synchronous=NORMAL drops the fsync on every commit (still durable at
+# checkpoints, safe against application crashes). Foreign keys are enforced (SQLite leaves them
+# off by default), so deleting a session deletes its messages; auto_vacuum=INCREMENTAL only takes
+# effect on a new database or at the next full VACUUM (see maintenance.py).
+
+BUSY_TIMEOUT_SECONDS = 5.0
+BUSY_MAX_RETRIES = 6
+BUSY_BACKOFF_BASE_SECONDS = 0.02
+STATEMENT_CACHE_SIZE = 256
+CONNECTION_PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL", # Before journal_mode, which initializes a new file
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-16384",    # 16 MB page cache per connection
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+def _sleep_backoff(attempt):
+    time.sleep(BUSY_BACKOFF_BASE_SECONDS * (2 ** attempt) * (0.5 + random.random()))
+
+class ConnectionPool:
+    def __init__(self, db_path, max_connections=8):
+        self.db_path = str(db_path)
+        self.max_connections = max_connections
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        conn = None
+        try:
+            try: conn = self._idle.get_nowait()
+            except queue.Empty: conn = self._connect()
+            yield conn
+        finally:
+            if conn is not None:
+                if conn.in_transaction:
+                    conn.rollback()
+                if self._closed: conn.close()
+                else: self._idle.put(conn)
+            self._slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in a write transaction (BEGIN IMMEDIATE), committing on success."""
+        with self.connection() as conn:
+            for attempt in range(BUSY_MAX_RETRIES + 1):
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if not is_busy_error(e) or attempt == BUSY_MAX_RETRIES: raise
+                    _sleep_backoff(attempt)
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction: conn.execute("ROLLBACK")
+                raise
+
+    def _with_retry(self, operation):
+        for attempt in range(BUSY_MAX_RETRIES + 1):
+            try:
+                return operation()
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == BUSY_MAX_RETRIES: raise
+                _sleep_backoff(attempt)
+
+    def fetchall(self, sql, params=()):
+        def operation():
+            with self.connection() as conn:
+                return conn.execute(sql, params).fetchall()
+        return self._with_retry(operation)
+
+    def fetchone(self, sql, params=()):
+        def operation():
+            with self.connection() as conn:
+                return conn.execute(sql, params).fetchone()
+        return self._with_retry(operation)
+
+    def execute(self, sql, params=()):
+        """Single write statement in its own transaction; returns (rowcount, lastrowid)."""
+        def operation():
+            with self.transaction() as conn:
+                cursor = conn.execute(sql, params)
+                return cursor.rowcount, cursor.lastrowid
+        return self._with_retry(operation)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try: self._idle.get_nowait().close()
+            except queue.Empty: break
+
+# --- Schema Migrations ---
+# `migrations` is a list of (version, function(cursor)). The schema version of the database file
+# is kept in PRAGMA user_version, so each migration runs once per database, not once per process
+# or rerun. The check-and-apply runs under BEGIN IMMEDIATE, so concurrent workers cannot both
+# apply the same migration.
+
+def schema_version(pool):
+    return pool.fetchone("PRAGMA user_version")[0]
+
+def migrate(pool, migrations):
+    """Apply the migrations newer than the database's user_version, in order; return the final version."""
+    with pool.transaction() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target_version, migration in sorted(migrations, key=lambda m: m[0]):
+            if target_version <= version: continue
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {int(target_version)}")
+            version = target_version
+    return version
@@ -0,0 +1,240 @@
+import concurrent.futures
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+import gemini_scheduler
+
+# --- Gemini File Registry ---
+# Uploaded PDFs are shared by every session and worker process: a file is keyed by the
+# SHA-256 of its content plus the hash of the API key it was uploaded with, so it is
+# only re-uploaded when the Gemini copy expires, disappears or the PDF itself changes.
+# Uploads go through the key's rate limiter like the chat requests, and each file's prompt size
+# (pages x gemini_scheduler.PDF_PAGE_TOKENS) is registered for the limiter's token estimates.
+
+GEMINI_FILE_TTL_SECONDS = 48 * 3600  # Gemini File API keeps uploads for 48 hours
+EXPIRY_SAFETY_MARGIN_SECONDS = 30 * 60
+REVALIDATE_INTERVAL_SECONDS = 10 * 60
+UPLOAD_WORKERS = 4
+UPLOAD_ATTEMPTS = 2  # Per file and turn, on top of call_with_retry's backoff on transient errors
+UPLOAD_WAIT_SECONDS = 300
+
+RegisteredFile = namedtuple("RegisteredFile", ["name", "uri", "mime_type", "expires_at", "content_sha256", "filename"])
+
+_FILE_HASH_CACHE = {}  # str(path) -> (mtime_ns, size, sha256)
+_PAGE_COUNT_CACHE = {}  # str(path) -> (mtime_ns, size, pages or None)
+_KEY_LOCKS = {}
+_KEY_LOCKS_GUARD = threading.Lock()
+_UPLOADS_GUARD = threading.Lock()
+_UPLOADS = {}  # (str(path), api_key_hash) -> (Future of (RegisteredFile, uploaded_now), submitted_at)
+_EXECUTOR = {"pool": None}
+
+def init_file_registry_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gemini_files (
+            content_sha256 TEXT NOT NULL,
+            api_key_hash TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            gemini_name TEXT NOT NULL,
+            gemini_uri TEXT NOT NULL,
+            mime_type TEXT,
+            uploaded_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            last_validated_at INTEGER NOT NULL,
+            PRIMARY KEY (content_sha256, api_key_hash)
+        ) ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_gemini_files_key_filename ON gemini_files (api_key_hash, filename);''')
+
+def hash_api_key(api_key_value):
+    return hashlib.sha256(api_key_value.encode("utf-8")).hexdigest()
+
+def file_sha256(file_path):
+    stat = file_path.stat()
+    cached = _FILE_HASH_CACHE.get(str(file_path))
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    sha = digest.hexdigest()
+    _FILE_HASH_CACHE[str(file_path)] = (stat.st_mtime_ns, stat.st_size, sha)
+    return sha
+
+def pdf_page_count(file_path):
+    """Number of pages of the PDF, cached by mtime and size; None when it cannot be read."""
+    stat = file_path.stat()
+    cached = _PAGE_COUNT_CACHE.get(str(file_path))
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+    try:
+        from pypdf import PdfReader
+        pages = len(PdfReader(str(file_path)).pages)
+    except Exception:
+        pages = None  # Not a PDF, or damaged: the scheduler's default estimate applies
+    _PAGE_COUNT_CACHE[str(file_path)] = (stat.st_mtime_ns, stat.st_size, pages)
+    return pages
+
+def _register_token_estimate(record, file_path):
+    pages = pdf_page_count(file_path)
+    if pages: gemini_scheduler.set_file_token_estimate(record.uri, pages * gemini_scheduler.PDF_PAGE_TOKENS)
+
+def _lock_for(key):
+    with _KEY_LOCKS_GUARD:
+        return _KEY_LOCKS.setdefault(key, threading.Lock())
+
+def _expiry_timestamp(gemini_file):
+    expiration_time = getattr(gemini_file, "expiration_time", None)
+    if expiration_time is not None:
+        try: return int(expiration_time.timestamp())
+        except (AttributeError, OverflowError, ValueError): pass
+    return int(time.time()) + GEMINI_FILE_TTL_SECONDS
+
+def _is_remote_file_active(client, gemini_name):
+    try:
+        remote_file = client.files.get(name=gemini_name)
+    except Exception:
+        return False
+    state = getattr(remote_file, "state", None)
+    state_name = getattr(state, "name", state)
+    return state_name in (None, "ACTIVE", "PROCESSING", "STATE_UNSPECIFIED")
+
+def _load_entry(pool, content_sha, key_hash):
+    row = pool.fetchone("""
+        SELECT gemini_name, gemini_uri, mime_type, expires_at, filename, last_validated_at
+        FROM gemini_files WHERE content_sha256 = ? AND api_key_hash = ?""", (content_sha, key_hash))
+    if not row: return None, 0
+    return RegisteredFile(row[0], row[1], row[2], row[3], content_sha, row[4]), row[5]
+
+def _store_entry(pool, record, key_hash):
+    current_time = int(time.time())
+    with pool.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO gemini_files
+                (content_sha256, api_key_hash, filename, gemini_name, gemini_uri, mime_type, uploaded_at, expires_at, last_validated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (record.content_sha256, key_hash, record.filename, record.name, record.uri, record.mime_type,
+             current_time, record.expires_at, current_time))
+        # Older uploads of the same document (content changed since) are no longer referenced.
+        cursor.execute("SELECT gemini_name FROM gemini_files WHERE api_key_hash = ? AND filename = ? AND content_sha256 != ?",
+                       (key_hash, record.filename, record.content_sha256))
+        stale_names = [r[0] for r in cursor.fetchall()]
+        cursor.execute("DELETE FROM gemini_files WHERE api_key_hash = ? AND filename = ? AND content_sha256 != ?",
+                       (key_hash, record.filename, record.content_sha256))
+    return stale_names
+
+def _touch_entry(pool, content_sha, key_hash):
+    pool.execute("UPDATE gemini_files SET last_validated_at = ? WHERE content_sha256 = ? AND api_key_hash = ?",
+                 (int(time.time()), content_sha, key_hash))
+
+def get_or_upload_file(client, pool, api_key_value, file_path):
+    """Return (RegisteredFile, uploaded_now) for file_path, uploading only when needed."""
+    content_sha = file_sha256(file_path)
+    key_hash = hash_api_key(api_key_value)
+    with _lock_for((content_sha, key_hash)):
+        record, last_validated_at = _load_entry(pool, content_sha, key_hash)
+        now = time.time()
+        if record and record.expires_at - EXPIRY_SAFETY_MARGIN_SECONDS > now:
+            if now - last_validated_at < REVALIDATE_INTERVAL_SECONDS:
+                _register_token_estimate(record, file_path)
+                return record, False
+            if _is_remote_file_active(client, record.name):
+                _touch_entry(pool, content_sha, key_hash)
+                _register_token_estimate(record, file_path)
+                return record, False
+
+        limiter = gemini_scheduler.get_limiter(pool, api_key_value)
+        def upload():
+            limiter.acquire(0)  # One request of the key's quota per attempt, in the same FIFO queue as the chat turns
+            return client.files.upload(file=file_path)
+        gemini_file = gemini_scheduler.call_with_retry(upload)
+        record = RegisteredFile(gemini_file.name, gemini_file.uri, gemini_file.mime_type or "application/pdf",
+                                _expiry_timestamp(gemini_file), content_sha, file_path.name)
+        _register_token_estimate(record, file_path)
+        for stale_name in _store_entry(pool, record, key_hash):
+            try: client.files.delete(name=stale_name)
+            except Exception: pass  # Expires on its own anyway
+        return record, True
+
+# --- Background Pre-warming ---
+# Uploads start on a small worker pool as soon as a session is created or an API key is saved,
+# every file at once. A turn then waits only for the files still in flight; a file whose upload
+# failed is submitted again on its own while the others are used as they are.
+def _executor():
+    with _UPLOADS_GUARD:
+        if _EXECUTOR["pool"] is None:
+            _EXECUTOR["pool"] = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="gemini-upload")
+        return _EXECUTOR["pool"]
+
+def _is_reusable(future, submitted_at):
+    # In flight, or succeeded recently enough that the registry would not revalidate it yet.
+    if not future.done(): return True
+    if future.exception() is not None: return False
+    record = future.result()[0]
+    now = time.time()
+    return now - submitted_at < REVALIDATE_INTERVAL_SECONDS and record.expires_at - EXPIRY_SAFETY_MARGIN_SECONDS > now
+
+def prewarm_files(client, pool, api_key_value, file_paths):
+    """Start uploading file_paths in the background; returns {file_path: Future of (RegisteredFile, uploaded_now)}."""
+    key_hash = hash_api_key(api_key_value)
+    executor = _executor()
+    futures = {}
+    with _UPLOADS_GUARD:
+        for file_path in file_paths:
+            upload_key = (str(file_path), key_hash)
+            entry = _UPLOADS.get(upload_key)
+            if entry is None or not _is_reusable(*entry):
+                entry = (executor.submit(get_or_upload_file, client, pool, api_key_value, file_path), time.time())
+                _UPLOADS[upload_key] = entry
+            futures[file_path] = entry[0]
+    return futures
+
+def prewarm_status(api_key_value, file_paths):
+    """Counts of file_paths that are ready, uploading and failed in the background pool (unknown files are not counted)."""
+    key_hash = hash_api_key(api_key_value)
+    status = {"ready": 0, "uploading": 0, "failed": 0}
+    with _UPLOADS_GUARD:
+        entries = [_UPLOADS.get((str(file_path), key_hash)) for file_path in file_paths]
+    for entry in entries:
+        if entry is None: continue
+        if not entry[0].done(): status["uploading"] += 1
+        elif entry[0].exception() is not None: status["failed"] += 1
+        else: status["ready"] += 1
+    return status
+
+def wait_for_files(client, pool, api_key_value, file_paths, on_progress=None, timeout_seconds=UPLOAD_WAIT_SECONDS):
+    """Return [(file_path, RegisteredFile or None, uploaded_now, error or None)] in file_paths order.
+
+    Files already uploaded in the background are returned at once; on_progress(ready, total) is
+    called as the others finish. Failed files are retried individually, up to UPLOAD_ATTEMPTS.
+    """
+    results = {}
+    deadline = time.monotonic() + timeout_seconds
+    pending_paths = list(file_paths)
+    for _ in range(UPLOAD_ATTEMPTS):
+        futures = prewarm_files(client, pool, api_key_value, pending_paths)
+        path_by_future = {future: file_path for file_path, future in futures.items()}
+        finished_before = {future for future in path_by_future if future.done()}  # Reported as already uploaded
+        waiting = len(finished_before) < len(path_by_future)
+
+        def record_result(future, file_path):
+            try: record, uploaded_now = future.result()
+            except Exception as e: results[file_path] = (file_path, None, False, e)
+            else: results[file_path] = (file_path, record, uploaded_now and future not in finished_before, None)
+
+        try:
+            for future in concurrent.futures.as_completed(path_by_future, timeout=max(0.0, deadline - time.monotonic())):
+                file_path = path_by_future[future]
+                record_result(future, file_path)
+                if on_progress and waiting: on_progress(sum(1 for r in results.values() if r[3] is None), len(file_paths))
+        except concurrent.futures.TimeoutError as e:
+            for future, file_path in path_by_future.items():
+                # Futures that finished after the timeout was raised are recorded too; the rest are still uploading, for a later turn.
+                if future.done(): record_result(future, file_path)
+                else: results[file_path] = (file_path, None, False, e)
+            break
+        pending_paths = [file_path for file_path in pending_paths if results[file_path][3] is not None]
+        if not pending_paths: break
+    return [results[file_path] for file_path in file_paths]
@@ -0,0 +1,196 @@
+import collections
+import contextvars
+import queue
+import threading
+import time
+
+import file_registry
+import gemini_scheduler
+
+# --- Hedged Gemini Requests ---
+# Most answers start streaming within a second or two, but a few wait much longer (an overloaded
+# backend, a 503 being retried with backoff). A hedged call starts the request as usual and, if no
+# chunk has arrived by a deadline derived from the recent time-to-first-chunk p95 of that model,
+# sends a second request, optionally to a lighter fallback model. Whichever stream produces a
+# chunk first is used; the other is cancelled: closed as soon as its next chunk arrives, and never
+# queued, retried or resent after that (the cancel Event reaches gemini_scheduler, which checks it
+# before each attempt and during the retry backoff). A stream that ends without any output does not
+# win; the other one is waited for. Both streams run in worker threads and hand their chunks, queue
+# and retry notices back to the caller's thread, so callbacks never run elsewhere.
+#
+# Hedges must not double the quota: each API key earns HEDGE_BUDGET_RATIO of a hedge per request
+# (capped at HEDGE_BUDGET_BURST), a hedge spends one, and it is only sent when the key's limiter
+# admits it right away (gemini_scheduler.KeyRateLimiter.try_acquire), never by queueing.
+
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20 # Below this, HEDGE_DEFAULT_DELAY_SECONDS is used
+HEDGE_DEFAULT_DELAY_SECONDS = 4.0
+HEDGE_MIN_DELAY_SECONDS = 0.5
+HEDGE_MAX_DELAY_SECONDS = 15.0
+HEDGE_BUDGET_RATIO = 0.1 # Hedges allowed per request sent, per API key
+HEDGE_BUDGET_BURST = 3.0
+FIRST_CHUNK_WINDOW = 200 # Most recent first-chunk times kept per model
+
+_LOCK = threading.Lock()
+_FIRST_CHUNK_SECONDS = {} # model -> deque of seconds from request to first chunk
+_BUDGETS = {} # sha256(API key) -> hedge credit
+_STATS = collections.Counter()
+
+def configure(percentile=None, budget_ratio=None):
+    global HEDGE_PERCENTILE, HEDGE_BUDGET_RATIO
+    if percentile: HEDGE_PERCENTILE = percentile
+    if budget_ratio is not None: HEDGE_BUDGET_RATIO = budget_ratio
+
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))]
+
+def record_first_chunk(model, seconds):
+    with _LOCK:
+        _FIRST_CHUNK_SECONDS.setdefault(model, collections.deque(maxlen=FIRST_CHUNK_WINDOW)).append(seconds)
+
+def hedge_delay(model, percentile=None):
+    """Seconds to wait for a first chunk before hedging: the recent p-th percentile for the model, clamped."""
+    percentile = percentile or HEDGE_PERCENTILE
+    with _LOCK:
+        values = sorted(_FIRST_CHUNK_SECONDS.get(model, ()))
+    if len(values) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    return min(HEDGE_MAX_DELAY_SECONDS, max(HEDGE_MIN_DELAY_SECONDS, _percentile(values, percentile)))
+
+def _earn_budget(key_hash, ratio):
+    with _LOCK:
+        _BUDGETS[key_hash] = min(HEDGE_BUDGET_BURST, _BUDGETS.get(key_hash, 1.0) + ratio)
+
+def _spend_budget(key_hash):
+    with _LOCK:
+        if _BUDGETS.get(key_hash, 0.0) < 1.0: return False
+        _BUDGETS[key_hash] -= 1.0
+        return True
+
+def _refund_budget(key_hash):
+    with _LOCK:
+        _BUDGETS[key_hash] = min(HEDGE_BUDGET_BURST, _BUDGETS.get(key_hash, 0.0) + 1.0)
+
+def hedging_stats():
+    """Counters of this process plus the current deadline and first-chunk p50/p95 per model."""
+    with _LOCK:
+        stats = dict(_STATS)
+        first_chunk = {model: sorted(values) for model, values in _FIRST_CHUNK_SECONDS.items()}
+    stats["models"] = {model: {"samples": len(values), "p50_ms": round(_percentile(values, 50) * 1000.0, 1),
+                               "p95_ms": round(_percentile(values, 95) * 1000.0, 1), "hedge_delay_ms": round(hedge_delay(model) * 1000.0, 1)}
+                       for model, values in first_chunk.items() if values}
+    return stats
+
+def reset_stats():
+    with _LOCK:
+        _STATS.clear(); _FIRST_CHUNK_SECONDS.clear(); _BUDGETS.clear()
+
+def _count(name):
+    with _LOCK:
+        _STATS[name] += 1
+
+# --- Streams ---
+class _Stream:
+    # One request in a worker thread; everything it produces goes to the shared queue, tagged.
+    def __init__(self, label, model, events, stream_factory):
+        self.label = label
+        self.model = model
+        self.cancelled = threading.Event()
+        self.started_at = time.monotonic()
+        self.waited = False # Queued for quota: its first-chunk time says nothing about the backend
+        self.first_chunk_at = None
+        context = contextvars.copy_context()
+        self.thread = threading.Thread(target=context.run, args=(self._run, events, stream_factory),
+                                       name=f"gemini-{label}", daemon=True)
+        self.thread.start()
+
+    def _run(self, events, stream_factory):
+        def on_wait(*args):
+            self.waited = True; events.put((self, "wait", args))
+        stream = stream_factory(on_wait=on_wait, on_retry=lambda *args: events.put((self, "retry", args)), cancel=self.cancelled)
+        try:
+            for item in stream:
+                if self.first_chunk_at is None:
+                    # Recorded for the losing stream too, so hedging does not hide the slow requests from the p95.
+                    self.first_chunk_at = time.monotonic()
+                    if not self.waited: record_first_chunk(self.model, self.first_chunk_at - self.started_at)
+                if self.cancelled.is_set(): return
+                events.put((self, "item", item))
+            events.put((self, "end", None))
+        except Exception as e:
+            events.put((self, "error", e))
+        finally:
+            stream.close() # Closes the HTTP stream of a cancelled request
+
+def hedged_stream_generate_content(client, pool, api_key_value, model, contents, config, fallback_model=None, on_wait=None,
+                                   on_retry=None, on_hedge=None, resume_from="", budget_ratio=None):
+    """Like gemini_scheduler.stream_generate_content, with one hedge request after the first-chunk deadline.
+
+    on_hedge(event, model) is called with "launched" when the hedge is sent, then with "won" and
+    the model of the stream that is used. The hedge goes to fallback_model (the same model when
+    None) and is not retried: if it fails, the first request carries on alone.
+    """
+    key_hash = file_registry.hash_api_key(api_key_value or "")
+    _earn_budget(key_hash, HEDGE_BUDGET_RATIO if budget_ratio is None else budget_ratio)
+    _count("requests")
+    events = queue.Queue()
+
+    def start(label, stream_model, **options):
+        return _Stream(label, stream_model, events, lambda on_wait, on_retry, cancel: gemini_scheduler.stream_generate_content(
+            client, pool, api_key_value, stream_model, contents, config, on_wait=on_wait, on_retry=on_retry,
+            resume_from=resume_from, cancel=cancel, **options))
+
+    primary = start("primary", model)
+    streams = [primary]; failed = []; errors = []; winner = None; first_item = None
+    deadline = time.monotonic() + hedge_delay(model)
+    try:
+        while winner is None:
+            timeout = deadline - time.monotonic() if len(streams) == 1 and deadline is not None else None
+            try:
+                stream, kind, payload = events.get(timeout=max(0.0, timeout) if timeout is not None else None)
+            except queue.Empty:
+                deadline = None # One hedge at most, whether or not it can be sent
+                hedge_model = fallback_model or model
+                limiter = gemini_scheduler.get_limiter(pool, api_key_value)
+                if not _spend_budget(key_hash):
+                    _count("skipped_budget"); continue
+                if not limiter.try_acquire(gemini_scheduler.estimate_tokens(contents)):
+                    _refund_budget(key_hash); _count("skipped_quota"); continue
+                _count("hedges")
+                streams.append(start("hedge", hedge_model, max_retries=0, preacquired=True))
+                if on_hedge: on_hedge("launched", hedge_model)
+                continue
+            if stream in failed: continue
+            if kind == "wait":
+                if deadline is not None: deadline = time.monotonic() + hedge_delay(model) # Queue time is not backend latency
+                if on_wait and stream is primary: on_wait(*payload)
+            elif kind == "retry":
+                if on_retry and stream is primary: on_retry(*payload)
+            elif kind in ("error", "end"):
+                # Ended without output (an error, or an empty answer): the other stream may still answer.
+                failed.append(stream)
+                if kind == "error": errors.append(payload)
+                if len(failed) == len(streams): # Nothing else can answer
+                    if errors: raise errors[-1]
+                    return
+                _count(f"{stream.label}_{'errors' if kind == 'error' else 'empty'}")
+            else:
+                winner = stream; first_item = payload
+        for stream in streams:
+            if stream is not winner: stream.cancelled.set()
+        if len(streams) > 1:
+            _count(f"{winner.label}_wins")
+            if on_hedge: on_hedge("won", winner.model)
+        yield first_item
+        while True:
+            stream, kind, payload = events.get()
+            if stream is not winner: continue
+            if kind == "item": yield payload
+            elif kind == "retry":
+                if on_retry: on_retry(*payload)
+            elif kind == "wait":
+                if on_wait: on_wait(*payload)
+            elif kind == "error": raise payload
+            else: return
+    finally:
+        for stream in streams: stream.cancelled.set() # The caller stopped early or an error ended the call
@@ -0,0 +1,319 @@
+import datetime
+import random
+import threading
+import time
+
+import file_registry
+
+# --- Gemini Request Scheduler ---
+# Every Gemini API key has its own quota (15 RPM, 1M TPM and 1500 RPD for gemini-2.0-flash on
+# the free tier). Requests for a key go through one limiter per process: token buckets for
+# requests and tokens per minute, plus a daily request/token count stored in chat_sessions.db
+# so it survives restarts and is shared with other worker processes. Callers queue in FIFO order
+# (bounded, so a backlog fails fast instead of piling up) and are told their position while
+# waiting. Retryable errors (429, 5xx, connection drops) are retried with jittered exponential
+# backoff; a stream that breaks after producing text is resumed from where it stopped.
+
+GEMINI_RPM_LIMIT = 15
+GEMINI_TPM_LIMIT = 1000000
+GEMINI_RPD_LIMIT = 1500
+MAX_QUEUED_REQUESTS = 20
+MAX_QUEUE_WAIT_SECONDS = 120
+QUEUE_POLL_SECONDS = 0.5
+
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+CHARS_PER_TOKEN = 3
+FILE_PART_TOKEN_ESTIMATE = 2000  # For a file of unknown size; corrected from usage_metadata once the response arrives
+PDF_PAGE_TOKENS = 258  # Gemini bills each PDF page as an image of 258 tokens
+RESUME_OVERLAP_CHARS = 200
+RESUME_PROMPT = ("Câu trả lời trước của bạn bị ngắt giữa chừng. Hãy viết tiếp chính xác từ chỗ bị ngắt, "
+                 "không lặp lại phần đã viết và không thêm lời dẫn.")
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")  # Gemini daily quotas reset at midnight Pacific time
+except Exception:
+    QUOTA_TIMEZONE = datetime.timezone.utc
+
+_LIMITERS = {}
+_LIMITERS_GUARD = threading.Lock()
+_FILE_TOKEN_ESTIMATES = {}  # file URI -> estimated prompt tokens, set by file_registry
+
+class SchedulerError(Exception):
+    pass
+
+class SchedulerBusyError(SchedulerError):
+    pass
+
+class DailyQuotaExceededError(SchedulerError):
+    pass
+
+class RequestCancelledError(SchedulerError):
+    pass
+
+def init_usage_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gemini_key_usage (
+            api_key_hash TEXT NOT NULL,
+            day TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (api_key_hash, day)
+        ) ''')
+
+def configure(rpm=None, tpm=None, rpd=None, max_queued=None):
+    global GEMINI_RPM_LIMIT, GEMINI_TPM_LIMIT, GEMINI_RPD_LIMIT, MAX_QUEUED_REQUESTS
+    if rpm: GEMINI_RPM_LIMIT = rpm
+    if tpm: GEMINI_TPM_LIMIT = tpm
+    if rpd: GEMINI_RPD_LIMIT = rpd
+    if max_queued: MAX_QUEUED_REQUESTS = max_queued
+
+def _quota_day():
+    return datetime.datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+class TokenBucket:
+    def __init__(self, capacity, per_seconds=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)  # An oversized request waits for a full bucket, not forever
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount  # May go negative after a usage correction; later callers wait it out
+
+class KeyRateLimiter:
+    def __init__(self, pool, api_key_hash):
+        self.pool = pool
+        self.api_key_hash = api_key_hash
+        self.requests = TokenBucket(GEMINI_RPM_LIMIT)
+        self.tokens = TokenBucket(GEMINI_TPM_LIMIT)
+        self._cond = threading.Condition()
+        self._queue = []  # Tickets waiting, in arrival order
+        self._next_ticket = 0
+
+    def daily_usage(self):
+        row = self.pool.fetchone("SELECT requests, tokens FROM gemini_key_usage WHERE api_key_hash = ? AND day = ?",
+                                 (self.api_key_hash, _quota_day()))
+        return (row[0], row[1]) if row else (0, 0)
+
+    def _record_daily(self, requests, tokens):
+        self.pool.execute("""
+            INSERT INTO gemini_key_usage (api_key_hash, day, requests, tokens) VALUES (?, ?, ?, ?)
+            ON CONFLICT(api_key_hash, day) DO UPDATE SET requests = requests + excluded.requests, tokens = tokens + excluded.tokens""",
+            (self.api_key_hash, _quota_day(), requests, tokens))
+
+    def _seconds_until_admitted(self, estimated_tokens):
+        return max(self.requests.seconds_until(1), self.tokens.seconds_until(estimated_tokens))
+
+    def acquire(self, estimated_tokens, on_wait=None, max_wait_seconds=MAX_QUEUE_WAIT_SECONDS, cancel=None):
+        """Block until this request may be sent. on_wait(position, seconds) is called while queued.
+
+        Raises RequestCancelledError, without taking a slot, once the `cancel` Event is set.
+        """
+        if self.daily_usage()[0] >= GEMINI_RPD_LIMIT:
+            raise DailyQuotaExceededError(f"API key đã dùng hết {GEMINI_RPD_LIMIT} lượt gọi Gemini của hôm nay.")
+        deadline = time.monotonic() + max_wait_seconds
+        with self._cond:
+            if len(self._queue) >= MAX_QUEUED_REQUESTS:
+                raise SchedulerBusyError("Hệ thống đang có quá nhiều câu hỏi chờ xử lý, vui lòng thử lại sau ít phút.")
+            ticket = self._next_ticket; self._next_ticket += 1
+            self._queue.append(ticket)
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelledError("Yêu cầu Gemini đã bị huỷ.")
+                with self._cond:
+                    position = self._queue.index(ticket)
+                    wait_seconds = self._seconds_until_admitted(estimated_tokens)
+                    if position == 0 and wait_seconds <= 0:
+                        self.requests.consume(1); self.tokens.consume(estimated_tokens)
+                        self._queue.pop(0); self._cond.notify_all()
+                        break
+                    if position > 0:
+                        wait_seconds += position * 60.0 / GEMINI_RPM_LIMIT  # Rough: one request slot per caller ahead
+                if time.monotonic() + min(wait_seconds, QUEUE_POLL_SECONDS) > deadline:
+                    raise SchedulerBusyError("Đã chờ quá lâu để gọi Gemini, vui lòng thử lại sau ít phút.")
+                if on_wait: on_wait(position + 1, wait_seconds)
+                with self._cond:
+                    self._cond.wait(timeout=min(max(wait_seconds, 0.05), QUEUE_POLL_SECONDS))
+        except BaseException:
+            with self._cond:
+                if ticket in self._queue:
+                    self._queue.remove(ticket); self._cond.notify_all()
+            raise
+        self._record_daily(1, 0)
+
+    def try_acquire(self, estimated_tokens):
+        """Non-blocking acquire for background work: never jumps ahead of queued callers."""
+        with self._cond:
+            if self._queue or self._seconds_until_admitted(estimated_tokens) > 0:
+                return False
+            if self.daily_usage()[0] >= GEMINI_RPD_LIMIT:
+                return False
+            self.requests.consume(1); self.tokens.consume(estimated_tokens)
+        self._record_daily(1, 0)
+        return True
+
+    def record_usage(self, actual_tokens, estimated_tokens):
+        actual_tokens = actual_tokens if actual_tokens is not None else estimated_tokens
+        with self._cond:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+        self._record_daily(0, actual_tokens)
+
+def get_limiter(pool, api_key_value):
+    key_hash = file_registry.hash_api_key(api_key_value or "")
+    with _LIMITERS_GUARD:
+        limiter = _LIMITERS.get(key_hash)
+        if limiter is None:
+            limiter = _LIMITERS[key_hash] = KeyRateLimiter(pool, key_hash)
+        return limiter
+
+def set_file_token_estimate(file_uri, tokens):
+    if tokens: _FILE_TOKEN_ESTIMATES[file_uri] = tokens
+
+def estimate_tokens(contents):
+    chars = 0; file_tokens = 0
+    for content in contents or []:
+        if isinstance(content, str):
+            chars += len(content); continue
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "text", None): chars += len(part.text)
+            elif getattr(part, "file_data", None):
+                file_tokens += _FILE_TOKEN_ESTIMATES.get(part.file_data.file_uri, FILE_PART_TOKEN_ESTIMATE)
+    return chars // CHARS_PER_TOKEN + file_tokens + 1
+
+# --- Retries ---
+def is_retryable(error):
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return True
+    try:
+        from google.api_core import exceptions as api_core_exceptions
+        if isinstance(error, (api_core_exceptions.ResourceExhausted, api_core_exceptions.ServiceUnavailable,
+                              api_core_exceptions.InternalServerError, api_core_exceptions.DeadlineExceeded)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import httpx
+        if isinstance(error, httpx.TransportError): return True
+    except ImportError:
+        pass
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def _server_retry_delay(error):
+    # 429 responses carry a google.rpc.RetryInfo detail such as {"retryDelay": "27s"}.
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        details = (details.get("error") or {}).get("details")
+    for detail in details if isinstance(details, list) else []:
+        delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
+            try: return float(delay[:-1])
+            except ValueError: pass
+    return None
+
+def backoff_delay(attempt, error=None):
+    # Full jitter, but never shorter than the delay the server asked for.
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+    server_delay = _server_retry_delay(error) if error is not None else None
+    return min(max(delay, server_delay or 0), BACKOFF_MAX_SECONDS * 2)
+
+def call_with_retry(operation, on_retry=None, max_retries=MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            return operation()
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_retries: raise
+            delay = backoff_delay(attempt, e)
+            if on_retry: on_retry(attempt + 1, delay, e)
+            time.sleep(delay)
+
+# --- Streaming ---
+def _chunk_text(chunk):
+    # Joined by hand: chunk.text logs a warning for every chunk that also carries a function call.
+    candidates = getattr(chunk, "candidates", None)
+    content = getattr(candidates[0], "content", None) if candidates else None
+    return "".join(part.text for part in (getattr(content, "parts", None) or []) if getattr(part, "text", None) and not getattr(part, "thought", None))
+
+def _usage_tokens(chunk):
+    usage = getattr(chunk, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
+
+def _strip_overlap(produced, continuation):
+    # The resumed answer sometimes repeats the end of what was already shown.
+    for size in range(min(len(produced), len(continuation), RESUME_OVERLAP_CHARS), 10, -1):
+        if produced.endswith(continuation[:size]):
+            return continuation[size:]
+    return continuation
+
+def _resume_contents(contents, produced):
+    from google.genai import types as google_genai_types  # Deferred: the SDK is slow to import
+    return list(contents) + [
+        google_genai_types.Content(role="model", parts=[google_genai_types.Part.from_text(text=produced)]),
+        google_genai_types.Content(role="user", parts=[google_genai_types.Part.from_text(text=RESUME_PROMPT)]),
+    ]
+
+def stream_generate_content(client, pool, api_key_value, model, contents, config, on_wait=None, on_retry=None, resume_from="",
+                            max_retries=MAX_RETRIES, preacquired=False, cancel=None):
+    """Yield (text, chunk) pairs from a rate-limited, retried generate_content_stream call.
+
+    chunk is None for text released after a resumed stream's overlap check. Errors that are not
+    retryable (or persist after max_retries) are raised to the caller. `resume_from` is an answer
+    cut short earlier (e.g. by a crash): only its continuation is yielded. `preacquired`: the first
+    attempt was already admitted with the key's limiter (try_acquire), so it is not queued again.
+    `cancel`: a threading.Event; once set, the stream ends without queueing for, or sending, another
+    attempt (a retry backoff is cut short).
+    """
+    limiter = get_limiter(pool, api_key_value)
+    estimated_tokens = estimate_tokens(contents)
+    produced = resume_from or ""
+    request_contents = _resume_contents(contents, produced) if produced else contents
+    for attempt in range(max_retries + 1):
+        if cancel is not None and cancel.is_set(): return
+        if attempt or not preacquired:
+            try: limiter.acquire(estimated_tokens, on_wait=on_wait, cancel=cancel)
+            except RequestCancelledError: return
+        usage_tokens = None; pending = ""; overlap_checked = not produced
+        try:
+            for chunk in client.models.generate_content_stream(model=model, contents=request_contents, config=config):
+                usage_tokens = _usage_tokens(chunk) or usage_tokens
+                text = _chunk_text(chunk)
+                if not overlap_checked:
+                    pending += text
+                    if len(pending) < RESUME_OVERLAP_CHARS:
+                        yield "", chunk
+                        continue
+                    text = _strip_overlap(produced, pending); overlap_checked = True
+                produced += text
+                yield text, chunk
+            if not overlap_checked and pending:
+                text = _strip_overlap(produced, pending); produced += text
+                yield text, None
+            limiter.record_usage(usage_tokens, estimated_tokens)
+            return
+        except Exception as e:
+            limiter.record_usage(usage_tokens, estimated_tokens)
+            if not is_retryable(e) or attempt == max_retries: raise
+            delay = backoff_delay(attempt, e)
+            if on_retry: on_retry(attempt + 1, delay, e)
+            if cancel is not None:
+                if cancel.wait(delay): return
+            else: time.sleep(delay)
+            if produced:
+                request_contents = _resume_contents(contents, produced)
@@ -0,0 +1,120 @@
+import threading
+
+import gemini_scheduler
+
+# --- Conversation History Manager ---
+# The prompt carries the last HISTORY_VERBATIM_TURNS turns verbatim, trimmed to a token budget,
+# plus a running summary of everything older that is stored on the session row. Messages that
+# fall out of the verbatim window are folded into the summary in the background, one batch at a
+# time on top of the previous summary (until a fold covers them they stay in the verbatim part,
+# budget permitting), so the prompt size stays bounded however long the session gets and the
+# user never waits on a summarization call. Fold batches are read from the messages table, so
+# turns that were never paged into the UI are summarized as well.
+
+HISTORY_TOKEN_BUDGET = 6000
+HISTORY_VERBATIM_TURNS = 4
+SUMMARY_MAX_WORDS = 250
+FOLD_BATCH_MESSAGES = 40  # Larger backlogs are folded over several turns
+CHARS_PER_TOKEN = 3  # Conservative for Vietnamese text with diacritics
+
+_FOLD_LOCKS = {}
+_FOLD_LOCKS_GUARD = threading.Lock()
+
+def init_history_columns(cursor):
+    cursor.execute("PRAGMA table_info(sessions)")
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    if "history_summary" not in existing_columns:
+        cursor.execute("ALTER TABLE sessions ADD COLUMN history_summary TEXT")
+    if "summary_through_seq" not in existing_columns:
+        cursor.execute("ALTER TABLE sessions ADD COLUMN summary_through_seq INTEGER NOT NULL DEFAULT 0")
+
+def estimate_tokens(text):
+    return len(text or "") // CHARS_PER_TOKEN + 1
+
+def load_summary(pool, session_id):
+    row = pool.fetchone("SELECT history_summary, summary_through_seq FROM sessions WHERE id = ?", (session_id,))
+    if not row: return "", 0
+    return row[0] or "", row[1] or 0
+
+def _save_summary(pool, session_id, summary, through_seq, previous_through_seq):
+    # Only advance from the state the summary was computed on (another worker may have folded already).
+    pool.execute("UPDATE sessions SET history_summary = ?, summary_through_seq = ? WHERE id = ? AND summary_through_seq = ?",
+                 (summary, through_seq, session_id, previous_through_seq))
+
+def select_history(chat_history, summary, through_seq, token_budget=HISTORY_TOKEN_BUDGET, verbatim_turns=HISTORY_VERBATIM_TURNS,
+                   older_history_unloaded=False):
+    """Split chat_history into (verbatim tail, seq before which messages should be folded, or None).
+
+    Folding starts at the last verbatim_turns turns, but messages before them that the summary does
+    not cover yet stay in the tail (within the token budget) until a fold has taken them in.
+    """
+    unsummarized = [m for m in chat_history if m.get("seq", through_seq + 1) > through_seq]
+    tail = []; used_tokens = estimate_tokens(summary) if summary else 0
+    window = None  # Number of tail messages in the last verbatim_turns turns
+    for msg in reversed(unsummarized):
+        cost = estimate_tokens(msg.get("content", ""))
+        if tail and used_tokens + cost > token_budget:
+            break
+        if window is None and len(tail) >= verbatim_turns * 2:
+            window = len(tail)
+        tail.append(msg); used_tokens += cost
+    tail.reverse()
+    if window is None: window = len(tail)
+    has_older = len(unsummarized) > window or (older_history_unloaded and bool(chat_history) and len(unsummarized) == len(chat_history))
+    fold_before_seq = tail[-window].get("seq") if window and has_older else None
+    return tail, fold_before_seq
+
+def _load_fold_batch(pool, session_id, through_seq, before_seq):
+    rows = pool.fetchall("""
+        SELECT rowid, role, content FROM messages
+        WHERE session_id = ? AND rowid > ? AND rowid < ?
+        ORDER BY timestamp ASC, rowid ASC LIMIT ?""", (session_id, through_seq, before_seq, FOLD_BATCH_MESSAGES))
+    return [{"seq": r[0], "role": r[1], "content": r[2]} for r in rows]
+
+def _summarize(client, model, previous_summary, messages):
+    transcript = "\n".join(f"{'Người dùng' if m['role'] == 'user' else 'Trợ lý'}: {m.get('content', '')}" for m in messages)
+    prompt = (
+        "Bạn đang duy trì bản tóm tắt của một cuộc trò chuyện về giao thông công cộng TP.HCM.\n"
+        f"Bản tóm tắt hiện tại:\n{previous_summary or '(chưa có)'}\n\n"
+        f"Các lượt hội thoại mới cần gộp vào:\n{transcript}\n\n"
+        f"Hãy viết lại bản tóm tắt đã cập nhật (tối đa {SUMMARY_MAX_WORDS} từ), giữ lại các chi tiết quan trọng như "
+        "tuyến, ga, trạm, giá vé, giờ hoạt động, địa điểm và nhu cầu của người dùng. Chỉ trả về bản tóm tắt."
+    )
+    response = client.models.generate_content(model=model, contents=prompt)
+    return (getattr(response, "text", None) or "").strip() or None
+
+def fold_history(client, model, pool, session_id, fold_before_seq, api_key_value=None):
+    with _FOLD_LOCKS_GUARD:
+        lock = _FOLD_LOCKS.setdefault(session_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return  # A fold for this session is already running; the next turn picks up the rest
+    try:
+        summary, through_seq = load_summary(pool, session_id)
+        pending = _load_fold_batch(pool, session_id, through_seq, fold_before_seq)
+        if not pending: return
+        if api_key_value is not None:
+            # Background work never waits for quota; the fold is retried on a later turn.
+            estimated_tokens = (len(summary) + sum(len(m["content"]) for m in pending)) // CHARS_PER_TOKEN + SUMMARY_MAX_WORDS * 2
+            if not gemini_scheduler.get_limiter(pool, api_key_value).try_acquire(estimated_tokens): return
+        new_summary = _summarize(client, model, summary, pending)
+        if new_summary:
+            _save_summary(pool, session_id, new_summary, max(m["seq"] for m in pending), through_seq)
+    except Exception:
+        pass  # Retried with a larger batch on a later turn
+    finally:
+        lock.release()
+
+def build_history(client, model, pool, session_id, chat_history, token_budget=HISTORY_TOKEN_BUDGET, verbatim_turns=HISTORY_VERBATIM_TURNS,
+                  older_history_unloaded=False, api_key_value=None):
+    """Return (summary, verbatim tail) for the prompt and start folding older turns in the background.
+
+    chat_history may be only the most recent page of the session; pass older_history_unloaded=True
+    when earlier messages exist in the DB but were not loaded. With api_key_value, background folds
+    only run when the key's rate limiter has spare capacity.
+    """
+    summary, through_seq = load_summary(pool, session_id)
+    tail, fold_before_seq = select_history(chat_history, summary, through_seq, token_budget, verbatim_turns, older_history_unloaded)
+    if fold_before_seq:
+        threading.Thread(target=fold_history, args=(client, model, pool, session_id, fold_before_seq, api_key_value),
+                         name="history-fold", daemon=True).start()
+    return summary, tail
@@ -0,0 +1,318 @@
+import argparse
+import collections
+import gzip
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from pathlib import Path
+
+from retrieval import BUILD_FAILURE_BACKOFF_SECONDS, INDEX_DIR, fold_diacritics
+
+# --- Intent Classifier ---
+# A small in-process classifier run before the Gemini call: greetings, thanks/goodbyes, off-topic
+# and abusive messages get a templated Vietnamese reply without spending a request. Features are
+# hashed character 2-4-grams and words of the diacritic-folded text (so "gia ve" and "giá vé"
+# match), the model is a multinomial logistic regression trained offline on data/intent_train.tsv
+# and stored next to the retrieval index. Scoring a message is a few hundred dict lookups, well
+# under a millisecond. Anything below the confidence threshold, long, or "transit" goes to Gemini.
+#
+#   python intent_classifier.py train
+#   python intent_classifier.py eval                 # per-label precision/recall on data/intent_eval.tsv
+#   python intent_classifier.py classify "xin chào"
+
+MODEL_FORMAT_VERSION = 1
+MODEL_FILENAME = "intent_classifier.json.gz"
+TRAIN_DATA_PATH = Path("data") / "intent_train.tsv"
+EVAL_DATA_PATH = Path("data") / "intent_eval.tsv"
+
+LABELS = ("transit", "greeting", "thanks", "off_topic", "abusive")
+PASS_THROUGH_LABEL = "transit" # Always answered by Gemini
+CONTEXT_FREE_LABELS = ("greeting", "thanks", "abusive") # Routed even mid-conversation; off-topic follow-ups may need the context
+CONFIDENCE_THRESHOLD = 0.85
+ROUTE_MAX_CHARS = 200 # Longer messages always go to Gemini
+LATENCY_BUDGET_MS = 1.0
+
+FEATURE_BUCKETS = 1 << 18
+CHAR_NGRAM_SIZES = (2, 3, 4)
+TRAIN_EPOCHS = 40
+LEARNING_RATE = 0.5
+L2_PENALTY = 1e-5
+STATS_WINDOW = 1000 # Most recent classifications used for latency percentiles
+
+RESPONSES = {
+    "greeting": ("Xin chào! Mình là trợ lý giao thông công cộng nội thành TP.HCM. Bạn có thể hỏi mình về tuyến metro số 1, "
+                 "các tuyến xe buýt, buýt đường sông, xe đạp công cộng, giá vé, giờ chạy hoặc cách đi từ điểm A đến điểm B, "
+                 "ví dụ: \"Đi từ Bến Thành đến Suối Tiên thế nào?\""),
+    "thanks": ("Rất vui được giúp bạn! Nếu cần thêm thông tin về metro, xe buýt, buýt đường sông hay xe đạp công cộng "
+               "ở TP.HCM, bạn cứ hỏi nhé."),
+    "off_topic": ("Xin lỗi, mình chỉ hỗ trợ các câu hỏi về giao thông công cộng khu vực nội thành TP.HCM. Bạn có thể hỏi, "
+                  "chẳng hạn: \"Giá vé metro số 1 bao nhiêu?\", \"Xe buýt số 19 đi qua những đâu?\" hoặc "
+                  "\"Buýt đường sông chạy mấy giờ?\""),
+    "abusive": ("Mình rất tiếc nếu câu trả lời trước chưa làm bạn hài lòng. Mình sẵn sàng giúp nếu bạn cho biết bạn cần "
+                "thông tin gì về giao thông công cộng TP.HCM, ví dụ tuyến xe buýt, metro, buýt đường sông hay giá vé."),
+}
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_LOADED_MODELS = {}
+_LOAD_LOCK = threading.Lock()
+_BUILD_THREADS = {}
+_BUILD_FAILED_UNTIL = {}
+_SIGNATURE_CACHE = {}  # str(train_path) -> ((mtime_ns, size) or None when missing, signature)
+_STATS_LOCK = threading.Lock()
+_STATS = {"classified": 0, "no_model": 0, "over_budget": 0, "routed": collections.Counter(), "passed": collections.Counter(),
+          "latencies_ms": collections.deque(maxlen=STATS_WINDOW)}
+
+IntentDecision = collections.namedtuple("IntentDecision", "label confidence response")
+
+# --- Features ---
+def normalize(text):
+    words = _WORD_RE.findall(unicodedata.normalize("NFC", text).lower())
+    return words, [fold_diacritics(w) for w in words]
+
+def _bucket(feature):
+    return zlib.crc32(feature.encode("utf-8")) % FEATURE_BUCKETS # Stable across processes, unlike hash()
+
+def extract_features(text):
+    """Return {bucket: value} for one message, L2-normalized."""
+    words, folded = normalize(text)
+    features = [f"w:{w}" for w in folded]
+    features.extend(f"a:{w}" for w, f in zip(words, folded) if w != f)
+    features.extend(f"b:{a}_{b}" for a, b in zip(folded, folded[1:]))
+    padded = f" {' '.join(folded)} "
+    for n in CHAR_NGRAM_SIZES:
+        features.extend(f"c{n}:{padded[i:i + n]}" for i in range(len(padded) - n + 1))
+    features.append(f"len:{min(len(words), 8)}") # Greetings and thanks are short
+    counts = collections.Counter(_bucket(f) for f in features)
+    norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+    return {bucket: v / norm for bucket, v in counts.items()}
+
+# --- Training ---
+def load_labeled(path):
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            label, _, text = line.rstrip("\n").partition("\t")
+            if line_number == 1 and label == "label": continue # Header
+            if not text.strip(): continue
+            if label not in LABELS: raise ValueError(f"{path}:{line_number}: unknown label {label!r}")
+            examples.append((label, text))
+    return examples
+
+def compute_training_signature(train_path=TRAIN_DATA_PATH):
+    # Called on every turn: the training file is only hashed again when its mtime or size changes.
+    train_path = Path(train_path)
+    try: stat = train_path.stat(); file_key = (stat.st_mtime_ns, stat.st_size)
+    except OSError: file_key = None
+    cached = _SIGNATURE_CACHE.get(str(train_path))
+    if cached and cached[0] == file_key:
+        return cached[1]
+    digest = hashlib.sha256(f"v{MODEL_FORMAT_VERSION}:{FEATURE_BUCKETS}:{CHAR_NGRAM_SIZES}:{LABELS}".encode("utf-8"))
+    if file_key is not None:
+        digest.update(train_path.read_bytes())
+    _SIGNATURE_CACHE[str(train_path)] = (file_key, digest.hexdigest())
+    return digest.hexdigest()
+
+def _softmax(scores):
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+def train(examples, epochs=TRAIN_EPOCHS, learning_rate=LEARNING_RATE, l2_penalty=L2_PENALTY, seed=0):
+    """Fit softmax regression with SGD (AdaGrad step sizes); returns (weights per label, biases)."""
+    vectors = [(LABELS.index(label), extract_features(text)) for label, text in examples]
+    weights = [collections.defaultdict(float) for _ in LABELS]
+    squared_gradients = [collections.defaultdict(float) for _ in LABELS]
+    biases = [0.0] * len(LABELS)
+    rng = random.Random(seed)
+    for _ in range(epochs):
+        rng.shuffle(vectors)
+        for target, features in vectors:
+            probabilities = _softmax([biases[k] + sum(weights[k][b] * v for b, v in features.items()) for k in range(len(LABELS))])
+            for k, probability in enumerate(probabilities):
+                error = probability - (1.0 if k == target else 0.0)
+                biases[k] -= learning_rate * 0.1 * error
+                for bucket, value in features.items():
+                    gradient = error * value + l2_penalty * weights[k][bucket]
+                    squared_gradients[k][bucket] += gradient * gradient
+                    weights[k][bucket] -= learning_rate * gradient / math.sqrt(squared_gradients[k][bucket] + 1e-8)
+    return [{b: w for b, w in label_weights.items() if abs(w) > 1e-6} for label_weights in weights], biases
+
+def build_model(train_path=TRAIN_DATA_PATH, index_dir=INDEX_DIR):
+    examples = load_labeled(train_path)
+    weights, biases = train(examples)
+    model_data = {
+        "version": MODEL_FORMAT_VERSION,
+        "training_signature": compute_training_signature(train_path),
+        "labels": list(LABELS),
+        "biases": biases,
+        "weights": [{str(b): round(w, 5) for b, w in label_weights.items()} for label_weights in weights],
+        "examples": len(examples),
+    }
+    index_dir = Path(index_dir); index_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_dir / (MODEL_FILENAME + ".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(model_data, f, separators=(",", ":"))
+    tmp_path.replace(index_dir / MODEL_FILENAME)
+    return len(examples)
+
+# --- Query time ---
+class IntentClassifier:
+    def __init__(self, model_data):
+        self.labels = tuple(model_data["labels"])
+        self.biases = model_data["biases"]
+        self.training_signature = model_data["training_signature"]
+        # bucket -> [(label index, weight)], so scoring touches only the message's own features
+        self.weights_by_bucket = collections.defaultdict(list)
+        for k, label_weights in enumerate(model_data["weights"]):
+            for bucket, weight in label_weights.items():
+                self.weights_by_bucket[int(bucket)].append((k, weight))
+
+    def probabilities(self, text):
+        scores = list(self.biases)
+        for bucket, value in extract_features(text).items():
+            for k, weight in self.weights_by_bucket.get(bucket, ()):
+                scores[k] += weight * value
+        return dict(zip(self.labels, _softmax(scores)))
+
+    def classify(self, text):
+        """Return (label, confidence)."""
+        label, confidence = max(self.probabilities(text).items(), key=lambda item: item[1])
+        return label, confidence
+
+def load_model(index_dir=INDEX_DIR, expected_signature=None):
+    """Return the process-wide IntentClassifier, or None when it is missing or stale."""
+    model_path = Path(index_dir) / MODEL_FILENAME
+    if not model_path.exists():
+        return None
+    cache_key = (str(model_path), model_path.stat().st_mtime_ns)
+    with _LOAD_LOCK:
+        model = _LOADED_MODELS.get(cache_key)
+        if model is None:
+            with gzip.open(model_path, "rt", encoding="utf-8") as f:
+                model_data = json.load(f)
+            if model_data.get("version") != MODEL_FORMAT_VERSION:
+                return None
+            model = IntentClassifier(model_data)
+            _LOADED_MODELS.clear(); _LOADED_MODELS[cache_key] = model
+    if expected_signature and model.training_signature != expected_signature:
+        return None
+    return model
+
+def ensure_model_built_async(train_path=TRAIN_DATA_PATH, index_dir=INDEX_DIR):
+    # Training takes a few seconds; until the model exists every message goes to Gemini. A failed
+    # build is not retried for BUILD_FAILURE_BACKOFF_SECONDS (returns None meanwhile).
+    if not Path(train_path).exists():
+        return None
+    key = str(index_dir)
+    with _LOAD_LOCK:
+        if _BUILD_FAILED_UNTIL.get(key, 0) > time.time():
+            return None
+        thread = _BUILD_THREADS.get(key)
+        if thread and thread.is_alive():
+            return thread
+        thread = threading.Thread(target=_build_in_background, args=(key, train_path, index_dir), name="intent-model-build", daemon=True)
+        _BUILD_THREADS[key] = thread
+    thread.start()
+    return thread
+
+def _build_in_background(key, train_path, index_dir):
+    try:
+        build_model(train_path, index_dir)
+    except Exception:
+        with _LOAD_LOCK: _BUILD_FAILED_UNTIL[key] = time.time() + BUILD_FAILURE_BACKOFF_SECONDS
+        raise  # Reported by the thread's excepthook, once per backoff period
+
+# --- Routing ---
+def route(model, text, has_history=False, threshold=CONFIDENCE_THRESHOLD):
+    """Return an IntentDecision when the message gets a templated reply, None when it goes to Gemini."""
+    if model is None:
+        with _STATS_LOCK: _STATS["no_model"] += 1
+        return None
+    if len(text) > ROUTE_MAX_CHARS:
+        with _STATS_LOCK: _STATS["passed"]["too_long"] += 1
+        return None
+    started = time.perf_counter()
+    label, confidence = model.classify(text)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    routed = (label != PASS_THROUGH_LABEL and confidence >= threshold
+              and (not has_history or label in CONTEXT_FREE_LABELS))
+    with _STATS_LOCK:
+        _STATS["classified"] += 1
+        _STATS["latencies_ms"].append(elapsed_ms)
+        if elapsed_ms > LATENCY_BUDGET_MS: _STATS["over_budget"] += 1
+        _STATS["routed" if routed else "passed"][label] += 1
+    return IntentDecision(label, confidence, RESPONSES[label]) if routed else None
+
+def routing_stats():
+    with _STATS_LOCK:
+        latencies = sorted(_STATS["latencies_ms"])
+        stats = {"classified": _STATS["classified"], "no_model": _STATS["no_model"], "over_budget": _STATS["over_budget"],
+                 "routed": dict(_STATS["routed"]), "passed": dict(_STATS["passed"])}
+    if latencies:
+        stats["p50_ms"] = round(latencies[int(0.50 * (len(latencies) - 1))], 3)
+        stats["p95_ms"] = round(latencies[int(0.95 * (len(latencies) - 1))], 3)
+    return stats
+
+# --- Evaluation ---
+def evaluate(model, examples, threshold=CONFIDENCE_THRESHOLD):
+    """Per-label precision/recall of the raw prediction, plus how routing at `threshold` behaves."""
+    per_label = {label: {"tp": 0, "fp": 0, "fn": 0} for label in LABELS}
+    routed_total = routed_correct = transit_routed = 0
+    latencies = []
+    for label, text in examples:
+        started = time.perf_counter()
+        predicted, confidence = model.classify(text)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if predicted == label: per_label[label]["tp"] += 1
+        else: per_label[predicted]["fp"] += 1; per_label[label]["fn"] += 1
+        if predicted != PASS_THROUGH_LABEL and confidence >= threshold:
+            routed_total += 1
+            routed_correct += predicted == label
+            transit_routed += label == PASS_THROUGH_LABEL
+    report = {"examples": len(examples), "labels": {}}
+    for label, c in per_label.items():
+        report["labels"][label] = {
+            "precision": round(c["tp"] / (c["tp"] + c["fp"]), 3) if c["tp"] + c["fp"] else None,
+            "recall": round(c["tp"] / (c["tp"] + c["fn"]), 3) if c["tp"] + c["fn"] else None}
+    report["accuracy"] = round(sum(c["tp"] for c in per_label.values()) / len(examples), 3) if examples else None
+    # The number that matters: of the messages answered from a template, how many deserved it.
+    report["routing"] = {"threshold": threshold, "routed": routed_total,
+                         "precision": round(routed_correct / routed_total, 3) if routed_total else None,
+                         "transit_questions_routed": transit_routed}
+    latencies.sort()
+    if latencies:
+        report["p50_ms"] = round(latencies[len(latencies) // 2], 3)
+        report["max_ms"] = round(latencies[-1], 3)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train, evaluate or query the local intent classifier.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument("--data", default=str(TRAIN_DATA_PATH))
+    eval_parser = subparsers.add_parser("eval")
+    eval_parser.add_argument("--data", default=str(EVAL_DATA_PATH))
+    eval_parser.add_argument("--threshold", type=float, default=CONFIDENCE_THRESHOLD)
+    classify_parser = subparsers.add_parser("classify")
+    classify_parser.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        print(f"Trained on {build_model(args.data)} examples into {INDEX_DIR / MODEL_FILENAME}")
+    else:
+        model = load_model()
+        if model is None:
+            raise SystemExit("Model not found, run: python intent_classifier.py train")
+        if args.command == "eval":
+            print(json.dumps(evaluate(model, load_labeled(args.data), args.threshold), indent=2, ensure_ascii=False))
+        else:
+            for label, probability in sorted(model.probabilities(args.text).items(), key=lambda item: -item[1]):
+                print(f"{probability:6.3f}  {label}")
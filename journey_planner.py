@@ -0,0 +1,352 @@
+import argparse
+import datetime
+import re
+import threading
+import time
+from collections import namedtuple
+
+import transit_kb
+
+# --- Journey Planner ---
+# Itineraries over the metro, bus and waterbus routes of the transit knowledge base, computed
+# locally and handed to Gemini as grounded context for "từ A đến B" questions. The documents give
+# headways and operating hours, not timetables, so the search is a frequency-based RAPTOR: one
+# round per boarded vehicle, boarding waits half a headway (the headway of the period the
+# passenger arrives in), and a route can only be boarded between its first and last departure.
+# Ride times are the route's end-to-end trip time split evenly over its listed stops, or derived
+# from its length; legs using assumed values are flagged as estimates. Stops of different modes
+# with the same name (after dropping "Bến xe", "Ga"...) are linked by a short walking transfer.
+# Alternatives are found by searching again without the first route of each itinerary found.
+
+MAX_RIDES = 4  # Vehicles per itinerary (3 transfers)
+MAX_ITINERARIES = 3
+ALTERNATIVE_SLACK_MINUTES = 60  # Alternatives arriving later than this after the best one are dropped
+TRANSFER_MINUTES = 5
+BUS_SPEED_KMH = 18.0
+DEFAULT_SEGMENT_MINUTES = 8.0
+DEFAULT_HEADWAY_MINUTES = 20.0
+DEFAULT_SERVICE_HOURS = ("05:00", "21:00")
+VIETNAM_TZ = datetime.timezone(datetime.timedelta(hours=7))
+_FACILITY_PREFIXES = ("ben xe buyt ", "ben xe ", "ben tau thuy ", "ben ", "ga ", "tram ")
+_INFINITY = float("inf")
+_JOURNEY_RE = re.compile(
+    r"(?:^|\s)(?:từ|tu)\s+(?P<origin>.+?)\s+(?:đến|tới|den|toi|về|ve|sang|ra|vô|vào)\s+(?P<destination>.+?)"
+    r"(?=\s+(?:bằng|bang|như thế nào|thế nào|the nao|nhu the nao|như nào|lúc|luc|vào lúc|trước|truoc|thì|thi|mất|mat|hết|het|đi|di)\b|\s*[?.!,;]|\s*$)",
+    re.IGNORECASE)
+_CLOCK_RE = re.compile(r"\b(?:lúc|luc|khoảng|khoang)?\s*(\d{1,2})\s*(?:h|:|giờ|gio)\s*(\d{2})?\b", re.IGNORECASE)
+# Times and amounts in "từ X đến Y" ("từ mấy giờ đến mấy giờ", "từ 7h đến 22h", "từ bao nhiêu đến bao nhiêu") are not places.
+_NOT_A_PLACE_RE = re.compile(
+    r"^(?:mấy|may|bao nhiêu|bao nhieu|bao lâu|bao lau|khi nào|khi nao|lúc nào|luc nao)\b"
+    r"|^[\d.,:]+\s*(?:h|giờ|gio|g|phút|phut|p|đồng|dong|đ|d|k|km|m|%)?\s*\d*\s*(?:sáng|sang|trưa|trua|chiều|chieu|tối|toi|đêm|dem)?$",
+    re.IGNORECASE)
+_QUESTION_PREFIX_RE = re.compile(r"^(?:làm sao|lam sao|cách|cach|muốn|muon|đi|di|tôi|toi|mình|minh)\b\s*", re.IGNORECASE)
+
+Pattern = namedtuple("Pattern", ["route_id", "mode", "label", "stops", "offsets", "first", "last", "headways", "estimated"])
+_Label = namedtuple("_Label", ["arrival", "kind", "data"])  # kind: "start" | "ride" | "walk"
+
+_NETWORKS = {}
+_NETWORKS_LOCK = threading.Lock()
+
+def parse_clock(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def format_clock(minutes):
+    minutes = int(round(minutes))
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+def core_name(search_name):
+    """'ben xe suoi tien' -> 'suoi tien'; names left with a single word keep their prefix ('ben thanh')."""
+    for prefix in _FACILITY_PREFIXES:
+        if search_name.startswith(prefix):
+            stripped = search_name[len(prefix):]
+            return stripped if len(stripped.split()) >= 2 else search_name
+    return search_name
+
+def _headway_windows(headways):
+    # [(start, end, minutes)] from a period note listing clock ranges ("6:00-8:00, 11:00-12:00"),
+    # and the headway for the rest of the day.
+    windows = []; default = None
+    for row in headways:
+        if row["min_minutes"] is None: continue
+        minutes = (row["min_minutes"] + row["max_minutes"]) / 2.0
+        ranges = re.findall(r"(\d{1,2}:\d\d)\s*-\s*(\d{1,2}:\d\d)", row["note"] or "")
+        if ranges: windows.extend((parse_clock(a), parse_clock(b), minutes) for a, b in ranges)
+        elif default is None: default = minutes
+    return windows, default
+
+class Network:
+    """Stop indexes, route patterns (both directions) and transfer edges, built once per KB."""
+
+    def __init__(self, exported):
+        self.stops = exported["stops"]
+        self.stop_index = {row["stop_id"]: i for i, row in enumerate(self.stops)}
+        routes = {row["route_id"]: row for row in exported["routes"]}
+        sequences = {}
+        for row in exported["route_stops"]:
+            sequences.setdefault(row["route_id"], []).append(self.stop_index[row["stop_id"]])
+        for row in exported["stop_connections"]:
+            # Feeder buses: the metro stations they serve, between their two terminals.
+            if row["route_id"] in sequences and self.stop_index[row["stop_id"]] not in sequences[row["route_id"]]:
+                sequences[row["route_id"]].insert(-1, self.stop_index[row["stop_id"]])
+        hours = {row["route_id"]: row for row in exported["hours"]}
+        headways = {}
+        for row in exported["headways"]:
+            headways.setdefault(row["route_id"], []).append(row)
+
+        self.patterns = []
+        for route_id, stops in sequences.items():
+            if len(stops) < 2 or route_id not in routes: continue
+            route = routes[route_id]
+            segment_minutes, estimated = self._segment_minutes(route, len(stops) - 1)
+            route_hours = hours.get(route_id)
+            first, last = (route_hours["first_departure"], route_hours["last_departure"]) if route_hours else DEFAULT_SERVICE_HOURS
+            windows, default_headway = _headway_windows(headways.get(route_id, []))
+            if default_headway is None and not windows:
+                default_headway = self._headway_from_trip_count(headways.get(route_id, []), first, last)
+                estimated = estimated or default_headway == DEFAULT_HEADWAY_MINUTES
+            label = f"{transit_kb.MODE_LABELS.get(route['mode'], route['mode'])} {route['code']}"
+            offsets = [segment_minutes * i for i in range(len(stops))]
+            for direction_stops in (stops, stops[::-1]):
+                self.patterns.append(Pattern(route_id, route["mode"], label, tuple(direction_stops), offsets, parse_clock(first), parse_clock(last),
+                                             (windows, default_headway), estimated or not route_hours))
+
+        self.patterns_by_stop = [[] for _ in self.stops]
+        for pattern_index, pattern in enumerate(self.patterns):
+            for position, stop in enumerate(pattern.stops):
+                self.patterns_by_stop[stop].append((pattern_index, position))
+        by_core = {}
+        for i, row in enumerate(self.stops):
+            by_core.setdefault(core_name(row["search_name"]), []).append(i)
+        self.transfers = [[] for _ in self.stops]
+        for group in by_core.values():
+            for a in group:
+                self.transfers[a].extend((b, TRANSFER_MINUTES) for b in group if b != a)
+
+    @staticmethod
+    def _segment_minutes(route, segments):
+        trip = [int(n) for n in re.findall(r"\d+", route["trip_minutes"] or "")]
+        if trip: return sum(trip) / len(trip) / segments, False
+        if route["length_km"]: return route["length_km"] / BUS_SPEED_KMH * 60.0 / segments, True
+        return DEFAULT_SEGMENT_MINUTES, True
+
+    @staticmethod
+    def _headway_from_trip_count(rows, first, last):
+        # "Có 4 chuyến đi và 4 chuyến về mỗi ngày": trips spread over the service hours.
+        for row in rows:
+            trips = re.search(r"(\d+) chuyến", row["note"] or "")
+            if trips and int(trips.group(1)) > 0:
+                return max(DEFAULT_HEADWAY_MINUTES, (parse_clock(last) - parse_clock(first)) / int(trips.group(1)))
+        return DEFAULT_HEADWAY_MINUTES
+
+    def headway_at(self, pattern, minute):
+        windows, default = pattern.headways
+        for start, end, minutes in windows:
+            if start <= minute % 1440 < end: return minutes
+        return default if default is not None else (windows[0][2] if windows else DEFAULT_HEADWAY_MINUTES)
+
+    def departure(self, pattern, position, ready_at):
+        """Expected departure from the stop at `position` for a passenger there at `ready_at`, or None."""
+        first = pattern.first + pattern.offsets[position]; last = pattern.last + pattern.offsets[position]
+        if ready_at > last: return None
+        return max(ready_at + self.headway_at(pattern, ready_at) / 2.0, first)
+
+    def resolve_place(self, text):
+        """Stop indexes whose name matches the text (exact core name first, then containment)."""
+        key = transit_kb.search_key(text)
+        if not key: return []
+        exact = [i for i, row in enumerate(self.stops) if row["search_name"] == key or core_name(row["search_name"]) == core_name(key)]
+        if exact: return exact
+        padded = f" {key} "
+        return [i for i, row in enumerate(self.stops) if padded in f" {row['search_name']} "]
+
+def get_network(kb):
+    """The Network of a loaded TransitKB, built on first use."""
+    cache_key = (kb.path, kb.corpus_signature)
+    with _NETWORKS_LOCK:
+        network = _NETWORKS.get(cache_key)
+        if network is None:
+            network = Network(kb.export_network())
+            _NETWORKS.clear(); _NETWORKS[cache_key] = network
+    return network
+
+# --- Search ---
+def _raptor(network, origins, depart_at, excluded_routes):
+    rounds = [[None] * len(network.stops)]
+    best = [_INFINITY] * len(network.stops)
+    marked = set()
+    for stop in origins:
+        rounds[0][stop] = _Label(depart_at, "start", None); best[stop] = depart_at; marked.add(stop)
+    for stop in list(marked):
+        for target, minutes in network.transfers[stop]:
+            if depart_at + minutes < best[target]:
+                rounds[0][target] = _Label(depart_at + minutes, "walk", (stop, minutes)); best[target] = depart_at + minutes; marked.add(target)
+
+    for ride in range(1, MAX_RIDES + 1):
+        previous = rounds[-1]; current = [None] * len(network.stops); rounds.append(current)
+        queue = {}
+        for stop in marked:
+            for pattern_index, position in network.patterns_by_stop[stop]:
+                if network.patterns[pattern_index].route_id in excluded_routes: continue
+                queue[pattern_index] = min(position, queue.get(pattern_index, position))
+        marked = set()
+        for pattern_index, start_position in queue.items():
+            pattern = network.patterns[pattern_index]
+            boarded = None  # (position, departure)
+            for position in range(start_position, len(pattern.stops)):
+                stop = pattern.stops[position]
+                if boarded is not None:
+                    arrival = boarded[1] + pattern.offsets[position] - pattern.offsets[boarded[0]]
+                    if arrival < best[stop]:
+                        current[stop] = _Label(arrival, "ride", (pattern_index, boarded[0], position, boarded[1]))
+                        best[stop] = arrival; marked.add(stop)
+                label = previous[stop]
+                if label is None: continue
+                departure = network.departure(pattern, position, label.arrival)
+                if departure is not None and (boarded is None or
+                                              departure < boarded[1] + pattern.offsets[position] - pattern.offsets[boarded[0]]):
+                    boarded = (position, departure)
+        for stop in list(marked):
+            for target, minutes in network.transfers[stop]:
+                arrival = current[stop].arrival + minutes
+                if arrival < best[target]:
+                    current[target] = _Label(arrival, "walk", (stop, minutes)); best[target] = arrival; marked.add(target)
+        if not marked: break
+    return rounds
+
+def _legs(network, rounds, ride_round, stop):
+    legs = []
+    while True:
+        label = rounds[ride_round][stop]
+        if label.kind == "start":
+            return legs[::-1]
+        if label.kind == "walk":
+            from_stop, minutes = label.data
+            legs.append({"mode": "walk", "from": network.stops[from_stop]["name"], "to": network.stops[stop]["name"], "minutes": minutes,
+                         "from_mode": network.stops[from_stop]["mode"], "to_mode": network.stops[stop]["mode"]})
+            stop = from_stop
+            continue
+        pattern_index, board_position, alight_position, departure = label.data
+        pattern = network.patterns[pattern_index]
+        board_stop = pattern.stops[board_position]
+        ready_at = rounds[ride_round - 1][board_stop].arrival
+        leg = {"mode": pattern.mode, "route": pattern.label, "route_id": pattern.route_id,
+               "from": network.stops[board_stop]["name"], "to": network.stops[stop]["name"],
+               "board_at": departure, "alight_at": label.arrival, "wait_minutes": departure - ready_at,
+               "ride_minutes": label.arrival - departure, "stops": [network.stops[s]["name"] for s in pattern.stops[board_position:alight_position + 1]]}
+        if pattern.estimated: leg["estimated"] = True
+        legs.append(leg)
+        stop = board_stop; ride_round -= 1
+
+def _itineraries(network, rounds, destinations, depart_at):
+    found = []; best_arrival = _INFINITY
+    for ride_round in range(1, len(rounds)):
+        candidates = [(rounds[ride_round][d].arrival, d) for d in destinations if rounds[ride_round][d] is not None]
+        if not candidates: continue
+        arrival, stop = min(candidates)
+        if arrival >= best_arrival: continue  # Dominated: as late, with more rides
+        best_arrival = arrival
+        legs = _legs(network, rounds, ride_round, stop)
+        rides = [leg for leg in legs if leg["mode"] != "walk"]
+        if not rides: continue
+        found.append({"depart_at": depart_at, "arrive_at": arrival, "duration_minutes": arrival - depart_at,
+                      "transfers": len(rides) - 1, "legs": legs})
+    return found
+
+def _bike_note(network, stop_name):
+    for row in network.stops:
+        if row["name"] == stop_name and "xe đạp công cộng" in (row["amenities"] or "").lower():
+            return f"Ga {stop_name} có trạm xe đạp công cộng (TNGO) cho chặng đầu/cuối."
+    return None
+
+def plan(network, origin, destination, depart_at=None, max_itineraries=MAX_ITINERARIES):
+    """Ranked itineraries between two place names; depart_at in minutes after midnight (default: now in Vietnam).
+
+    Returns {"origin_stops", "destination_stops", "itineraries"}; empty itineraries when a place is
+    unknown or no route connects them.
+    """
+    if depart_at is None:
+        now = datetime.datetime.now(VIETNAM_TZ); depart_at = now.hour * 60 + now.minute
+    origins = network.resolve_place(origin); destinations = set(network.resolve_place(destination))
+    result = {"origin_stops": [network.stops[i]["name"] for i in origins], "destination_stops": sorted(network.stops[i]["name"] for i in destinations),
+              "depart_at": depart_at, "itineraries": []}
+    if not origins or not destinations or destinations & set(origins):
+        return result
+    excluded_routes = set(); seen = set()
+    for _ in range(max_itineraries):
+        rounds = _raptor(network, origins, depart_at, excluded_routes)
+        found = _itineraries(network, rounds, destinations, depart_at)
+        if not found: break
+        for itinerary in found:
+            signature = tuple(leg.get("route_id") for leg in itinerary["legs"] if leg["mode"] != "walk")
+            if signature not in seen:
+                seen.add(signature); result["itineraries"].append(itinerary)
+        excluded_routes.add(next(leg["route_id"] for leg in found[0]["legs"] if leg["mode"] != "walk"))
+    result["itineraries"].sort(key=lambda it: (it["arrive_at"], it["transfers"]))
+    if result["itineraries"]:
+        latest = result["itineraries"][0]["arrive_at"] + ALTERNATIVE_SLACK_MINUTES
+        result["itineraries"] = [it for it in result["itineraries"] if it["arrive_at"] <= latest][:max_itineraries]
+    for itinerary in result["itineraries"]:
+        notes = [_bike_note(network, itinerary["legs"][0]["from"]), _bike_note(network, itinerary["legs"][-1]["to"])]
+        notes = [n for n in dict.fromkeys(notes) if n]
+        if notes: itinerary["notes"] = notes
+    return result
+
+# --- Questions and prompt context ---
+def parse_journey_question(text):
+    """(origin, destination, depart_at or None) for questions like "đi từ Bến Thành đến Thủ Đức lúc 7h30", else None."""
+    match = _JOURNEY_RE.search(text or "")
+    if not match:
+        return None
+    origin = _QUESTION_PREFIX_RE.sub("", match.group("origin").strip(" \"'"))
+    destination = match.group("destination").strip(" \"'")
+    if not origin or not destination or _NOT_A_PLACE_RE.search(origin) or _NOT_A_PLACE_RE.search(destination):
+        return None
+    clock = _CLOCK_RE.search(text[match.end("destination"):]) or _CLOCK_RE.search(text[:match.start()])
+    depart_at = None
+    if clock and int(clock.group(1)) < 24:
+        depart_at = int(clock.group(1)) * 60 + int(clock.group(2) or 0)
+    return origin, destination, depart_at
+
+def format_plan_for_prompt(result, origin, destination):
+    if not result["itineraries"]:
+        return None
+    lines = [f"Lộ trình gợi ý từ {origin} đến {destination}, tính bằng bộ lập lộ trình nội bộ trên dữ liệu tuyến trong tài liệu "
+             f"(khởi hành {format_clock(result['depart_at'])}; thời gian chờ và đi là ước tính theo giãn cách chuyến và thời gian hành trình, "
+             "không phải lịch chạy thực tế; dựa vào các phương án này khi chỉ đường và nói rõ thời gian chỉ là ước tính):"]
+    for number, itinerary in enumerate(result["itineraries"], 1):
+        lines.append(f"Phương án {number}: đến khoảng {format_clock(itinerary['arrive_at'])} ({round(itinerary['duration_minutes'])} phút, "
+                     f"{itinerary['transfers']} lần chuyển tuyến)")
+        for leg in itinerary["legs"]:
+            if leg["mode"] == "walk":
+                lines.append(f"  - Đi bộ chuyển từ {leg['from']} ({transit_kb.MODE_LABELS[leg['from_mode']]}) sang {leg['to']} "
+                             f"({transit_kb.MODE_LABELS[leg['to_mode']]}), khoảng {leg['minutes']} phút")
+            else:
+                via = f", qua {', '.join(leg['stops'][1:-1])}" if len(leg["stops"]) > 2 else ""
+                lines.append(f"  - {leg['route']}: lên tại {leg['from']} khoảng {format_clock(leg['board_at'])} (chờ ~{round(leg['wait_minutes'])} phút), "
+                             f"xuống tại {leg['to']} khoảng {format_clock(leg['alight_at'])}{via}" + (" [ước tính]" if leg.get("estimated") else ""))
+        lines.extend(f"  * {note}" for note in itinerary.get("notes", []))
+    return "\n".join(lines)
+
+def plan_for_prompt(kb, origin, destination, depart_at=None):
+    """Prompt context for a journey question, or None when the planner has no itinerary."""
+    result = plan(get_network(kb), origin, destination, depart_at)
+    return format_plan_for_prompt(result, origin, destination)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan a journey over the transit knowledge base.")
+    parser.add_argument("origin")
+    parser.add_argument("destination")
+    parser.add_argument("--at", default=None, help="Departure time HH:MM (default: now, Vietnam time)")
+    args = parser.parse_args()
+    kb = transit_kb.load_kb()
+    if kb is None:
+        raise SystemExit("Knowledge base not found, run: python transit_kb.py build")
+    started = time.perf_counter()
+    network = get_network(kb)
+    built = time.perf_counter()
+    result = plan(network, args.origin, args.destination, parse_clock(args.at) if args.at else None)
+    planned = time.perf_counter()
+    print(format_plan_for_prompt(result, args.origin, args.destination) or f"Không tìm thấy lộ trình ({result['origin_stops']} -> {result['destination_stops']}).")
+    print(f"\nNetwork {(built - started) * 1000:.1f} ms, plan {(planned - built) * 1000:.2f} ms "
+          f"({len(network.stops)} stops, {len(network.patterns)} route patterns)")
@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import db
+import message_search
+
+# --- Database Maintenance ---
+# chat_sessions.db only grows otherwise. A background thread (one per process, one run per
+# MAINTENANCE_INTERVAL_SECONDS across processes, claimed in maintenance_state) does four things:
+#   - archives sessions untouched for N days: their messages become one compressed JSON blob in
+#     session_archive and leave the messages table and its indexes, but stay in the search index
+#     (message_search.index_archived_messages); the session itself stays in the list, and
+#     load_messages() restores the messages when it is opened;
+#   - deletes messages whose session no longer exists (left by deletes made before foreign keys
+#     were enforced by db.CONNECTION_PRAGMAS);
+#   - returns free pages to the filesystem with incremental VACUUM, in small steps so writers are
+#     not blocked (databases created before auto_vacuum=INCREMENTAL are converted once by a full
+#     VACUUM when they are small enough, or by "python maintenance.py vacuum --full");
+#   - refreshes the query planner statistics with ANALYZE.
+# database_report() gives the file size, free space, archive totals and the health of each index.
+
+MAINTENANCE_INTERVAL_SECONDS = 24 * 3600
+MAINTENANCE_START_DELAY_SECONDS = 60 # Leaves the process start to the app
+MAINTENANCE_CHECK_SECONDS = 3600
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SESSIONS = 200 # Sessions archived per run; the rest wait for the next one
+ORPHAN_SCAN_ROWS = 5000 # Messages rowid range checked per transaction
+INCREMENTAL_VACUUM_PAGES = 256 # Pages released per transaction (1 MB at 4 KB pages)
+FULL_VACUUM_MAX_BYTES = 64 * 2**20 # Larger databases are only converted from the command line
+ANALYSIS_LIMIT = 1000 # Rows sampled per index by ANALYZE
+ARCHIVE_COLUMNS = ("rowid", "id", "role", "content", "timestamp", "gemini_grounding_metadata_json", "status")
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+_MAINTENANCE_LOCK = threading.Lock()
+_MAINTENANCE = {"thread": None}
+
+def init_maintenance_tables(cursor):
+    # payload is NULL once the session has been restored; restored_at keeps it from being archived again right away.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_archive (
+            session_id TEXT PRIMARY KEY,
+            archived_at INTEGER NOT NULL,
+            restored_at INTEGER,
+            message_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            payload BLOB,
+            FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE
+        ) ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_started_at INTEGER NOT NULL,
+            last_finished_at INTEGER,
+            last_result_json TEXT
+        ) ''')
+    cursor.execute("INSERT OR IGNORE INTO maintenance_state (id, last_started_at) VALUES (1, 0)")
+
+# --- Archive ---
+def _compress(raw):
+    try:
+        import zstandard
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(raw)
+    except ImportError:
+        return "zlib", zlib.compress(raw, 9)
+
+def _decompress(codec, payload):
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+def archive_session(pool, session_id, idle_before):
+    """Move the session's messages into session_archive if it is still idle; returns the messages archived."""
+    with pool.transaction() as conn:
+        # Checked again under the write lock: a turn may have started since the candidates were listed.
+        if conn.execute("SELECT 1 FROM sessions WHERE id = ? AND last_updated_at < ?", (session_id, idle_before)).fetchone() is None:
+            return 0
+        # The newest message stays: SQLite gives new rows MAX(rowid) + 1, so removing it would hand its rowid
+        # (still used by the archive and the search index) to the next message.
+        newest = conn.execute("SELECT session_id FROM messages ORDER BY rowid DESC LIMIT 1").fetchone()
+        if newest is not None and newest[0] == session_id:
+            return 0
+        rows = conn.execute(f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM messages WHERE session_id = ? ORDER BY timestamp, rowid",
+                            (session_id,)).fetchall()
+        if not rows: return 0
+        existing = conn.execute("SELECT payload IS NOT NULL FROM session_archive WHERE session_id = ?", (session_id,)).fetchone()
+        if existing and existing[0]:
+            rows = _archived_rows(conn, session_id) + rows # Written after it was archived, without opening it
+        raw = json.dumps({"columns": ARCHIVE_COLUMNS, "rows": rows}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        codec, payload = _compress(raw)
+        conn.execute('''
+            INSERT INTO session_archive (session_id, archived_at, restored_at, message_count, raw_bytes, codec, payload)
+            VALUES (?, ?, NULL, ?, ?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET archived_at = excluded.archived_at, restored_at = NULL,
+                message_count = excluded.message_count, raw_bytes = excluded.raw_bytes, codec = excluded.codec, payload = excluded.payload''',
+            (session_id, int(time.time()), len(rows), len(raw), codec, payload))
+        conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        message_search.index_archived_messages(conn, session_id, [(message[0], message[2], message[4], message[3]) for message in rows])
+        return len(rows)
+
+def _archived_rows(conn, session_id):
+    row = conn.execute("SELECT codec, payload FROM session_archive WHERE session_id = ? AND payload IS NOT NULL", (session_id,)).fetchone()
+    if row is None: return []
+    archive = json.loads(_decompress(row[0], row[1]))
+    return [[message[archive["columns"].index(name)] for name in ARCHIVE_COLUMNS] for message in archive["rows"]]
+
+def archived_message_contents(pool, session_id):
+    """{rowid: content} of the session's archived messages (for search snippets); empty once restored."""
+    with pool.connection() as conn:
+        return {message[0]: message[3] for message in _archived_rows(conn, session_id)}
+
+def index_archived_sessions(cursor):
+    # Sessions archived before their messages were kept in the search index (migration 5).
+    for (session_id,) in cursor.execute("SELECT session_id FROM session_archive WHERE payload IS NOT NULL").fetchall():
+        rows = _archived_rows(cursor, session_id)
+        message_search.index_archived_messages(cursor, session_id, [(message[0], message[2], message[4], message[3]) for message in rows])
+
+def archive_idle_sessions(pool, archive_after_days=ARCHIVE_AFTER_DAYS, limit=ARCHIVE_BATCH_SESSIONS):
+    """Archive up to `limit` sessions not updated (nor restored) for archive_after_days; returns (sessions, messages)."""
+    idle_before = int(time.time()) - archive_after_days * 86400
+    candidates = pool.fetchall('''
+        SELECT s.id FROM sessions s
+        LEFT JOIN session_archive a ON a.session_id = s.id
+        WHERE s.last_updated_at < ? AND COALESCE(a.restored_at, 0) < ?
+          AND EXISTS (SELECT 1 FROM messages m WHERE m.session_id = s.id)
+        ORDER BY s.last_updated_at LIMIT ?''', (idle_before, idle_before, limit))
+    archived_sessions = archived_messages = 0
+    for (session_id,) in candidates:
+        count = archive_session(pool, session_id, idle_before)
+        if count: archived_sessions += 1; archived_messages += count
+    return archived_sessions, archived_messages
+
+def has_archive(pool, session_id):
+    return pool.fetchone("SELECT 1 FROM session_archive WHERE session_id = ? AND payload IS NOT NULL", (session_id,)) is not None
+
+def restore_session(pool, session_id):
+    """Put an archived session's messages back into the messages table; returns the messages restored."""
+    if not has_archive(pool, session_id): return 0 # The common case: one primary key lookup, no write lock
+    with pool.transaction() as conn:
+        rows = _archived_rows(conn, session_id)
+        if not rows: return 0 # Restored by another request meanwhile
+        message_search.unindex_archived_messages(conn, session_id)
+        rowids = [message[0] for message in rows]
+        rowids_taken = conn.execute("SELECT COUNT(*) FROM messages WHERE rowid IN (SELECT value FROM json_each(?))",
+                                    (json.dumps(rowids),)).fetchone()[0]
+        if rowids_taken:
+            # Only possible when newer messages were deleted and SQLite reused their rowids. The messages get new
+            # rowids in the same order, and the history summary, which refers to the old ones, is rebuilt.
+            conn.executemany(f"INSERT INTO messages ({', '.join(ARCHIVE_COLUMNS[1:])}, session_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [tuple(message[1:]) + (session_id,) for message in rows])
+            conn.execute("UPDATE sessions SET history_summary = NULL, summary_through_seq = 0 WHERE id = ?", (session_id,))
+        else:
+            conn.executemany(f"INSERT INTO messages ({', '.join(ARCHIVE_COLUMNS)}, session_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [tuple(message) + (session_id,) for message in rows])
+        conn.execute("UPDATE session_archive SET payload = NULL, restored_at = ? WHERE session_id = ?", (int(time.time()), session_id))
+        return len(rows)
+
+# --- Cleanup and compaction ---
+def delete_orphaned_messages(pool, scan_rows=ORPHAN_SCAN_ROWS):
+    """Delete messages whose session is gone, walking the table by rowid in short transactions; returns the count."""
+    deleted = 0; after_rowid = 0
+    while True:
+        with pool.transaction() as conn:
+            last = conn.execute("SELECT MAX(rowid) FROM (SELECT rowid FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                                (after_rowid, scan_rows)).fetchone()[0]
+            if last is None: return deleted
+            deleted += conn.execute('''
+                DELETE FROM messages WHERE rowid > ? AND rowid <= ?
+                  AND NOT EXISTS (SELECT 1 FROM sessions s WHERE s.id = messages.session_id)''', (after_rowid, last)).rowcount
+        after_rowid = last
+
+def count_orphaned_messages(pool):
+    return pool.fetchone("SELECT COUNT(*) FROM messages m WHERE NOT EXISTS (SELECT 1 FROM sessions s WHERE s.id = m.session_id)")[0]
+
+def _pragma(pool, name):
+    return pool.fetchone(f"PRAGMA {name}")[0]
+
+def vacuum(pool, full=False, max_full_bytes=FULL_VACUUM_MAX_BYTES, step_pages=INCREMENTAL_VACUUM_PAGES):
+    """Release free pages; returns {"freed_pages", "full_vacuum"}.
+
+    With auto_vacuum=INCREMENTAL the free pages are released step_pages at a time. Otherwise (a
+    database created before) a full VACUUM, which also switches it to incremental, runs when
+    `full` is set or the file is at most max_full_bytes; it blocks writers while it runs.
+    """
+    freelist_before = _pragma(pool, "freelist_count")
+    page_size = _pragma(pool, "page_size")
+    if full or _pragma(pool, "auto_vacuum") != 2:
+        if not full and _pragma(pool, "page_count") * page_size > max_full_bytes:
+            return {"freed_pages": 0, "full_vacuum": False}
+        with pool.connection() as conn:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        return {"freed_pages": freelist_before, "full_vacuum": True}
+    while _pragma(pool, "freelist_count"):
+        with pool.connection() as conn:
+            # executescript steps the pragma to completion in its own transaction; execute() would free a single page.
+            conn.executescript(f"PRAGMA incremental_vacuum({int(step_pages)});")
+        time.sleep(0.01) # Lets waiting writers in between steps
+    return {"freed_pages": freelist_before, "full_vacuum": False}
+
+def analyze(pool, analysis_limit=ANALYSIS_LIMIT):
+    with pool.connection() as conn:
+        conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        conn.execute("ANALYZE")
+        conn.execute("PRAGMA analysis_limit = 0") # Back to the default on the pooled connection
+
+def checkpoint(pool):
+    # Truncates the WAL file after the vacuum; skipped (busy) while readers still use it.
+    with pool.connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+def run_maintenance(pool, archive_after_days=ARCHIVE_AFTER_DAYS, full_vacuum=False):
+    """One maintenance pass: archive, orphan cleanup, vacuum, ANALYZE. Returns what was done; also stored in maintenance_state."""
+    started = time.perf_counter()
+    result = {"archived_sessions": 0, "archived_messages": 0}
+    if archive_after_days:
+        result["archived_sessions"], result["archived_messages"] = archive_idle_sessions(pool, archive_after_days)
+    result["orphaned_messages_deleted"] = delete_orphaned_messages(pool)
+    result.update(vacuum(pool, full=full_vacuum))
+    analyze(pool)
+    checkpoint(pool)
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    pool.execute("UPDATE maintenance_state SET last_finished_at = ?, last_result_json = ? WHERE id = 1",
+                 (int(time.time()), json.dumps(result)))
+    return result
+
+def _claim_run(pool, interval_seconds):
+    # Compare-and-set on last_started_at, so one process runs the pass when several share the database.
+    now = int(time.time())
+    rowcount, _ = pool.execute("UPDATE maintenance_state SET last_started_at = ? WHERE id = 1 AND last_started_at <= ?",
+                               (now, now - interval_seconds))
+    return rowcount == 1
+
+def ensure_maintenance_async(pool, archive_after_days=ARCHIVE_AFTER_DAYS, interval_seconds=MAINTENANCE_INTERVAL_SECONDS):
+    # One background thread per process; it runs a pass whenever the last one (by any process) is older than the interval.
+    with _MAINTENANCE_LOCK:
+        if _MAINTENANCE["thread"] is not None and _MAINTENANCE["thread"].is_alive():
+            return
+        def run():
+            time.sleep(MAINTENANCE_START_DELAY_SECONDS)
+            while True:
+                try:
+                    if _claim_run(pool, interval_seconds): run_maintenance(pool, archive_after_days)
+                except Exception:
+                    pass # Retried at the next interval
+                time.sleep(min(MAINTENANCE_CHECK_SECONDS, interval_seconds))
+        _MAINTENANCE["thread"] = threading.Thread(target=run, name="db-maintenance", daemon=True)
+        _MAINTENANCE["thread"].start()
+
+# --- Report ---
+def database_report(pool, detailed=False):
+    """File size, free space and archive totals; with `detailed`, also row counts, orphans and per-index health (slower)."""
+    page_size = _pragma(pool, "page_size"); page_count = _pragma(pool, "page_count"); freelist = _pragma(pool, "freelist_count")
+    wal_path = f"{pool.db_path}-wal"
+    archive = pool.fetchone('''
+        SELECT COUNT(*), COALESCE(SUM(message_count), 0), COALESCE(SUM(raw_bytes), 0), COALESCE(SUM(LENGTH(payload)), 0)
+        FROM session_archive WHERE payload IS NOT NULL''')
+    last_run = pool.fetchone("SELECT last_finished_at, last_result_json FROM maintenance_state WHERE id = 1")
+    report = {
+        "file_bytes": page_count * page_size, "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        "page_size": page_size, "free_bytes": freelist * page_size, "free_ratio": round(freelist / page_count, 4) if page_count else 0.0,
+        "auto_vacuum": AUTO_VACUUM_MODES.get(_pragma(pool, "auto_vacuum"), "unknown"),
+        "archive": {"sessions": archive[0], "messages": archive[1], "raw_bytes": archive[2], "compressed_bytes": archive[3]},
+        "last_maintenance_at": last_run[0] if last_run else None,
+        "last_maintenance": json.loads(last_run[1]) if last_run and last_run[1] else None,
+    }
+    if not detailed: return report
+    report["sessions"] = pool.fetchone("SELECT COUNT(*) FROM sessions")[0]
+    report["messages"] = pool.fetchone("SELECT COUNT(*) FROM messages")[0]
+    report["orphaned_messages"] = count_orphaned_messages(pool)
+    report["foreign_key_violations"] = len(pool.fetchall("PRAGMA foreign_key_check"))
+    report["objects"] = object_sizes(pool)
+    return report
+
+def object_sizes(pool):
+    """Per table and index: pages, bytes, how full its pages are, and (for indexes) whether ANALYZE has statistics for it."""
+    try:
+        rows = pool.fetchall('''
+            SELECT name, COUNT(*), SUM(pgsize), SUM(pgsize - unused) FROM dbstat
+            WHERE pagetype IN ('internal', 'leaf', 'overflow') GROUP BY name''')
+    except sqlite3.OperationalError:
+        return None # SQLite built without the dbstat virtual table
+    schema = {name: (object_type, table) for object_type, name, table in pool.fetchall("SELECT type, name, tbl_name FROM sqlite_master")}
+    try: statistics = dict(pool.fetchall("SELECT idx, stat FROM sqlite_stat1 WHERE idx IS NOT NULL"))
+    except sqlite3.OperationalError: statistics = {} # Never analyzed
+    objects = []
+    for name, pages, size, used in rows:
+        object_type, table = schema.get(name, ("table", name)) # sqlite_schema itself is not listed
+        entry = {"name": name, "type": object_type, "table": table,
+                 "pages": pages, "bytes": size, "fill": round(used / size, 3) if size else 0.0}
+        if entry["type"] == "index": entry["statistics"] = statistics.get(name)
+        objects.append(entry)
+    return sorted(objects, key=lambda entry: -entry["bytes"])
+
+def integrity_problems(pool):
+    """PRAGMA quick_check findings; an empty list when the database is sound. Reads every page."""
+    return [row[0] for row in pool.fetchall("PRAGMA quick_check") if row[0] != "ok"]
+
+if __name__ == "__main__":
+    import chat_core
+    parser = argparse.ArgumentParser(description="Archive, clean up and compact the chat database.")
+    parser.add_argument("--db", default="chat_sessions.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="Database size, free space, archive totals and index health.")
+    report_parser.add_argument("--check", action="store_true", help="Also run PRAGMA quick_check (reads the whole file).")
+    run_parser = subparsers.add_parser("run", help="One maintenance pass, now.")
+    run_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="Archive sessions idle for this many days (0: none).")
+    archive_parser = subparsers.add_parser("archive", help="Archive idle sessions only.")
+    archive_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    archive_parser.add_argument("--limit", type=int, default=ARCHIVE_BATCH_SESSIONS)
+    restore_parser = subparsers.add_parser("restore", help="Restore one archived session.")
+    restore_parser.add_argument("session_id")
+    subparsers.add_parser("cleanup", help="Delete messages of deleted sessions.")
+    vacuum_parser = subparsers.add_parser("vacuum", help="Release free pages.")
+    vacuum_parser.add_argument("--full", action="store_true", help="Full VACUUM (blocks writers); converts older databases to incremental.")
+    args = parser.parse_args()
+    maintenance_pool = db.ConnectionPool(args.db, max_connections=2)
+    db.migrate(maintenance_pool, chat_core.SCHEMA_MIGRATIONS)
+
+    if args.command == "report":
+        report = database_report(maintenance_pool, detailed=True)
+        objects = report.pop("objects") or []
+        print(json.dumps(report, indent=2))
+        for entry in objects:
+            health = "" if entry["type"] != "index" else ("  analyzed: " + entry["statistics"] if entry["statistics"] else "  not analyzed")
+            print(f"{entry['type']:<6} {entry['name']:<45} {entry['bytes'] / 1024:>10.0f} KB  fill {entry['fill']:.0%}{health}")
+        if args.check: print("quick_check:", integrity_problems(maintenance_pool) or "ok")
+    elif args.command == "run":
+        print(run_maintenance(maintenance_pool, args.days, full_vacuum=False))
+    elif args.command == "archive":
+        print("Archived (sessions, messages):", archive_idle_sessions(maintenance_pool, args.days, args.limit))
+    elif args.command == "restore":
+        print(f"Restored {restore_session(maintenance_pool, args.session_id)} messages")
+    elif args.command == "cleanup":
+        print(f"Deleted {delete_orphaned_messages(maintenance_pool)} orphaned messages")
+    else:
+        print(vacuum(maintenance_pool, full=args.full))
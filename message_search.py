@@ -0,0 +1,241 @@
+import argparse
+import re
+import threading
+
+# --- Chat History Search ---
+# messages_fts is an FTS5 index over messages.content (rowid = messages.rowid), kept in sync by
+# triggers. The unicode61 tokenizer with remove_diacritics 2 matches "duong" with "đường" except
+# for đ, which Unicode does not decompose: the triggers index the text with đ/Đ replaced by d/D,
+# a one-for-one character swap, so the original text can be restored in the snippets. Databases
+# that already hold messages are indexed by a resumable backfill in small batches.
+# Archived messages (maintenance.archive_session) leave the messages table but not the index:
+# messages_fts_archived records the session, role and timestamp of each of their rowids, and
+# deleting those rows (a restore, or the session's deletion by cascade) removes them from the index.
+# Results are ranked by bm25 and paged with a (rank, rowid) keyset.
+
+SEARCH_PAGE_SIZE = 10
+SNIPPET_CHARS = 160
+BACKFILL_BATCH_SIZE = 2000
+HIGHLIGHT_OPEN = "\ue000"  # Private-use characters, never present in chat text
+HIGHLIGHT_CLOSE = "\ue001"
+_QUERY_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_BACKFILL_LOCK = threading.Lock()
+_BACKFILL = {"thread": None}
+
+def _fold_d_sql(expression):
+    return f"replace(replace({expression}, 'đ', 'd'), 'Đ', 'D')"
+
+def init_search_index(cursor):
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            tokenize = 'unicode61 remove_diacritics 2'
+        ) ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_after_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, {_fold_d_sql("new.content")});
+        END ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_after_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.rowid;
+        END ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_after_update AFTER UPDATE OF content ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.rowid;
+            INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, {_fold_d_sql("new.content")});
+        END ''')
+    # Rows that existed before the triggers; the backfill walks them by rowid from here.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages_fts_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_rowid INTEGER NOT NULL,
+            until_rowid INTEGER NOT NULL
+        ) ''')
+    cursor.execute('''INSERT OR IGNORE INTO messages_fts_backfill (id, last_rowid, until_rowid)
+                      SELECT 1, 0, COALESCE(MAX(rowid), 0) FROM messages''')
+
+def skip_streaming_updates(cursor):
+    # Once messages have a status column (turn_store), streaming checkpoints rewrite the assistant
+    # message every few seconds; only re-index it when the answer is final (or interrupted).
+    cursor.execute("DROP TRIGGER IF EXISTS messages_fts_after_update")
+    cursor.execute(f'''
+        CREATE TRIGGER messages_fts_after_update AFTER UPDATE OF content, status ON messages
+        WHEN new.status != 'streaming' BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.rowid;
+            INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, {_fold_d_sql("new.content")});
+        END ''')
+
+def init_archive_search(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages_fts_archived (
+            rowid INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            FOREIGN KEY (session_id) REFERENCES sessions (id) ON DELETE CASCADE
+        ) ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_fts_archived_session ON messages_fts_archived (session_id)")
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_archived_after_delete AFTER DELETE ON messages_fts_archived BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.rowid;
+        END ''')
+    # SQLite reuses the rowid of deleted messages when they were the newest: a new message then
+    # takes over the index row of the archived message that had it.
+    cursor.execute("DROP TRIGGER IF EXISTS messages_fts_after_insert")
+    cursor.execute(f'''
+        CREATE TRIGGER messages_fts_after_insert AFTER INSERT ON messages BEGIN
+            DELETE FROM messages_fts_archived WHERE rowid = new.rowid;
+            INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, {_fold_d_sql("new.content")});
+        END ''')
+
+def index_archived_messages(cursor, session_id, messages):
+    """Keep archived messages searchable after they left the messages table; messages: (rowid, role, timestamp, content)."""
+    messages = [message for message in messages
+                if cursor.execute("SELECT 1 FROM messages WHERE rowid = ?", (message[0],)).fetchone() is None]
+    cursor.executemany("INSERT OR REPLACE INTO messages_fts_archived (rowid, session_id, role, timestamp) VALUES (?, ?, ?, ?)",
+                       [(rowid, session_id, role, timestamp) for rowid, role, timestamp, _ in messages])
+    cursor.executemany("DELETE FROM messages_fts WHERE rowid = ?", [(message[0],) for message in messages])
+    cursor.executemany("INSERT INTO messages_fts (rowid, content) VALUES (?, ?)",
+                       [(rowid, content.replace("đ", "d").replace("Đ", "D")) for rowid, _, _, content in messages])
+
+def unindex_archived_messages(cursor, session_id):
+    # Before a restore: the messages are indexed again as they are inserted (possibly under new rowids).
+    cursor.execute("DELETE FROM messages_fts_archived WHERE session_id = ?", (session_id,))
+
+# --- Backfill ---
+def backfill_batch(pool, batch_size=BACKFILL_BATCH_SIZE):
+    """Index the next batch of pre-existing messages; returns the number of rows examined (0 when done)."""
+    with pool.transaction() as conn:
+        last_rowid, until_rowid = conn.execute("SELECT last_rowid, until_rowid FROM messages_fts_backfill WHERE id = 1").fetchone()
+        rows = conn.execute("SELECT rowid FROM messages WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?",
+                            (last_rowid, until_rowid, batch_size)).fetchall()
+        if not rows:
+            if last_rowid < until_rowid:
+                conn.execute("UPDATE messages_fts_backfill SET last_rowid = until_rowid WHERE id = 1")
+            return 0
+        batch_last_rowid = rows[-1][0]
+        # Rows rewritten since the triggers exist are already indexed; skip them.
+        conn.execute(f'''
+            INSERT INTO messages_fts (rowid, content)
+            SELECT m.rowid, {_fold_d_sql("m.content")} FROM messages m
+            WHERE m.rowid > ? AND m.rowid <= ?
+              AND NOT EXISTS (SELECT 1 FROM messages_fts f WHERE f.rowid = m.rowid)''', (last_rowid, batch_last_rowid))
+        conn.execute("UPDATE messages_fts_backfill SET last_rowid = ? WHERE id = 1", (batch_last_rowid,))
+        return len(rows)
+
+def backfill(pool, batch_size=BACKFILL_BATCH_SIZE):
+    """Run the backfill to completion, one short transaction per batch; returns the rows examined."""
+    total = 0
+    while True:
+        examined = backfill_batch(pool, batch_size)
+        if not examined: return total
+        total += examined
+
+def backfill_progress(pool):
+    """Return (indexed_up_to_rowid, until_rowid); equal once the backfill has finished."""
+    row = pool.fetchone("SELECT last_rowid, until_rowid FROM messages_fts_backfill WHERE id = 1")
+    return (row[0], row[1]) if row else (0, 0)
+
+def ensure_backfill_async(pool):
+    # One background backfill per process; a no-op once the index has caught up.
+    last_rowid, until_rowid = backfill_progress(pool)
+    if last_rowid >= until_rowid:
+        return
+    with _BACKFILL_LOCK:
+        if _BACKFILL["thread"] is not None and _BACKFILL["thread"].is_alive():
+            return
+        def run():
+            try: backfill(pool)
+            except Exception: pass  # Resumes from the stored cursor on the next start
+        _BACKFILL["thread"] = threading.Thread(target=run, name="messages-fts-backfill", daemon=True)
+        _BACKFILL["thread"].start()
+
+# --- Search ---
+def build_match_query(text):
+    """Turn user input into an FTS5 query: every word required, the last one as a prefix."""
+    tokens = _QUERY_TOKEN_RE.findall(text.replace("đ", "d").replace("Đ", "D"))
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def _restore_original(highlighted, original):
+    # highlight() returns the indexed (đ-folded) text with markers; copy the characters back from
+    # the original, which has the same length.
+    restored = []; position = 0
+    for char in highlighted:
+        if char in (HIGHLIGHT_OPEN, HIGHLIGHT_CLOSE):
+            restored.append(char)
+        else:
+            restored.append(original[position] if position < len(original) else char)
+            position += 1
+    return "".join(restored)
+
+def make_snippet(highlighted, original, max_chars=SNIPPET_CHARS):
+    """A window of the message around the first match, as Markdown with the matches in bold."""
+    text = _restore_original(highlighted, original)
+    text = " ".join(text.split())
+    first_match = text.find(HIGHLIGHT_OPEN)
+    start = max(0, first_match - max_chars // 3) if first_match > 0 else 0
+    end = min(len(text), start + max_chars)
+    window = text[start:end]
+    # Keep markers balanced when the window cuts through a highlighted word.
+    if window.count(HIGHLIGHT_OPEN) > window.count(HIGHLIGHT_CLOSE): window += HIGHLIGHT_CLOSE
+    if window.count(HIGHLIGHT_CLOSE) > window.count(HIGHLIGHT_OPEN): window = HIGHLIGHT_OPEN + window
+    window = re.sub(r"([*_`\[\]<>#])", r"\\\1", window)
+    window = window.replace(HIGHLIGHT_OPEN, "**").replace(HIGHLIGHT_CLOSE, "**").replace("****", "")
+    return ("…" if start > 0 else "") + window + ("…" if end < len(text) else "")
+
+def search_messages(pool, user_email, text, limit=SEARCH_PAGE_SIZE, after=None):
+    """Return (results, next_cursor) for the user's messages matching `text`, best matches first.
+
+    `after` is the next_cursor of the previous page: a (rank, rowid) keyset. Messages of archived
+    sessions are found too; their text is read back from the archive for the snippet.
+    """
+    match_query = build_match_query(text or "")
+    if not match_query:
+        return [], None
+    keyset_clause = "AND (messages_fts.rank, messages_fts.rowid) > (?, ?)" if after else ""
+    params = [match_query, user_email] + (list(after) if after else []) + [limit + 1]
+    rows = pool.fetchall(f'''
+        SELECT messages_fts.rowid, messages_fts.rank, highlight(messages_fts, 0, '{HIGHLIGHT_OPEN}', '{HIGHLIGHT_CLOSE}'),
+               m.content, COALESCE(m.role, a.role), COALESCE(m.timestamp, a.timestamp), s.id, s.name
+        FROM messages_fts
+        LEFT JOIN messages m ON m.rowid = messages_fts.rowid
+        LEFT JOIN messages_fts_archived a ON a.rowid = messages_fts.rowid
+        JOIN sessions s ON s.id = COALESCE(m.session_id, a.session_id)
+        WHERE messages_fts MATCH ? AND s.user_email = ? {keyset_clause}
+        ORDER BY messages_fts.rank, messages_fts.rowid
+        LIMIT ?''', params)
+    archived_contents = {}
+    archived_sessions = {row[6] for row in rows[:limit] if row[3] is None}
+    if archived_sessions:
+        import maintenance  # Imports this module
+        for session_id in archived_sessions:
+            archived_contents.update(maintenance.archived_message_contents(pool, session_id))
+    results = [{"message_rowid": rowid, "role": role, "timestamp": timestamp, "session_id": session_id, "session_name": session_name,
+                "snippet": make_snippet(highlighted, archived_contents.get(rowid, "") if content is None else content)}
+               for rowid, rank, highlighted, content, role, timestamp, session_id, session_name in rows[:limit]]
+    next_cursor = (rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return results, next_cursor
+
+if __name__ == "__main__":
+    import db
+    parser = argparse.ArgumentParser(description="Full-text index of the chat history.")
+    parser.add_argument("--db", default="chat_sessions.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="Index messages stored before the search index existed.")
+    backfill_parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    search_parser = subparsers.add_parser("search", help="Search one user's messages.")
+    search_parser.add_argument("user_email")
+    search_parser.add_argument("query")
+    args = parser.parse_args()
+    search_pool = db.ConnectionPool(args.db, max_connections=2)
+
+    if args.command == "backfill":
+        print(f"Examined {backfill(search_pool, args.batch_size)} messages; progress {backfill_progress(search_pool)}")
+    else:
+        results, _ = search_messages(search_pool, args.user_email, args.query)
+        for result in results:
+            print(f"[{result['session_name']}] {result['role']}: {result['snippet']}")
@@ -0,0 +1,335 @@
+import argparse
+import collections
+import contextvars
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+# --- Turn Metrics ---
+# Each chat turn is traced with a few spans (DB writes, history, retrieval, uploads, context
+# cache, time to first token, stream duration...) plus prompt/response sizes and the token usage
+# reported by Gemini. The trace of the turn in progress lives in a context variable, so helpers
+# add spans without having it passed around; finished traces are queued and written to the
+# turn_metrics table by a background thread, off the request path. The same table feeds the
+# admin panel (p50/p95 per stage) and a Prometheus text exposition (file or `python metrics.py serve`).
+# turn_metrics only keeps RETENTION_SECONDS of turns; the counters and the summary sums and counts
+# of the exposition come from turn_metric_totals, added to in the same transaction and never pruned,
+# so they only go up, whichever process writes the turns or serves the exposition.
+
+STAGES = ("session_lookup", "save_user_message", "answer_cache", "history", "retrieval", "upload", "context_cache",
+          "ttft", "stream", "save_assistant_message", "total")
+USAGE_FIELDS = ("prompt_tokens", "response_tokens", "cached_tokens", "total_tokens")
+PERCENTILE_WINDOW = 1000  # Most recent turns used for p50/p95
+RETENTION_SECONDS = 30 * 24 * 3600
+QUEUE_MAX_SIZE = 1000
+FLUSH_INTERVAL_SECONDS = 2.0
+METRIC_PREFIX = "gtcc"
+SCRIPT_RUN_WINDOW = 500  # Most recent script runs kept per process
+
+_CURRENT_TRACE = contextvars.ContextVar("gtcc_turn_trace", default=None)
+_QUEUE = queue.Queue(maxsize=QUEUE_MAX_SIZE)
+_WRITER_LOCK = threading.Lock()
+_WRITER = {"thread": None, "pool": None, "exposition_path": None}
+_SCRIPT_RUNS_LOCK = threading.Lock()
+_SCRIPT_RUNS = {"count": 0, "cold_start_seconds": None, "rerun_total_seconds": 0.0, "recent": collections.deque(maxlen=SCRIPT_RUN_WINDOW)}
+
+def init_metrics_table(cursor):
+    stage_columns = ", ".join(f"{stage}_ms REAL" for stage in STAGES)
+    usage_columns = ", ".join(f"{field} INTEGER" for field in USAGE_FIELDS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS turn_metrics (
+            id INTEGER PRIMARY KEY,
+            created_at INTEGER NOT NULL,
+            session_id TEXT,
+            user_email TEXT,
+            model TEXT,
+            outcome TEXT,
+            {stage_columns},
+            prompt_chars INTEGER,
+            response_chars INTEGER,
+            {usage_columns},
+            extra_json TEXT
+        ) ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_turn_metrics_created_at ON turn_metrics (created_at);''')
+
+def init_metric_totals_table(cursor):
+    # name: "turns" (label: outcome), "tokens" (label: usage field), "stage_seconds" / "stage_count" (label: stage).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS turn_metric_totals (
+            name TEXT NOT NULL,
+            label TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, label)
+        ) ''')
+    # Start from the turns still in turn_metrics.
+    columns = ["outcome"] + [f"{s}_ms" for s in STAGES] + list(USAGE_FIELDS)
+    rows = cursor.execute(f"SELECT {', '.join(columns)} FROM turn_metrics").fetchall()
+    _add_totals(cursor, [dict(zip(columns, row)) for row in rows])
+
+class TurnTrace:
+    def __init__(self, session_id, user_email, model):
+        self.started_at = time.perf_counter()
+        self.created_at = int(time.time())
+        self.session_id = session_id; self.user_email = user_email; self.model = model
+        self.stages = {}
+        self.attributes = {"outcome": "ok"}
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+        if seconds is not None:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def mark(self, name):
+        # Elapsed time since the turn started, recorded once (e.g. time to first token).
+        if name not in self.stages:
+            self.stages[name] = time.perf_counter() - self.started_at
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_usage(self, usage_metadata):
+        if usage_metadata is None: return
+        self.set(prompt_tokens=getattr(usage_metadata, "prompt_token_count", None),
+                 response_tokens=getattr(usage_metadata, "candidates_token_count", None),
+                 cached_tokens=getattr(usage_metadata, "cached_content_token_count", None),
+                 total_tokens=getattr(usage_metadata, "total_token_count", None))
+
+    def to_row(self):
+        attributes = dict(self.attributes)
+        extra = {k: v for k, v in attributes.items() if k not in ("outcome", "prompt_chars", "response_chars") + USAGE_FIELDS}
+        extra.update({f"{k}_ms": round(v * 1000.0, 3) for k, v in self.stages.items() if k not in STAGES})
+        stage_values = [round(self.stages[s] * 1000.0, 3) if s in self.stages else None for s in STAGES]
+        return ([self.created_at, self.session_id, self.user_email, self.model, attributes.get("outcome")] + stage_values +
+                [attributes.get("prompt_chars"), attributes.get("response_chars")] + [attributes.get(f) for f in USAGE_FIELDS] +
+                [json.dumps(extra, ensure_ascii=False, default=str) if extra else None])
+
+# --- Current-turn helpers (no-ops outside a traced turn) ---
+def current_trace():
+    return _CURRENT_TRACE.get()
+
+def span(name):
+    trace = _CURRENT_TRACE.get()
+    return trace.span(name) if trace else nullcontext()
+
+def record(name, seconds):
+    trace = _CURRENT_TRACE.get()
+    if trace: trace.record(name, seconds)
+
+def mark(name):
+    trace = _CURRENT_TRACE.get()
+    if trace: trace.mark(name)
+
+def set_attributes(**attributes):
+    trace = _CURRENT_TRACE.get()
+    if trace: trace.set(**attributes)
+
+def set_usage(usage_metadata):
+    trace = _CURRENT_TRACE.get()
+    if trace: trace.set_usage(usage_metadata)
+
+@contextmanager
+def turn(pool, session_id, user_email, model, exposition_path=None):
+    """Trace one chat turn; the trace is queued for the background writer when the block exits."""
+    trace = TurnTrace(session_id, user_email, model)
+    token = _CURRENT_TRACE.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.set(outcome="exception", exception=type(e).__name__)
+        raise
+    finally:
+        _CURRENT_TRACE.reset(token)
+        trace.stages["total"] = time.perf_counter() - trace.started_at
+        _submit(pool, trace, exposition_path)
+
+# --- Background writer ---
+def _submit(pool, trace, exposition_path):
+    with _WRITER_LOCK:
+        _WRITER["pool"] = pool; _WRITER["exposition_path"] = exposition_path
+        if _WRITER["thread"] is None or not _WRITER["thread"].is_alive():
+            _WRITER["thread"] = threading.Thread(target=_writer_loop, name="turn-metrics-writer", daemon=True)
+            _WRITER["thread"].start()
+    try: _QUEUE.put_nowait(trace)
+    except queue.Full: pass  # Metrics are best effort; never slow a turn down
+
+def _writer_loop():
+    while True:
+        traces = [_QUEUE.get()]
+        time.sleep(FLUSH_INTERVAL_SECONDS)  # Batch traces finished close together into one transaction
+        while True:
+            try: traces.append(_QUEUE.get_nowait())
+            except queue.Empty: break
+        try:
+            flush(_WRITER["pool"], traces)
+            if _WRITER["exposition_path"]:
+                write_exposition_file(_WRITER["pool"], _WRITER["exposition_path"])
+        except Exception:
+            pass
+
+def flush(pool, traces):
+    columns = (["created_at", "session_id", "user_email", "model", "outcome"] + [f"{s}_ms" for s in STAGES] +
+               ["prompt_chars", "response_chars"] + list(USAGE_FIELDS) + ["extra_json"])
+    rows = [trace.to_row() for trace in traces]
+    with pool.transaction() as conn:
+        conn.executemany(f"INSERT INTO turn_metrics ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+        _add_totals(conn, [dict(zip(columns, row)) for row in rows])
+        conn.execute("DELETE FROM turn_metrics WHERE created_at < ?", (int(time.time()) - RETENTION_SECONDS,))
+
+def _add_totals(conn, rows):
+    totals = collections.Counter()
+    for row in rows:
+        totals[("turns", row["outcome"])] += 1
+        for field in USAGE_FIELDS:
+            if row[field] is not None: totals[("tokens", field)] += row[field]
+        for stage in STAGES:
+            if row[f"{stage}_ms"] is not None:
+                totals[("stage_seconds", stage)] += row[f"{stage}_ms"] / 1000.0; totals[("stage_count", stage)] += 1
+    conn.executemany('''
+        INSERT INTO turn_metric_totals (name, label, value) VALUES (?, ?, ?)
+        ON CONFLICT(name, label) DO UPDATE SET value = value + excluded.value''',
+        [(name, label, value) for (name, label), value in totals.items()])
+
+# --- Script runs (per process) ---
+# Streamlit executes app.py again on every interaction. The first run of a server process also
+# pays for imports and one-time setup (cold start); the following runs should only pay for
+# rendering. Kept in memory: the numbers describe this process, not the whole deployment.
+def record_script_run(seconds):
+    with _SCRIPT_RUNS_LOCK:
+        if _SCRIPT_RUNS["count"] == 0: _SCRIPT_RUNS["cold_start_seconds"] = seconds
+        else:
+            _SCRIPT_RUNS["recent"].append(seconds); _SCRIPT_RUNS["rerun_total_seconds"] += seconds
+        _SCRIPT_RUNS["count"] += 1
+
+def script_run_summary():
+    """Return {"runs", "cold_start_ms"} plus "p50_ms"/"p95_ms" of the later (warm) runs once there are any."""
+    with _SCRIPT_RUNS_LOCK:
+        runs = _SCRIPT_RUNS["count"]; cold_start_seconds = _SCRIPT_RUNS["cold_start_seconds"]
+        values = sorted(_SCRIPT_RUNS["recent"])
+    summary = {"runs": runs, "cold_start_ms": round(cold_start_seconds * 1000.0, 1) if cold_start_seconds is not None else None}
+    if values:
+        summary.update(p50_ms=round(_percentile(values, 50) * 1000.0, 1), p95_ms=round(_percentile(values, 95) * 1000.0, 1))
+    return summary
+
+def process_memory():
+    """Return {"rss_bytes", "peak_rss_bytes"} of this process; None where the platform does not report it."""
+    rss_bytes = peak_rss_bytes = None
+    try:
+        with open("/proc/self/statm") as f:
+            rss_bytes = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    except ImportError:
+        pass # Windows: neither is available without psutil
+    return {"rss_bytes": rss_bytes, "peak_rss_bytes": peak_rss_bytes}
+
+# --- Reporting ---
+def _percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))]
+
+def stage_percentiles(pool, window=PERCENTILE_WINDOW):
+    """Return {stage: {"count", "p50_ms", "p95_ms"}} over the most recent `window` turns."""
+    rows = pool.fetchall(f"SELECT {', '.join(f'{s}_ms' for s in STAGES)} FROM turn_metrics ORDER BY id DESC LIMIT ?", (window,))
+    summary = {}
+    for index, stage in enumerate(STAGES):
+        values = sorted(row[index] for row in rows if row[index] is not None)
+        if values:
+            summary[stage] = {"count": len(values), "p50_ms": round(_percentile(values, 50), 1), "p95_ms": round(_percentile(values, 95), 1)}
+    return summary
+
+def metric_totals(pool):
+    """Return {(name, label): value} from turn_metric_totals (cumulative since the table was created)."""
+    return {(name, label): value for name, label, value in pool.fetchall("SELECT name, label, value FROM turn_metric_totals")}
+
+def render_exposition(pool, window=PERCENTILE_WINDOW):
+    """Prometheus text exposition format (quantiles over the recent window; sums, counts and counters cumulative)."""
+    totals = metric_totals(pool)
+    lines = [f"# HELP {METRIC_PREFIX}_turn_stage_seconds Duration of each stage of a chat turn (quantiles over the last {window} turns).",
+             f"# TYPE {METRIC_PREFIX}_turn_stage_seconds summary"]
+    rows = pool.fetchall(f"SELECT {', '.join(f'{s}_ms' for s in STAGES)} FROM turn_metrics ORDER BY id DESC LIMIT ?", (window,))
+    for index, stage in enumerate(STAGES):
+        values = sorted(row[index] / 1000.0 for row in rows if row[index] is not None)
+        for quantile in (0.5, 0.95) if values else ():
+            lines.append(f'{METRIC_PREFIX}_turn_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {_percentile(values, quantile * 100):.6f}')
+        if ("stage_count", stage) not in totals: continue
+        lines.append(f'{METRIC_PREFIX}_turn_stage_seconds_sum{{stage="{stage}"}} {totals[("stage_seconds", stage)]:.6f}')
+        lines.append(f'{METRIC_PREFIX}_turn_stage_seconds_count{{stage="{stage}"}} {int(totals[("stage_count", stage)])}')
+
+    lines += [f"# HELP {METRIC_PREFIX}_turns_total Chat turns recorded, by outcome.", f"# TYPE {METRIC_PREFIX}_turns_total counter"]
+    for (name, outcome), count in sorted(totals.items()):
+        if name == "turns": lines.append(f'{METRIC_PREFIX}_turns_total{{outcome="{outcome}"}} {int(count)}')
+
+    lines += [f"# HELP {METRIC_PREFIX}_tokens_total Gemini tokens reported in usage metadata, by kind.", f"# TYPE {METRIC_PREFIX}_tokens_total counter"]
+    for field in USAGE_FIELDS:
+        lines.append(f'{METRIC_PREFIX}_tokens_total{{kind="{field[:-len("_tokens")]}"}} {int(totals.get(("tokens", field), 0))}')
+
+    # Script runs are only known to the app process itself (empty for `python metrics.py export`).
+    with _SCRIPT_RUNS_LOCK:
+        runs = _SCRIPT_RUNS["count"]; cold_start_seconds = _SCRIPT_RUNS["cold_start_seconds"]
+        rerun_total_seconds = _SCRIPT_RUNS["rerun_total_seconds"]; values = sorted(_SCRIPT_RUNS["recent"])
+    if cold_start_seconds is not None:
+        lines += [f"# HELP {METRIC_PREFIX}_script_cold_start_seconds Duration of the first script run of this process.",
+                  f"# TYPE {METRIC_PREFIX}_script_cold_start_seconds gauge",
+                  f"{METRIC_PREFIX}_script_cold_start_seconds {cold_start_seconds:.6f}"]
+    if values:
+        lines += [f"# HELP {METRIC_PREFIX}_script_rerun_seconds Duration of the later script runs of this process (quantiles over the last {SCRIPT_RUN_WINDOW}).",
+                  f"# TYPE {METRIC_PREFIX}_script_rerun_seconds summary"]
+        for quantile in (0.5, 0.95):
+            lines.append(f'{METRIC_PREFIX}_script_rerun_seconds{{quantile="{quantile}"}} {_percentile(values, quantile * 100):.6f}')
+        lines.append(f"{METRIC_PREFIX}_script_rerun_seconds_sum {rerun_total_seconds:.6f}")
+        lines.append(f"{METRIC_PREFIX}_script_rerun_seconds_count {runs - 1}")
+    memory = process_memory()
+    for field, description in (("rss_bytes", "Resident memory"), ("peak_rss_bytes", "Peak resident memory")):
+        if memory[field] is None: continue
+        name = f"{METRIC_PREFIX}_process_{field.replace('rss', 'resident_memory')}"
+        lines += [f"# HELP {name} {description} of the process writing this exposition.", f"# TYPE {name} gauge", f"{name} {memory[field]}"]
+    return "\n".join(lines) + "\n"
+
+def write_exposition_file(pool, path):
+    # For the node_exporter textfile collector: replaced atomically so scrapers never see half a file.
+    path = Path(path); path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(render_exposition(pool), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+if __name__ == "__main__":
+    import db
+    parser = argparse.ArgumentParser(description="Export the chatbot's turn metrics in Prometheus text format.")
+    parser.add_argument("--db", default="chat_sessions.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("export", help="Print the exposition once.")
+    serve_parser = subparsers.add_parser("serve", help="Serve the exposition over HTTP at /metrics.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=9464)
+    args = parser.parse_args()
+    metrics_pool = db.ConnectionPool(args.db, max_connections=2)
+
+    if args.command == "export":
+        print(render_exposition(metrics_pool), end="")
+    else:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404); return
+                body = render_exposition(metrics_pool).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers(); self.wfile.write(body)
+        print(f"Serving metrics on http://{args.host}:{args.port}/metrics")
+        ThreadingHTTPServer((args.host, args.port), MetricsHandler).serve_forever()
@@ -0,0 +1,283 @@
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from pathlib import Path
+
+import gemini_scheduler
+from file_registry import file_sha256
+
+# --- Local Retrieval Index ---
+# Offline ingestion: the PDFs are split into page-scoped passages and indexed with BM25 over a
+# Vietnamese-aware tokenization (diacritic-folded syllables, the accented form when it differs,
+# and folded syllable bigrams so multi-syllable words like "xe buýt" score as a unit). An
+# optional dense index (Gemini embeddings stored as a NumPy matrix) is fused in with reciprocal
+# rank fusion when present. The index lives on disk and is loaded once per process.
+
+INDEX_FORMAT_VERSION = 1
+INDEX_DIR = Path("index")
+LEXICAL_INDEX_FILENAME = "retrieval_index.json.gz"
+VECTOR_INDEX_FILENAME = "retrieval_vectors.npy"
+EMBEDDING_MODEL_ID = "text-embedding-004"
+
+CHUNK_TARGET_CHARS = 900
+CHUNK_OVERLAP_SENTENCES = 1
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+DEFAULT_TOP_K = 6
+QUERY_EMBED_MAX_RETRIES = 1  # On the turn's path: lexical results are used rather than waiting out a backoff
+BUILD_FAILURE_BACKOFF_SECONDS = 15 * 60
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?;:])\s+|\s+(?=[●○■•])")
+_REFERENCES_MARKER_RE = re.compile(r"\bWorks cited\b", re.IGNORECASE)
+
+_LOADED_INDEXES = {}
+_LOAD_LOCK = threading.Lock()
+_BUILD_THREADS = {}
+_BUILD_FAILED_UNTIL = {}
+
+def fold_diacritics(text):
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn")
+    return text.replace("đ", "d").replace("Đ", "D")
+
+def tokenize(text):
+    words = _TOKEN_RE.findall(unicodedata.normalize("NFC", text).lower())
+    folded = [fold_diacritics(w) for w in words]
+    terms = list(folded)
+    terms.extend(w for w, f in zip(words, folded) if w != f)
+    terms.extend(f"{a}_{b}" for a, b in zip(folded, folded[1:]))
+    return terms
+
+def compute_corpus_signature(doc_dir, pdf_filenames):
+    digest = hashlib.sha256(f"v{INDEX_FORMAT_VERSION}".encode("ascii"))
+    for filename in sorted(pdf_filenames):
+        file_path = Path(doc_dir) / filename
+        if file_path.exists():
+            digest.update(filename.encode("utf-8")); digest.update(file_sha256(file_path).encode("ascii"))
+    return digest.hexdigest()
+
+# --- Ingestion ---
+def extract_pdf_pages(file_path):
+    from pypdf import PdfReader  # Only needed at ingestion time
+    pages = []
+    for page in PdfReader(str(file_path)).pages:
+        raw_text = page.extract_text() or ""
+        # The PDFs were exported with one word per line separated by blank lines.
+        page_text = re.sub(r"\s+", " ", raw_text.replace("\n \n", " ")).strip()
+        # Each document ends with a bibliography of URLs that only adds noise to the index.
+        references_match = _REFERENCES_MARKER_RE.search(page_text)
+        if references_match:
+            pages.append(page_text[:references_match.start()].strip())
+            break
+        pages.append(page_text)
+    return pages
+
+def chunk_page(text):
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(text) if s.strip()]
+    chunks = []; current = []; current_len = 0
+    for sentence in sentences:
+        if current and current_len + len(sentence) > CHUNK_TARGET_CHARS:
+            chunks.append(" ".join(current))
+            current = current[-CHUNK_OVERLAP_SENTENCES:] if CHUNK_OVERLAP_SENTENCES else []
+            current_len = sum(len(s) + 1 for s in current)
+        current.append(sentence); current_len += len(sentence) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def build_index(doc_dir, pdf_filenames, index_dir=INDEX_DIR, embed_client=None):
+    chunks = []
+    for filename in pdf_filenames:
+        file_path = Path(doc_dir) / filename
+        if not file_path.exists():
+            continue
+        for page_number, page_text in enumerate(extract_pdf_pages(file_path), start=1):
+            for chunk_text in chunk_page(page_text):
+                chunks.append({"file": filename, "page": page_number, "text": chunk_text})
+
+    postings = defaultdict(list); doc_lengths = []
+    for chunk_id, chunk in enumerate(chunks):
+        term_counts = Counter(tokenize(chunk["text"]))
+        doc_lengths.append(sum(term_counts.values()))
+        for term, tf in term_counts.items():
+            postings[term].append([chunk_id, tf])
+
+    index_data = {
+        "version": INDEX_FORMAT_VERSION,
+        "corpus_signature": compute_corpus_signature(doc_dir, pdf_filenames),
+        "chunks": chunks,
+        "doc_lengths": doc_lengths,
+        "postings": postings,
+        "embedding_model": None,
+    }
+    index_dir = Path(index_dir); index_dir.mkdir(parents=True, exist_ok=True)
+    if embed_client is not None:
+        vectors = _embed_texts(embed_client, [c["text"] for c in chunks], "RETRIEVAL_DOCUMENT")
+        import numpy as np
+        np.save(index_dir / VECTOR_INDEX_FILENAME, vectors)
+        index_data["embedding_model"] = EMBEDDING_MODEL_ID
+    tmp_path = index_dir / (LEXICAL_INDEX_FILENAME + ".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(index_data, f, ensure_ascii=False)
+    os.replace(tmp_path, index_dir / LEXICAL_INDEX_FILENAME)
+    return len(chunks)
+
+def _embed_texts(client, texts, task_type, batch_size=100):
+    import numpy as np
+    from google.genai import types as google_genai_types
+    rows = []
+    for start in range(0, len(texts), batch_size):
+        result = client.models.embed_content(
+            model=EMBEDDING_MODEL_ID, contents=texts[start:start + batch_size],
+            config=google_genai_types.EmbedContentConfig(task_type=task_type))
+        rows.extend(e.values for e in result.embeddings)
+    matrix = np.asarray(rows, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+# --- Query time ---
+class RetrievalIndex:
+    def __init__(self, index_data, vectors=None):
+        self.chunks = index_data["chunks"]
+        self.corpus_signature = index_data["corpus_signature"]
+        self.embedding_model = index_data.get("embedding_model")
+        self.doc_lengths = index_data["doc_lengths"]
+        self.avg_doc_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 1.0
+        self.postings = index_data["postings"]
+        n_docs = len(self.chunks)
+        self.idf = {term: math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()}
+        self.vectors = vectors
+
+    def lexical_search(self, query, limit):
+        scores = defaultdict(float)
+        for term, query_tf in Counter(tokenize(query)).items():
+            postings = self.postings.get(term)
+            if not postings: continue
+            idf = self.idf[term]
+            for chunk_id, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / self.avg_doc_length)
+                scores[chunk_id] += query_tf * idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def vector_search(self, query, limit, embed_client, limiter=None):
+        if self.vectors is None or embed_client is None:
+            return []
+        def embed_query():
+            # Counted against the key's quota, but never queued: without a free slot the search stays lexical.
+            if limiter is not None and not limiter.try_acquire(len(query) // gemini_scheduler.CHARS_PER_TOKEN + 1):
+                raise gemini_scheduler.SchedulerBusyError("Không còn lượt gọi Gemini trống cho việc nhúng câu hỏi.")
+            return _embed_texts(embed_client, [query], "RETRIEVAL_QUERY")[0]
+        try:
+            query_vector = gemini_scheduler.call_with_retry(embed_query, max_retries=QUERY_EMBED_MAX_RETRIES)
+        except Exception:
+            return []
+        similarities = self.vectors @ query_vector
+        top_ids = similarities.argsort()[::-1][:limit]
+        return [(int(i), float(similarities[i])) for i in top_ids]
+
+    def search(self, query, top_k=DEFAULT_TOP_K, embed_client=None, limiter=None):
+        candidate_limit = top_k * 4
+        lexical_hits = self.lexical_search(query, candidate_limit)
+        vector_hits = self.vector_search(query, candidate_limit, embed_client, limiter)
+        if vector_hits:
+            fused = defaultdict(float)
+            for hits in (lexical_hits, vector_hits):
+                for rank, (chunk_id, _) in enumerate(hits):
+                    fused[chunk_id] += 1.0 / (RRF_K + rank + 1)
+            ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        else:
+            ranked = lexical_hits[:top_k]
+        return [dict(self.chunks[chunk_id], score=round(score, 4)) for chunk_id, score in ranked]
+
+def load_index(index_dir=INDEX_DIR, expected_signature=None):
+    """Return the process-wide RetrievalIndex, or None when it is missing or stale."""
+    lexical_path = Path(index_dir) / LEXICAL_INDEX_FILENAME
+    if not lexical_path.exists():
+        return None
+    cache_key = (str(lexical_path), lexical_path.stat().st_mtime_ns)
+    with _LOAD_LOCK:
+        index = _LOADED_INDEXES.get(cache_key)
+        if index is None:
+            with gzip.open(lexical_path, "rt", encoding="utf-8") as f:
+                index_data = json.load(f)
+            if index_data.get("version") != INDEX_FORMAT_VERSION:
+                return None
+            vectors = None
+            vector_path = Path(index_dir) / VECTOR_INDEX_FILENAME
+            if index_data.get("embedding_model") and vector_path.exists():
+                try:
+                    import numpy as np
+                    vectors = np.load(vector_path)
+                except ImportError:
+                    vectors = None  # NumPy is optional; lexical search still works
+            index = RetrievalIndex(index_data, vectors)
+            _LOADED_INDEXES.clear(); _LOADED_INDEXES[cache_key] = index
+    if expected_signature and index.corpus_signature != expected_signature:
+        return None
+    return index
+
+def ensure_index_built_async(doc_dir, pdf_filenames, index_dir=INDEX_DIR):
+    # PDF text extraction takes several seconds, so a missing or stale index is rebuilt in the
+    # background while callers keep using the full-document path. A failed build is not retried
+    # for BUILD_FAILURE_BACKOFF_SECONDS (returns None meanwhile).
+    key = str(index_dir)
+    with _LOAD_LOCK:
+        if _BUILD_FAILED_UNTIL.get(key, 0) > time.time():
+            return None
+        thread = _BUILD_THREADS.get(key)
+        if thread and thread.is_alive():
+            return thread
+        thread = threading.Thread(target=_build_in_background, args=(key, doc_dir, list(pdf_filenames), index_dir),
+                                  name="retrieval-index-build", daemon=True)
+        _BUILD_THREADS[key] = thread
+    thread.start()
+    return thread
+
+def _build_in_background(key, doc_dir, pdf_filenames, index_dir):
+    try:
+        build_index(doc_dir, pdf_filenames, index_dir)
+    except Exception:
+        with _LOAD_LOCK: _BUILD_FAILED_UNTIL[key] = time.time() + BUILD_FAILURE_BACKOFF_SECONDS
+        raise  # Reported by the thread's excepthook, once per backoff period
+
+def format_passages_for_prompt(passages):
+    lines = ["Trích đoạn tài liệu liên quan (trả lời dựa trên các trích đoạn này và ghi nguồn dạng (tên tài liệu, trang X); "
+             "nếu không đủ thông tin thì dùng Google Search):"]
+    for i, passage in enumerate(passages, start=1):
+        lines.append(f"\n[{i}] {passage['file']} - trang {passage['page']}\n{passage['text']}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the local PDF retrieval index.")
+    parser.add_argument("--doc-dir", default="documents")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--embeddings", action="store_true", help="Also build the vector index (needs GEMINI_API_KEY).")
+    search_parser = subparsers.add_parser("search")
+    search_parser.add_argument("query")
+    search_parser.add_argument("-k", type=int, default=DEFAULT_TOP_K)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        client = None
+        if args.embeddings:
+            from google import genai as google_genai_sdk
+            client = google_genai_sdk.Client(api_key=os.environ["GEMINI_API_KEY"])
+        pdf_filenames = sorted(p.name for p in Path(args.doc_dir).glob("*.pdf"))
+        print(f"Indexed {build_index(args.doc_dir, pdf_filenames, embed_client=client)} passages into {INDEX_DIR}/")
+    else:
+        index = load_index()
+        if index is None:
+            raise SystemExit("Index not found, run: python retrieval.py build")
+        for hit in index.search(args.query, args.k):
+            print(f"{hit['score']:>8}  {hit['file']} p.{hit['page']}: {hit['text'][:160]}")
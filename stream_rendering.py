@@ -0,0 +1,87 @@
+import time
+from collections import namedtuple
+
+# --- Streamed Response Rendering ---
+# Re-sending the whole growing answer to an st.empty() on every chunk costs O(n^2) bytes over the
+# websocket and as much Markdown parsing in the browser. The renderer buffers chunks and flushes
+# on a time/size cadence, and paragraphs that are complete (outside code fences) are frozen in
+# their own element, so each flush only re-sends the paragraph still being written. The final
+# answer is rendered once as a single element, identical to a non-streamed one.
+
+FLUSH_INTERVAL_SECONDS = 0.05
+FLUSH_MIN_CHARS = 200
+CURSOR = "▌"
+PARAGRAPH_BREAK = "\n\n"
+CODE_FENCE = "```"
+
+ChunkParts = namedtuple("ChunkParts", ["function_calls", "search_queries", "function_call_parts"])
+
+class StreamRenderer:
+    def __init__(self, placeholder, flush_interval_seconds=FLUSH_INTERVAL_SECONDS, flush_min_chars=FLUSH_MIN_CHARS, cursor=CURSOR):
+        self.placeholder = placeholder
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_min_chars = flush_min_chars
+        self.cursor = cursor
+        self.text = ""
+        self.flush_count = 0
+        self._segments = None  # Container holding the frozen paragraphs, created on the first flush
+        self._tail = None
+        self._tail_start = 0  # Offset in self.text where the paragraph being written starts
+        self._pending_chars = 0
+        self._last_flush_at = time.monotonic()
+
+    def append(self, chunk_text):
+        if not chunk_text: return
+        self.text += chunk_text
+        self._pending_chars += len(chunk_text)
+        if self._pending_chars >= self.flush_min_chars or time.monotonic() - self._last_flush_at >= self.flush_interval_seconds:
+            self.flush()
+
+    def _freeze_complete_paragraphs(self):
+        # Split at the last paragraph break that is not inside a code fence.
+        tail_text = self.text[self._tail_start:]
+        split_at = tail_text.rfind(PARAGRAPH_BREAK)
+        while split_at > 0 and tail_text[:split_at].count(CODE_FENCE) % 2:
+            split_at = tail_text.rfind(PARAGRAPH_BREAK, 0, split_at)
+        if split_at <= 0:
+            return
+        self._tail.markdown(tail_text[:split_at])
+        self._tail = self._segments.empty()
+        self._tail_start += split_at + len(PARAGRAPH_BREAK)
+
+    def flush(self):
+        if self._segments is None:
+            self._segments = self.placeholder.container()
+            self._tail = self._segments.empty()
+        self._freeze_complete_paragraphs()
+        self._tail.markdown(self.text[self._tail_start:] + self.cursor)
+        self.flush_count += 1
+        self._pending_chars = 0
+        self._last_flush_at = time.monotonic()
+
+    def finish(self):
+        """Replace the streamed segments with the complete answer and return its text."""
+        self.placeholder.markdown(self.text)
+        return self.text
+
+def collect_chunk_parts(chunk):
+    """Extract function calls and Google Search queries from a streamed GenerateContentResponse.
+
+    function_call_parts are the raw Parts of the calls, to be sent back with their responses.
+    """
+    function_calls = []; search_queries = []; function_call_parts = []
+    for candidate in getattr(chunk, "candidates", None) or []:
+        grounding_metadata = getattr(candidate, "grounding_metadata", None)
+        if grounding_metadata and getattr(grounding_metadata, "web_search_queries", None):
+            search_queries.extend(grounding_metadata.web_search_queries)
+        content = getattr(candidate, "content", None)
+        for part in (getattr(content, "parts", None) or []) if content else []:
+            function_call = getattr(part, "function_call", None)
+            if not function_call: continue
+            args_dict = {}
+            if getattr(function_call, "args", None):
+                try: args_dict = dict(function_call.args)
+                except TypeError: args_dict = {"error": f"Could not parse fc.args to dict ({type(function_call.args).__name__})"}
+            function_calls.append({"name": function_call.name, "args": args_dict})
+            function_call_parts.append(part)
+    return ChunkParts(function_calls, search_queries, function_call_parts)
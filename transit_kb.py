@@ -0,0 +1,667 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from file_registry import file_sha256
+from retrieval import BUILD_FAILURE_BACKOFF_SECONDS, INDEX_DIR, extract_pdf_pages, fold_diacritics
+
+# --- Transit Knowledge Base ---
+# Offline extraction of the tables in the PDFs (bus routes, metro stations, feeder buses, water
+# bus piers, fares, operating hours, headways) into a small SQLite database, answered locally
+# when Gemini calls one of the function-calling tools declared below. The PDFs were exported
+# with their tables flattened to text: cells of a row come out in column order, and a row that
+# runs over a page break continues its unfinished cells at the top of the next page, before the
+# next row. Each table has its own parser anchored on its caption; rows cut by a page break are
+# stitched back by _split_spill(). The database is rebuilt when the PDFs change.
+
+KB_FORMAT_VERSION = 1
+KB_FILENAME = "transit_kb.db"
+BUS_PDF = "xe_buyt.pdf"
+METRO_PDF = "tuyen_duong_sat_do_thi_hcm.pdf"
+OTHER_MODES_PDF = "xe_dap_cong_cong_xe_dien_4_banh_va_xe_buyt_duong_song.pdf"
+TOOL_RESULT_LIMIT = 20
+PAGE_BREAK = " \f "
+
+MODES = ("bus", "metro", "waterbus", "bike", "watergo")
+MODE_LABELS = {"bus": "Xe buýt", "metro": "Metro", "waterbus": "Buýt đường sông (Saigon Waterbus)",
+               "bike": "Xe đạp công cộng (TNGO)", "watergo": "Du thuyền Saigon WaterGo"}
+
+_PRICE = r"\d{1,3}(?:\.\d{3})+"
+_TIME_RE = re.compile(r"\b(\d{1,2})[h:](\d\d)\b")
+_BUS_ROW_HEAD = (r"(?:(?<=\s)|^)(?P<code>\d{2,3}) (?P<name>[^\f]+?) (?P<km>\d+(?:,\d+)?) (?P<start>\d{1,2}:\d\d) -"
+                 r"(?: (?P<end>\d{1,2}:\d\d))? (?P<trip>\d+(?: [–-] \d+)?|-) (?P<headway>\d+ [–-] \d+)")
+_BUS_ROW_RE = re.compile(_BUS_ROW_HEAD + r" (?P<rest>[^\f]*?)(?=\s" + _BUS_ROW_HEAD.replace("?P<", "?P<next_") + r"|\s*$)")
+_OPERATOR_RE = re.compile(r"\b(?:Công ty|HTX|Liên hiệp|Hợp tác xã)\b")
+_NOT_SUBSIDIZED = "(Không trợ giá)"
+
+REJECTED_BY_MODELS = set()  # Models that refused the declarations next to google_search (process-wide)
+_LOADED = {}
+_LOAD_LOCK = threading.Lock()
+_BUILD_THREADS = {}
+_BUILD_FAILED_UNTIL = {}
+
+def search_key(text):
+    return " ".join(fold_diacritics(text or "").lower().split())
+
+def _join_pages(text):
+    return " ".join(text.replace("\f", " ").split())
+
+def _price(text):
+    return int(text.replace(".", "")) if text else None
+
+def _hhmm(match):
+    return f"{int(match.group(1)):02d}:{match.group(2)}"
+
+def _minutes_range(text):
+    numbers = [int(n) for n in re.findall(r"\d+", text or "")]
+    return (min(numbers), max(numbers)) if numbers else (None, None)
+
+def compute_kb_signature(doc_dir, pdf_filenames):
+    digest = hashlib.sha256(f"transit-kb-v{KB_FORMAT_VERSION}".encode("ascii"))
+    for filename in sorted(pdf_filenames):
+        file_path = Path(doc_dir) / filename
+        if file_path.exists():
+            digest.update(filename.encode("utf-8")); digest.update(file_sha256(file_path).encode("ascii"))
+    return digest.hexdigest()
+
+# --- Extraction ---
+class _Document:
+    def __init__(self, file_path):
+        self.filename = Path(file_path).name
+        self.pages = extract_pdf_pages(file_path)
+        self.text = PAGE_BREAK.join(self.pages)
+
+    def page_at(self, offset):
+        return self.text.count("\f", 0, offset) + 1
+
+    def section(self, start_marker, end_marker, after=0):
+        """Text between the two markers (the end marker searched after the start), and its source."""
+        start = self.text.find(start_marker, after)
+        if start < 0:
+            return "", None
+        start += len(start_marker)
+        end = self.text.find(end_marker, start)
+        return self.text[start:end if end >= 0 else len(self.text)], f"{self.filename}, trang {self.page_at(start)}"
+
+def _split_spill(spill):
+    # Text a page starts with before its first row: the rest of the previous row's cells, in
+    # column order. Returns (name continuation, end time or None, remaining cells).
+    time_match = _TIME_RE.search(spill)
+    if time_match:
+        return spill[:time_match.start()].strip(), _hhmm(time_match), spill[time_match.end():].strip()
+    close_at = spill.rfind(")")
+    if close_at < 0:
+        return spill.strip(), None, ""
+    return spill[:close_at + 1].strip(), None, spill[close_at + 1:].strip()
+
+def _split_vehicle_operator(cells):
+    match = _OPERATOR_RE.search(cells)
+    if not match:
+        return cells.strip(), ""
+    return cells[:match.start()].strip(), cells[match.start():].strip()
+
+def _split_place(point):
+    """'Bến Thành (Bến xe buýt Sài Gòn, Q1)' -> ('Bến Thành', 'Bến xe buýt Sài Gòn, Q1')."""
+    point = point.strip()
+    paren_at = point.find("(")
+    if paren_at <= 0:
+        return point, None
+    return point[:paren_at].strip(), point[paren_at:].strip("() ").replace(") (", "; ")
+
+def parse_bus_routes(document):
+    region, source = document.section("Đơn vị đảm nhiệm (Ví dụ)", "Lưu ý: Đây chỉ là một phần")
+    routes = []
+    for segment in region.split("\f"):
+        first_row = _BUS_ROW_RE.search(segment)
+        spill = segment[:first_row.start()] if first_row else segment
+        if routes and spill.strip():
+            previous = routes[-1]
+            name_more, end_time, cells_more = _split_spill(spill)
+            previous["name"] = f"{previous['name']} {name_more}".strip()
+            previous["end"] = previous["end"] or end_time
+            if cells_more:
+                # Vehicle names are capitalised; the operator cell continues with a lowercase word.
+                words = cells_more.split(" ")
+                cut = next((i for i, w in enumerate(words) if w[:1].islower() and w != "etc."), len(words))
+                previous["vehicles"] = f"{previous['vehicles']} {' '.join(words[:cut])}".strip()
+                previous["operator"] = f"{previous['operator']} {' '.join(words[cut:])}".strip()
+        for row in _BUS_ROW_RE.finditer(segment):
+            vehicles, operator = _split_vehicle_operator(row.group("rest"))
+            routes.append({"code": row.group("code"), "name": row.group("name"), "km": row.group("km"), "start": row.group("start"),
+                           "end": row.group("end"), "trip": row.group("trip"), "headway": row.group("headway"),
+                           "vehicles": vehicles, "operator": operator})
+    results = []
+    for route in routes:
+        name = route["name"]
+        subsidized = _NOT_SUBSIDIZED not in name
+        name = " ".join(name.replace(_NOT_SUBSIDIZED, "").split())
+        points = [p for p in name.split(" ↔ ") if p.strip()]
+        headway_min, headway_max = _minutes_range(route["headway"])
+        results.append({
+            "mode": "bus", "code": route["code"], "name": name.replace(" ↔ ", " – "),
+            "stops": [_split_place(p) for p in points], "length_km": float(route["km"].replace(",", ".")),
+            "trip_minutes": None if route["trip"] == "-" else route["trip"].replace(" - ", " – "),
+            "operator": route["operator"] or None, "vehicles": route["vehicles"] or None, "subsidized": subsidized,
+            "hours": [(route["start"], route["end"], None)], "headways": [("Cả ngày", headway_min, headway_max, None)], "source": source})
+    return results
+
+def _km_band(text):
+    numbers = [int(n) for n in re.findall(r"\d+", text)]
+    if "trở xuống" in text or text.startswith("dưới"): return None, numbers[0]
+    if "trở lên" in text or "suốt tuyến" in text: return numbers[0], None
+    return (numbers[0], numbers[1]) if len(numbers) > 1 else (numbers[0], None)
+
+def parse_bus_fares(document):
+    fares = []
+    region, source = document.section("Một số tuyến áp dụng (Ví dụ)", "Đối với học sinh, sinh viên")
+    region = _join_pages(region)
+    bands = {}
+    for row in re.finditer(rf"(?P<band>(?:Từ|Trên) \d+ km[^\d]*?(?: \d+ km[^\d]*?)?) (?P<price>{_PRICE}) (?P<student>{_PRICE}) "
+                           r"(?P<routes>\d{2,3}(?:, \d{2,3})*) \d{1,2}\b", region):
+        min_km, max_km = _km_band(row.group("band"))
+        bands[_price(row.group("price"))] = (min_km, max_km)
+        note = f"Tuyến có trợ giá, cự ly {row.group('band').strip().lower()}. Ví dụ: {row.group('routes')}"
+        fares.append({"mode": "bus", "ticket": "Vé lượt", "rider": "Hành khách thường", "price_min": _price(row.group("price")),
+                      "unit": "đồng/lượt", "min_km": min_km, "max_km": max_km, "subsidized_only": True, "note": note, "source": source})
+        fares.append({"mode": "bus", "ticket": "Vé lượt", "rider": "Học sinh, sinh viên", "price_min": _price(row.group("student")),
+                      "unit": "đồng/lượt", "min_km": min_km, "max_km": max_km, "subsidized_only": True, "note": note, "source": source})
+    region, source = document.section("Vé bán trước (Vé tập)", "Quy định giá vé cho các tuyến đặc thù")
+    for row in re.finditer(rf"vé lượt ({_PRICE}) đồng: Giá vé tập là ({_PRICE}) đồng/tập (\d+) vé", region):
+        min_km, max_km = bands.get(_price(row.group(1)), (None, None))
+        fares.append({"mode": "bus", "ticket": f"Vé tập ({row.group(3)} vé)", "rider": "Hành khách thường", "price_min": _price(row.group(2)),
+                      "unit": "đồng/tập", "min_km": min_km, "max_km": max_km, "subsidized_only": True,
+                      "note": f"Tương ứng vé lượt {row.group(1)} đồng", "source": source})
+    region, source = document.section("Quy định giá vé cho các tuyến đặc thù và không trợ giá", "Chính sách giá vé này")
+    region = _join_pages(region)
+    for bullet in re.finditer(r"○ (?P<head>[^:]*?):(?P<body>.*?)(?=○|$)", region):
+        head, body = bullet.group("head"), bullet.group("body")
+        codes = re.findall(r"(\d+(?:-\d)?) \(", head) or re.findall(r"\d+-\d", head)
+        if not codes: continue
+        route_codes = ",".join(codes)
+        flat = re.search(rf"Giá vé lượt [^.]*? là ({_PRICE}) đồng/lượt", body)
+        if flat:
+            fares.append({"mode": "bus", "route_codes": route_codes, "ticket": "Vé lượt", "rider": "Hành khách thường",
+                          "price_min": _price(flat.group(1)), "unit": "đồng/lượt", "source": source})
+        student_book = re.search(rf"HSSV, giá vé tập là ({_PRICE}) đồng/tập (\d+) vé", body)
+        if student_book:
+            fares.append({"mode": "bus", "route_codes": route_codes, "ticket": f"Vé tập ({student_book.group(2)} vé)", "rider": "Học sinh, sinh viên",
+                          "price_min": _price(student_book.group(1)), "unit": "đồng/tập", "source": source})
+        price_range = re.search(rf"giá vé dao động từ ({_PRICE}) - ({_PRICE}) đồng", body)
+        if price_range:
+            fares.append({"mode": "bus", "route_codes": route_codes, "ticket": "Vé lượt", "rider": "Hành khách thường",
+                          "price_min": _price(price_range.group(1)), "price_max": _price(price_range.group(2)), "unit": "đồng/lượt", "source": source})
+        for band in re.finditer(rf"((?:dưới|từ) \d+ ?km[^;.]*?) là ({_PRICE}) VNĐ", body):
+            min_km, max_km = _km_band(band.group(1))
+            fares.append({"mode": "bus", "route_codes": route_codes, "ticket": "Vé lượt", "rider": "Hành khách thường",
+                          "price_min": _price(band.group(2)), "unit": "đồng/lượt", "note": f"Quãng đường đi {band.group(1)}", "source": source})
+        student_trip = re.search(rf"Vé lượt HSSV là ({_PRICE}) VNĐ", body)
+        if student_trip:
+            fares.append({"mode": "bus", "route_codes": route_codes, "ticket": "Vé lượt", "rider": "Học sinh, sinh viên",
+                          "price_min": _price(student_trip.group(1)), "unit": "đồng/lượt", "source": source})
+        for monthly in re.finditer(rf"vé tháng (đơn tuyến|liên tuyến) \(({_PRICE}) VNĐ/tháng", body):
+            fares.append({"mode": "bus", "route_codes": route_codes, "ticket": f"Vé tháng {monthly.group(1)}", "rider": "Hành khách thường",
+                          "price_min": _price(monthly.group(2)), "unit": "đồng/tháng", "source": source})
+    return fares
+
+def parse_metro_stations(document):
+    region, source = document.section("Tiện ích nổi bật (Tham khảo)", "Nguồn: Tổng hợp từ.")
+    region = _join_pages(region)
+    stations = []
+    for row in re.split(r"(?<=\.) \d{1,2}(?= |$)", region):
+        row = re.sub(r"^\s*Ga (?:Ngầm|Trên Cao) ", "", row.strip())
+        # A parenthesis closed at the top of this row is the end of the previous row's address.
+        spill = re.match(r"^([^()]*\))\s+", row)
+        if spill:
+            if stations: stations[-1]["address"] += " " + spill.group(1)
+            row = row[spill.end():]
+        match = re.match(r"(?P<name>.+?) (?P<address>(?:Quảng trường|Đường|Xa lộ) .+?) (?P<kind>Ngầm|Trên cao) (?P<rest>.*)", row)
+        if not match: continue
+        rest = match.group("rest")
+        buses = re.match(r"((?:\d+(?:-\d)?(?:, )?)*)(?:; (Kết nối .+?\)))?\s*", rest)
+        amenities = rest[buses.end():]
+        address = match.group("address")
+        # Address text pushed into the amenities cell by a page break: "..., thang Thảo Điền, TP. Thủ Đức (Gần ...) máy, ..."
+        moved = re.search(r" ((?:[A-ZĐÀ-Ỹ][^\s,]*\s?)+, [^()]*\((?:Gần|Đối diện|Trong) [^)]*\)) ", amenities)
+        if moved:
+            address += " " + moved.group(1); amenities = amenities[:moved.start()] + " " + amenities[moved.end():]
+        stations.append({"name": match.group("name").strip(), "address": address, "station_type": match.group("kind"),
+                         "bus_routes": [c for c in buses.group(1).split(", ") if c],
+                         "note": buses.group(2), "amenities": amenities.strip(), "source": source})
+    return stations
+
+def parse_metro_line(document, stations):
+    text = _join_pages(document.text)
+    hours_match = re.search(r"hoạt động từ (\d{1,2}:\d\d) sáng đến (\d{1,2}:\d\d) tối", text)
+    peak = re.search(r"Giờ cao điểm \(([^)]*)\): [^.]*?khoảng (\d+) phút/chuyến", text)
+    offpeak = re.search(r"Giờ thấp điểm/bình thường: Tần suất khoảng (\d+)-(\d+) phút/chuyến", text)
+    length = re.search(r"(\d+,\d+) km, trong đó có", text)
+    trip = re.search(r"Hành trình từ ga đầu Bến Thành đến ga cuối Suối Tiên[^.]*?mất khoảng (\d+) phút", text)
+    operator = re.search(r"(?:Công ty )?TNHH MTV Đường sắt đô thị số 1 \(HURC1\)", text)
+    headways = []
+    if peak: headways.append(("Giờ cao điểm", int(peak.group(2)), int(peak.group(2)), peak.group(1)))
+    if offpeak: headways.append(("Giờ thấp điểm/bình thường", int(offpeak.group(1)), int(offpeak.group(2)), None))
+    hours = [(_hhmm(_TIME_RE.search(hours_match.group(1))), _hhmm(_TIME_RE.search(hours_match.group(2))), "Hằng ngày")] if hours_match else []
+    return {"mode": "metro", "code": "1", "name": f"{stations[0]['name']} – {stations[-1]['name']}" if stations else "Metro số 1",
+            "stops": [(s["name"], None) for s in stations], "length_km": float(length.group(1).replace(",", ".")) if length else None,
+            "trip_minutes": trip.group(1) if trip else None, "operator": operator.group(0) if operator else None, "vehicles": None,
+            "subsidized": True, "hours": hours, "headways": headways, "source": stations[0]["source"] if stations else None}
+
+def parse_metro_fares(document):
+    region, source = document.section("Mô tả / Ưu đãi", "Nguồn: Tổng hợp từ.")
+    region = _join_pages(region)
+    fares = []
+    for row in re.finditer(rf"(?P<ticket>Vé (?:\d+ )?[^\d]+?) (?P<min>{_PRICE})(?: – (?P<max>{_PRICE}))? (?P<note>.*?)(?= Vé (?:\d+ )?[^\d]+? {_PRICE}|\s*$)", region):
+        ticket = row.group("ticket").strip()
+        rider = "Học sinh, sinh viên" if "Học sinh" in ticket else "Hành khách thường"
+        unit = "đồng/lượt" if "lượt" in ticket else "đồng/vé"
+        fares.append({"mode": "metro", "route_codes": "1", "ticket": re.sub(r" \(Học sinh, Sinh viên\)", "", ticket), "rider": rider,
+                      "price_min": _price(row.group("min")), "price_max": _price(row.group("max")), "unit": unit,
+                      "note": row.group("note").strip(), "source": source})
+    return fares
+
+def parse_feeder_buses(document, station_names):
+    region, source = document.section("Ga Metro Kết nối (Tham khảo)", "Nguồn: Tổng hợp từ.")
+    region = _join_pages(region)
+    station_alternatives = "|".join(re.escape(n) for n in sorted(station_names, key=len, reverse=True))
+    row_re = re.compile(rf"(?:(?<=\s)|^)(?P<code>\d{{3}}) (?P<summary>.+?) (?P<stations>Ga (?:{station_alternatives})(?:, Ga (?:{station_alternatives}))*)(?=\s+\d{{3}} |\s*\*|\s*$)")
+    routes = []
+    for row in row_re.finditer(region):
+        points = [p.strip() for p in row.group("summary").split(" - ")]
+        routes.append({"mode": "bus", "code": row.group("code"), "name": " – ".join(points), "stops": [(p, None) for p in points],
+                       "length_km": None, "trip_minutes": None, "operator": None, "vehicles": "Xe buýt điện", "subsidized": True,
+                       "hours": [], "headways": [], "source": source,
+                       "stations": [s[len("Ga "):] for s in row.group("stations").split(", ")]})
+    return routes
+
+def parse_waterbus(document):
+    text = _join_pages(document.text)
+    region, source = document.section("Tên Bến Tàu Địa Chỉ Chi Tiết Nguồn Tham Khảo", "Việc cung cấp địa chỉ")
+    region = _join_pages(region)
+    piers = [(m.group("name"), m.group("address")) for m in re.finditer(
+        r"Bến (?P<name>.+?) (?P<address>(?:\d+\w? )?(?:Đường|Lô|Cuối) .+?) \d{2}(?= Bến |\s*$)", region)]
+    length = re.search(r"Chiều dài tuyến: Khoảng (\d+(?:[.,]\d+)?) km", text)
+    trip = re.search(r"từ Bến Bạch Đằng đến Bến Linh Đông[^.]*?mất khoảng từ (\d+) phút đến (\d+) phút", text)
+    hours = re.search(r"Giờ hoạt động: ([^.]*?(?:\d{1,2}h\d\d)[^.]*?) đối với các chuyến \"Daily\"", text)
+    trips_per_day = re.search(r"Các chuyến \"Daily\" \([^)]*\): (Có [^.]*? mỗi ngày)", text)
+    operator = re.search(r"(Công ty TNHH [^,]+), đơn vị đang vận hành tuyến số 1", text)
+    hour_values = [_hhmm(m) for m in _TIME_RE.finditer(hours.group(1))] if hours else []
+    route = {"mode": "waterbus", "code": "1", "name": f"Bến {piers[0][0]} – Bến {piers[-1][0]}" if piers else "Buýt sông số 1",
+             "stops": [(f"Bến {name}", None) for name, _ in piers], "addresses": dict((f"Bến {name}", address) for name, address in piers),
+             "length_km": float(length.group(1).replace(",", ".")) if length else None,
+             "trip_minutes": f"{trip.group(1)} – {trip.group(2)}" if trip else None, "operator": operator.group(1) if operator else None,
+             "vehicles": None, "subsidized": False,
+             "hours": [(min(hour_values), max(hour_values), hours.group(1).strip())] if hour_values else [],
+             "headways": [("Chuyến Daily", None, None, trips_per_day.group(1))] if trips_per_day else [], "source": source}
+    fares = []
+    single = re.search(rf"Đồng giá ({_PRICE}) VNĐ/lượt/người ([^.]*)", text)
+    if single:
+        fares.append({"mode": "waterbus", "route_codes": "1", "ticket": "Vé lượt", "rider": "Hành khách thường", "price_min": _price(single.group(1)),
+                      "unit": "đồng/lượt", "note": single.group(2).strip(), "source": source})
+    round_trip = re.search(rf"Vé khứ hồi có giá ({_PRICE}) VNĐ/người", text)
+    if round_trip:
+        fares.append({"mode": "waterbus", "route_codes": "1", "ticket": "Vé khứ hồi", "rider": "Hành khách thường",
+                      "price_min": _price(round_trip.group(1)), "unit": "đồng/người", "source": source})
+    return route, fares
+
+def parse_bike_fares(document):
+    region, source = document.section("Chi Tiết và Điều Kiện Nguồn Tham Khảo", "Lưu ý:")
+    region = _join_pages(re.sub(r" \d{1,2}" + re.escape(PAGE_BREAK), " ", region))  # Citation cut by the page break
+    fares = []
+    for row in re.finditer(rf"(?P<ticket>Vé (?:Lượt|Ngày|Tháng \(Tùy chọn \d\)|Trả Trước)) (?P<price>{_PRICE}) "
+                           r"(?P<unit>(?:VNĐ|điểm TNGo)(?:/(?:\d+ )?\w+(?: đầu)?)?) (?P<note>.*?)(?: \d{1,2})?"
+                           r"(?= Vé (?:Lượt|Ngày|Tháng \(|Trả Trước)| Thuê |\s*$)", region):
+        fares.append({"mode": "bike", "ticket": row.group("ticket"), "rider": "Hành khách thường", "price_min": _price(row.group("price")),
+                      "unit": row.group("unit").replace("VNĐ", "đồng"), "note": row.group("note").strip(), "source": source})
+    return fares
+
+def parse_watergo_fares(document):
+    region, source = document.section("Mô Tả Ngắn Nguồn Tham Khảo", "Lưu ý:")
+    region = _join_pages(region)
+    return [{"mode": "watergo", "ticket": row.group("ticket"), "rider": "Người lớn", "price_min": _price(row.group("price")),
+             "unit": "đồng/vé", "note": row.group("note").strip(), "source": source}
+            for row in re.finditer(rf"(?P<ticket>(?:Cabin|River|Sky) Seat(?: - Tour [^\d]+?)?) (?P<price>{_PRICE}) (?P<note>.+?) \d{{1,2}}"
+                                   r"(?= (?:Cabin|River|Sky|Vé)|\s*\*|\s*$)", region)]
+
+def extract(doc_dir):
+    """Parse the PDFs; returns {"routes", "stations", "fares"} (metro stations keep their own fields)."""
+    doc_dir = Path(doc_dir)
+    routes, stations, fares = [], [], []
+    if (doc_dir / BUS_PDF).exists():
+        bus_document = _Document(doc_dir / BUS_PDF)
+        routes.extend(parse_bus_routes(bus_document)); fares.extend(parse_bus_fares(bus_document))
+    if (doc_dir / METRO_PDF).exists():
+        metro_document = _Document(doc_dir / METRO_PDF)
+        stations = parse_metro_stations(metro_document)
+        routes.append(parse_metro_line(metro_document, stations))
+        routes.extend(parse_feeder_buses(metro_document, [s["name"] for s in stations]))
+        fares.extend(parse_metro_fares(metro_document))
+    if (doc_dir / OTHER_MODES_PDF).exists():
+        other_document = _Document(doc_dir / OTHER_MODES_PDF)
+        waterbus_route, waterbus_fares = parse_waterbus(other_document)
+        routes.append(waterbus_route); fares.extend(waterbus_fares)
+        fares.extend(parse_bike_fares(other_document)); fares.extend(parse_watergo_fares(other_document))
+    return {"routes": routes, "stations": stations, "fares": fares}
+
+# --- Storage ---
+def _create_schema(conn):
+    conn.executescript('''
+        CREATE TABLE kb_meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE routes (
+            route_id TEXT PRIMARY KEY, mode TEXT NOT NULL, code TEXT NOT NULL, name TEXT NOT NULL,
+            length_km REAL, trip_minutes TEXT, operator TEXT, vehicles TEXT, subsidized INTEGER NOT NULL, source TEXT);
+        CREATE INDEX idx_routes_code ON routes (code);
+        CREATE TABLE stops (
+            stop_id INTEGER PRIMARY KEY, mode TEXT NOT NULL, name TEXT NOT NULL, search_name TEXT NOT NULL,
+            area TEXT, address TEXT, station_type TEXT, amenities TEXT, note TEXT, source TEXT,
+            UNIQUE (mode, search_name));
+        CREATE TABLE route_stops (
+            route_id TEXT NOT NULL, seq INTEGER NOT NULL, stop_id INTEGER NOT NULL,
+            PRIMARY KEY (route_id, seq));
+        CREATE INDEX idx_route_stops_stop ON route_stops (stop_id);
+        -- Routes serving a stop at an unknown position of their sequence (feeder buses of metro stations).
+        CREATE TABLE stop_connections (stop_id INTEGER NOT NULL, route_id TEXT NOT NULL, PRIMARY KEY (stop_id, route_id));
+        CREATE TABLE hours (route_id TEXT NOT NULL, first_departure TEXT, last_departure TEXT, note TEXT);
+        CREATE INDEX idx_hours_route ON hours (route_id);
+        CREATE TABLE headways (route_id TEXT NOT NULL, period TEXT NOT NULL, min_minutes INTEGER, max_minutes INTEGER, note TEXT);
+        CREATE INDEX idx_headways_route ON headways (route_id);
+        CREATE TABLE fares (
+            fare_id INTEGER PRIMARY KEY, mode TEXT NOT NULL, route_codes TEXT, ticket TEXT NOT NULL, rider TEXT NOT NULL,
+            price_min_vnd INTEGER, price_max_vnd INTEGER, unit TEXT, min_km REAL, max_km REAL,
+            subsidized_only INTEGER NOT NULL DEFAULT 0, note TEXT, source TEXT);
+        CREATE INDEX idx_fares_mode ON fares (mode);
+    ''')
+
+def _stop_id(conn, mode, name, area=None, **details):
+    key = search_key(name)
+    row = conn.execute("SELECT stop_id FROM stops WHERE mode = ? AND search_name = ?", (mode, key)).fetchone()
+    if row:
+        return row[0]
+    return conn.execute("INSERT INTO stops (mode, name, search_name, area, address, station_type, amenities, note, source) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (mode, name, key, area, details.get("address"), details.get("station_type"), details.get("amenities"),
+                         details.get("note"), details.get("source"))).lastrowid
+
+def write_kb(data, path, signature):
+    tmp_path = Path(str(path) + ".tmp")
+    if tmp_path.exists(): tmp_path.unlink()
+    conn = sqlite3.connect(tmp_path)
+    try:
+        with conn:
+            _create_schema(conn)
+            for station in data["stations"]:
+                _stop_id(conn, "metro", station["name"], address=station["address"], station_type=station["station_type"],
+                         amenities=station["amenities"], note=station["note"], source=station["source"])
+            for route in data["routes"]:
+                route_id = f"{route['mode']}:{route['code']}"
+                conn.execute("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (route_id, route["mode"], route["code"], route["name"], route["length_km"], route["trip_minutes"],
+                              route["operator"], route["vehicles"], int(route["subsidized"]), route["source"]))
+                conn.execute("DELETE FROM route_stops WHERE route_id = ?", (route_id,))
+                for seq, (name, area) in enumerate(route["stops"]):
+                    address = route.get("addresses", {}).get(name)
+                    conn.execute("INSERT INTO route_stops VALUES (?, ?, ?)",
+                                 (route_id, seq, _stop_id(conn, route["mode"], name, area, address=address, source=route["source"])))
+                for station_name in route.get("stations", []):
+                    conn.execute("INSERT OR IGNORE INTO stop_connections VALUES (?, ?)", (_stop_id(conn, "metro", station_name), route_id))
+                conn.executemany("INSERT INTO hours VALUES (?, ?, ?, ?)", [(route_id, *hours) for hours in route["hours"]])
+                conn.executemany("INSERT INTO headways VALUES (?, ?, ?, ?, ?)", [(route_id, *headway) for headway in route["headways"]])
+            for station in data["stations"]:
+                station_id = _stop_id(conn, "metro", station["name"])
+                conn.executemany("INSERT OR IGNORE INTO stop_connections VALUES (?, ?)", [(station_id, f"bus:{code}") for code in station["bus_routes"]])
+            conn.executemany('''INSERT INTO fares (mode, route_codes, ticket, rider, price_min_vnd, price_max_vnd, unit, min_km, max_km, subsidized_only, note, source)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             [(f["mode"], f.get("route_codes"), f["ticket"], f["rider"], f["price_min"], f.get("price_max"), f.get("unit"),
+                               f.get("min_km"), f.get("max_km"), int(f.get("subsidized_only", False)), f.get("note"), f.get("source")) for f in data["fares"]])
+            counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("routes", "stops", "route_stops", "fares")}
+            conn.executemany("INSERT INTO kb_meta VALUES (?, ?)", [("format_version", str(KB_FORMAT_VERSION)), ("corpus_signature", signature),
+                                                                  ("counts", json.dumps(counts))])
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return counts
+
+def build_kb(doc_dir, pdf_filenames, index_dir=INDEX_DIR):
+    """Extract the tables from the PDFs into index_dir/transit_kb.db; returns the row counts."""
+    index_dir = Path(index_dir); index_dir.mkdir(parents=True, exist_ok=True)
+    return write_kb(extract(doc_dir), index_dir / KB_FILENAME, compute_kb_signature(doc_dir, pdf_filenames))
+
+# --- Lookups ---
+class TransitKB:
+    def __init__(self, path):
+        self.path = str(path)
+        self._conn = sqlite3.connect(f"file:{Path(path).as_posix()}?mode=ro", uri=True, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()  # Lookups take well under a millisecond; one connection is enough
+        meta = dict(self._query("SELECT key, value FROM kb_meta"))
+        self.format_version = int(meta.get("format_version", 0))
+        self.corpus_signature = meta.get("corpus_signature")
+        self.counts = json.loads(meta.get("counts", "{}"))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _find_route_rows(self, route_code, mode=None):
+        code = re.sub(r"^(?:tuyến|tuyen|số|so|metro|buýt|buyt)\s*", "", search_key(route_code)).strip().upper()
+        candidates = {code, code.lstrip("0") or code, code.zfill(2) if code.isdigit() else code}
+        placeholders = ",".join("?" * len(candidates))
+        sql = f"SELECT * FROM routes WHERE code IN ({placeholders})" + (" AND mode = ?" if mode else "") + " ORDER BY mode, code"
+        return self._query(sql, tuple(candidates) + ((mode,) if mode else ()))
+
+    def _fares_for_route(self, route):
+        rows = self._query("SELECT * FROM fares WHERE mode = ? ORDER BY fare_id", (route["mode"],))
+        specific = [r for r in rows if r["route_codes"] and route["code"] in r["route_codes"].split(",")]
+        if specific or not route["subsidized"] or route["length_km"] is None:
+            return [_fare_dict(r) for r in specific]
+        return [_fare_dict(r) for r in rows if r["subsidized_only"] and not r["route_codes"]
+                and (r["min_km"] is None or route["length_km"] > r["min_km"])
+                and (r["max_km"] is None or route["length_km"] <= r["max_km"])]
+
+    def lookup_route(self, route_code, mode=None):
+        routes = self._find_route_rows(route_code, mode)
+        if not routes:
+            return {"error": f"Không có tuyến '{route_code}' trong dữ liệu trích từ tài liệu."}
+        results = []
+        for route in routes[:TOOL_RESULT_LIMIT]:
+            route_id = route["route_id"]
+            stops = self._query('''SELECT s.name, s.area FROM route_stops rs JOIN stops s ON s.stop_id = rs.stop_id
+                                   WHERE rs.route_id = ? ORDER BY rs.seq''', (route_id,))
+            stations = self._query('''SELECT s.name FROM stop_connections c JOIN stops s ON s.stop_id = c.stop_id
+                                      WHERE c.route_id = ? ORDER BY s.stop_id''', (route_id,))
+            result = _route_dict(route)
+            result["stops"] = [f"{s['name']} ({s['area']})" if s["area"] else s["name"] for s in stops]
+            if stations: result["metro_stations"] = [s["name"] for s in stations]
+            result["hours"] = [dict(first_departure=h[0], last_departure=h[1], **({"note": h[2]} if h[2] else {}))
+                               for h in self._query("SELECT first_departure, last_departure, note FROM hours WHERE route_id = ?", (route_id,))]
+            result["headways"] = [_drop_none(dict(h)) for h in self._query("SELECT period, min_minutes, max_minutes, note FROM headways WHERE route_id = ?", (route_id,))]
+            result["fares"] = self._fares_for_route(route)
+            results.append(result)
+        return {"routes": results}
+
+    def find_routes(self, place, mode=None):
+        key = search_key(place)
+        if not key:
+            return {"error": "Cần tên địa điểm."}
+        mode_clause = " AND s.mode = ?" if mode else ""
+        params = (f"%{key}%",) + ((mode,) if mode else ())
+        rows = self._query(f'''
+            SELECT DISTINCT r.route_id, r.mode, r.code, r.name, s.name AS matched_stop FROM stops s
+            JOIN (SELECT stop_id, route_id FROM route_stops UNION SELECT stop_id, route_id FROM stop_connections) link ON link.stop_id = s.stop_id
+            LEFT JOIN routes r ON r.route_id = link.route_id
+            WHERE s.search_name LIKE ?{mode_clause}
+            ORDER BY s.mode, r.mode, r.code LIMIT {TOOL_RESULT_LIMIT * 2}''', params)
+        results = {}
+        for row in rows:
+            route_id = row["route_id"] or ""
+            mode_name, _, code = route_id.partition(":")
+            entry = results.setdefault(route_id, {"mode": MODE_LABELS.get(row["mode"] or mode_name, mode_name), "code": row["code"] or code,
+                                                  "name": row["name"], "matched_stops": []})
+            if row["matched_stop"] not in entry["matched_stops"]: entry["matched_stops"].append(row["matched_stop"])
+        if not results:
+            return {"error": f"Không tìm thấy tuyến nào qua '{place}' trong dữ liệu trích từ tài liệu."}
+        return {"routes": [_drop_none(r) for r in list(results.values())[:TOOL_RESULT_LIMIT]]}
+
+    def lookup_station(self, name, mode=None):
+        key = search_key(name)
+        mode_clause = " AND mode = ?" if mode else ""
+        stops = self._query(f"SELECT * FROM stops WHERE search_name LIKE ?{mode_clause} ORDER BY mode = 'metro' DESC, length(search_name) LIMIT {TOOL_RESULT_LIMIT}",
+                            (f"%{key}%",) + ((mode,) if mode else ()))
+        if not key or not stops:
+            return {"error": f"Không có ga/trạm '{name}' trong dữ liệu trích từ tài liệu."}
+        results = []
+        for stop in stops:
+            routes = self._query('''
+                SELECT link.route_id, r.name FROM (SELECT stop_id, route_id FROM route_stops UNION SELECT stop_id, route_id FROM stop_connections) link
+                LEFT JOIN routes r ON r.route_id = link.route_id WHERE link.stop_id = ? ORDER BY link.route_id''', (stop["stop_id"],))
+            results.append(_drop_none({
+                "name": stop["name"], "mode": MODE_LABELS.get(stop["mode"], stop["mode"]), "area": stop["area"], "address": stop["address"],
+                "station_type": stop["station_type"], "amenities": stop["amenities"], "note": stop["note"], "source": stop["source"],
+                "routes": [f"{MODE_LABELS.get(r['route_id'].split(':')[0], '')} {r['route_id'].split(':')[1]}" + (f": {r['name']}" if r["name"] else "")
+                           for r in routes]}))
+        return {"stations": results}
+
+    def get_fares(self, mode, route_code=None):
+        if route_code:
+            routes = self._find_route_rows(route_code, mode)
+            if routes:
+                return {"fares": [dict(f, route=f"{MODE_LABELS[r['mode']]} {r['code']}") for r in routes for f in self._fares_for_route(r)]}
+        rows = self._query("SELECT * FROM fares WHERE mode = ? ORDER BY fare_id", (mode,))
+        if not rows:
+            return {"error": f"Không có bảng giá vé cho '{mode}' trong dữ liệu trích từ tài liệu."}
+        return {"fares": [_fare_dict(r) for r in rows[:TOOL_RESULT_LIMIT * 2]]}
+
+    def export_network(self):
+        """All stops, routes, ordered route stops, connections, hours and headways, as lists of dicts."""
+        tables = {"stops": "SELECT stop_id, mode, name, search_name, amenities FROM stops ORDER BY stop_id",
+                  "routes": "SELECT route_id, mode, code, name, length_km, trip_minutes FROM routes ORDER BY route_id",
+                  "route_stops": "SELECT route_id, seq, stop_id FROM route_stops ORDER BY route_id, seq",
+                  "stop_connections": "SELECT stop_id, route_id FROM stop_connections ORDER BY route_id, stop_id",
+                  "hours": "SELECT route_id, first_departure, last_departure FROM hours",
+                  "headways": "SELECT route_id, period, min_minutes, max_minutes, note FROM headways"}
+        return {name: [dict(row) for row in self._query(sql)] for name, sql in tables.items()}
+
+    def call(self, name, args):
+        """Run one tool call from Gemini; always returns a JSON-serialisable dict."""
+        handler = {"lookup_route": self.lookup_route, "find_routes": self.find_routes,
+                   "lookup_station": self.lookup_station, "get_fares": self.get_fares}.get(name)
+        if handler is None:
+            return {"error": f"Tool không tồn tại: {name}"}
+        args = dict(args or {})
+        if args.get("mode") not in MODES: args.pop("mode", None)
+        try:
+            if name == "get_fares" and "mode" not in args: args["mode"] = "bus"
+            return handler(**args)
+        except (TypeError, sqlite3.Error) as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+
+def _drop_none(values):
+    return {k: v for k, v in values.items() if v is not None and v != []}
+
+def _route_dict(route):
+    return _drop_none({"mode": MODE_LABELS.get(route["mode"], route["mode"]), "code": route["code"], "name": route["name"],
+                       "length_km": route["length_km"], "trip_minutes": route["trip_minutes"], "operator": route["operator"],
+                       "vehicles": route["vehicles"], "subsidized": bool(route["subsidized"]), "source": route["source"]})
+
+def _fare_dict(fare):
+    return _drop_none({"ticket": fare["ticket"], "rider": fare["rider"], "price_vnd": fare["price_min_vnd"] if not fare["price_max_vnd"] else None,
+                       "price_range_vnd": [fare["price_min_vnd"], fare["price_max_vnd"]] if fare["price_max_vnd"] else None,
+                       "unit": fare["unit"], "routes": fare["route_codes"], "note": fare["note"], "source": fare["source"]})
+
+def load_kb(index_dir=INDEX_DIR, expected_signature=None):
+    """Return the process-wide TransitKB, or None when it is missing or stale."""
+    path = Path(index_dir) / KB_FILENAME
+    if not path.exists():
+        return None
+    cache_key = (str(path), path.stat().st_mtime_ns)
+    with _LOAD_LOCK:
+        kb = _LOADED.get(cache_key)
+        if kb is None:
+            try:
+                kb = TransitKB(path)
+            except sqlite3.Error:
+                return None
+            if kb.format_version != KB_FORMAT_VERSION:
+                return None
+            _LOADED.clear(); _LOADED[cache_key] = kb
+    if expected_signature and kb.corpus_signature != expected_signature:
+        return None
+    return kb
+
+def ensure_kb_built_async(doc_dir, pdf_filenames, index_dir=INDEX_DIR):
+    # Extraction reads the three PDFs (a few seconds); until it is done the tools are not offered.
+    # A failed build is not retried for BUILD_FAILURE_BACKOFF_SECONDS (returns None meanwhile).
+    key = str(index_dir)
+    with _LOAD_LOCK:
+        if _BUILD_FAILED_UNTIL.get(key, 0) > time.time():
+            return None
+        thread = _BUILD_THREADS.get(key)
+        if thread and thread.is_alive():
+            return thread
+        thread = threading.Thread(target=_build_in_background, args=(key, doc_dir, list(pdf_filenames), index_dir),
+                                  name="transit-kb-build", daemon=True)
+        _BUILD_THREADS[key] = thread
+    thread.start()
+    return thread
+
+def _build_in_background(key, doc_dir, pdf_filenames, index_dir):
+    try:
+        build_kb(doc_dir, pdf_filenames, index_dir)
+    except Exception:
+        with _LOAD_LOCK: _BUILD_FAILED_UNTIL[key] = time.time() + BUILD_FAILURE_BACKOFF_SECONDS
+        raise  # Reported by the thread's excepthook, once per backoff period
+
+# --- Gemini function-calling tools ---
+_MODE_PARAMETER = {"type": "STRING", "enum": list(MODES),
+                   "description": "bus = xe buýt, metro = tàu điện, waterbus = buýt đường sông, bike = xe đạp công cộng TNGO, watergo = du thuyền Saigon WaterGo"}
+TOOL_DECLARATIONS = [
+    {"name": "lookup_route",
+     "description": "Tra cứu một tuyến theo mã số (ví dụ 01, 152, metro 1, buýt sông 1): lộ trình các điểm dừng theo thứ tự, cự ly, "
+                    "giờ hoạt động, giãn cách chuyến, đơn vị vận hành và giá vé.",
+     "parameters": {"type": "OBJECT", "properties": {"route_code": {"type": "STRING", "description": "Mã số tuyến, ví dụ '01', '152', '1'"},
+                                                     "mode": _MODE_PARAMETER}, "required": ["route_code"]}},
+    {"name": "find_routes",
+     "description": "Tìm các tuyến xe buýt, metro, buýt sông đi qua hoặc kết nối với một địa điểm, bến, ga (ví dụ 'Bến Thành', 'Suối Tiên', 'Sân bay Tân Sơn Nhất').",
+     "parameters": {"type": "OBJECT", "properties": {"place": {"type": "STRING", "description": "Tên địa điểm, có dấu hoặc không dấu"},
+                                                     "mode": _MODE_PARAMETER}, "required": ["place"]}},
+    {"name": "lookup_station",
+     "description": "Thông tin một ga metro, bến tàu hoặc điểm đầu/cuối tuyến: địa chỉ, loại ga, tiện ích và các tuyến kết nối.",
+     "parameters": {"type": "OBJECT", "properties": {"name": {"type": "STRING", "description": "Tên ga hoặc bến"},
+                                                     "mode": _MODE_PARAMETER}, "required": ["name"]}},
+    {"name": "get_fares",
+     "description": "Bảng giá vé của một loại hình (vé lượt, vé tập, vé ngày, vé tháng, giá học sinh sinh viên), hoặc giá vé của một tuyến cụ thể.",
+     "parameters": {"type": "OBJECT", "properties": {"mode": _MODE_PARAMETER,
+                                                     "route_code": {"type": "STRING", "description": "Mã số tuyến nếu hỏi giá vé một tuyến cụ thể"}},
+                    "required": ["mode"]}},
+]
+TOOL_NAMES = frozenset(d["name"] for d in TOOL_DECLARATIONS)
+
+@functools.lru_cache(maxsize=1)
+def gemini_tool():
+    """The function declarations as one google.genai Tool."""
+    from google.genai import types as google_genai_types  # Deferred: the SDK is slow to import
+    return google_genai_types.Tool(function_declarations=[google_genai_types.FunctionDeclaration(**d) for d in TOOL_DECLARATIONS])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the transit knowledge base extracted from the PDFs.")
+    parser.add_argument("--doc-dir", default="documents")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build")
+    call_parser = subparsers.add_parser("call", help="Run a tool call, e.g. call lookup_route '{\"route_code\": \"01\"}'")
+    call_parser.add_argument("tool", choices=sorted(TOOL_NAMES))
+    call_parser.add_argument("args", nargs="?", default="{}")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        pdf_filenames = sorted(p.name for p in Path(args.doc_dir).glob("*.pdf"))
+        print(f"Extracted {build_kb(args.doc_dir, pdf_filenames)} into {INDEX_DIR / KB_FILENAME}")
+    else:
+        kb = load_kb()
+        if kb is None:
+            raise SystemExit("Knowledge base not found, run: python transit_kb.py build")
+        print(json.dumps(kb.call(args.tool, json.loads(args.args)), ensure_ascii=False, indent=2))
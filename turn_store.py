@@ -0,0 +1,212 @@
+import queue
+import threading
+import time
+import uuid
+
+# --- Turn Persistence ---
+# A chat turn is written in two steps instead of two full save_message_db() calls:
+#   begin()  - one transaction: the user message, an empty assistant message with
+#              status='streaming', and the session's last_updated_at;
+#   finish() - one UPDATE with the final answer (status='complete').
+# While the answer streams, checkpoint() hands the partial text to a background writer, which
+# coalesces checkpoints per message and writes them off the streaming path. If the process dies
+# mid-answer, the row keeps the last checkpoint with status='streaming'; a turn ended by an API
+# error is stored as 'interrupted'. Both are shown as resumable once no live turn owns them.
+# Ownership is stored in the row, so it holds across worker processes: the turn streaming a
+# message writes its owner token, and the same writer refreshes heartbeat_at with every checkpoint
+# and every HEARTBEAT_INTERVAL_SECONDS. A 'streaming' row is only taken over (resume) once its
+# heartbeat is older than STALE_AFTER_SECONDS, by a compare-and-set UPDATE; writes of a turn whose
+# row was taken over are ignored.
+
+STATUS_COMPLETE = "complete"
+STATUS_STREAMING = "streaming"
+STATUS_INTERRUPTED = "interrupted"
+CHECKPOINT_INTERVAL_SECONDS = 2.0
+CHECKPOINT_MIN_CHARS = 400
+HEARTBEAT_INTERVAL_SECONDS = 10
+STALE_AFTER_SECONDS = 60
+
+_ACTIVE_LOCK = threading.Lock()
+_ACTIVE = {}  # Assistant message rowid being streamed by this process -> (pool, owner)
+_PENDING_LOCK = threading.Lock()
+_PENDING = {}  # (pool, rowid) -> (owner, latest checkpoint text)
+_WAKE = queue.Queue()
+_WRITER = {"thread": None}
+
+def init_turn_columns(cursor):
+    cursor.execute("PRAGMA table_info(messages)")
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    if "status" not in existing_columns:
+        cursor.execute(f"ALTER TABLE messages ADD COLUMN status TEXT NOT NULL DEFAULT '{STATUS_COMPLETE}'")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_messages_unfinished ON messages (session_id) WHERE status != '{STATUS_COMPLETE}'")
+
+def init_owner_columns(cursor):
+    cursor.execute("PRAGMA table_info(messages)")
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    if "owner" not in existing_columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN owner TEXT")
+    if "heartbeat_at" not in existing_columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN heartbeat_at INTEGER")
+
+def is_active(message_seq):
+    with _ACTIVE_LOCK:
+        return message_seq in _ACTIVE
+
+def is_resumable(message):
+    """An assistant message left unfinished by a crash or an error, with no live turn streaming it.
+
+    For a 'streaming' message this goes by the heartbeat_at it was loaded with; resume() checks
+    the stored one.
+    """
+    if message.get("role") != "assistant" or is_active(message.get("seq")):
+        return False
+    if message.get("status") == STATUS_INTERRUPTED:
+        return True
+    return message.get("status") == STATUS_STREAMING and (message.get("heartbeat_at") or 0) < time.time() - STALE_AFTER_SECONDS
+
+# --- Background checkpoint writer ---
+def _writer_loop():
+    last_heartbeat_at = 0.0
+    while True:
+        try: _WAKE.get(timeout=HEARTBEAT_INTERVAL_SECONDS)
+        except queue.Empty: pass
+        with _PENDING_LOCK:
+            pending = dict(_PENDING); _PENDING.clear()
+        now = int(time.time())
+        by_pool = {}
+        for (pool, rowid), (owner, text) in pending.items():
+            by_pool.setdefault(pool, ([], []))[0].append((text, now, rowid, owner))
+        if time.monotonic() - last_heartbeat_at >= HEARTBEAT_INTERVAL_SECONDS:
+            last_heartbeat_at = time.monotonic()
+            with _ACTIVE_LOCK:
+                active = dict(_ACTIVE)
+            for rowid, (pool, owner) in active.items():
+                if (pool, rowid) not in pending: by_pool.setdefault(pool, ([], []))[1].append((now, rowid, owner))
+        for pool, (checkpoints, heartbeats) in by_pool.items():
+            try:
+                with pool.transaction() as conn:
+                    # A checkpoint that lost the race with finish() (or a takeover) must not overwrite the text.
+                    conn.executemany(f"""UPDATE messages SET content = ?, heartbeat_at = ?
+                                         WHERE rowid = ? AND owner = ? AND status = '{STATUS_STREAMING}'""", checkpoints)
+                    conn.executemany(f"UPDATE messages SET heartbeat_at = ? WHERE rowid = ? AND owner = ? AND status = '{STATUS_STREAMING}'",
+                                     heartbeats)
+            except Exception:
+                pass  # Checkpoints are best effort; the next one (or finish) carries the full text
+
+def _ensure_writer():
+    with _PENDING_LOCK:
+        if _WRITER["thread"] is None or not _WRITER["thread"].is_alive():
+            _WRITER["thread"] = threading.Thread(target=_writer_loop, name="turn-checkpoint-writer", daemon=True)
+            _WRITER["thread"].start()
+
+def _enqueue_checkpoint(pool, rowid, owner, text):
+    with _PENDING_LOCK:
+        _PENDING[(pool, rowid)] = (owner, text)
+    _ensure_writer()
+    _WAKE.put(None)
+
+def _cancel_checkpoint(pool, rowid):
+    with _PENDING_LOCK:
+        _PENDING.pop((pool, rowid), None)
+
+class TurnWriter:
+    def __init__(self, pool, session_id, checkpoint_interval_seconds=CHECKPOINT_INTERVAL_SECONDS, checkpoint_min_chars=CHECKPOINT_MIN_CHARS):
+        self.pool = pool
+        self.session_id = session_id
+        self.owner = uuid.uuid4().hex
+        self.checkpoint_interval_seconds = checkpoint_interval_seconds
+        self.checkpoint_min_chars = checkpoint_min_chars
+        self.assistant_seq = None
+        self.assistant_timestamp = None
+        self.final_text = None
+        self.status = None
+        self._latest_text = ""
+        self._checkpointed_chars = 0
+        self._last_checkpoint_at = 0.0
+
+    def begin(self, user_text):
+        """Store the user message and the assistant placeholder in one transaction; returns (user_seq, timestamp)."""
+        current_time = int(time.time())
+        with self.pool.transaction() as conn:
+            user_seq = conn.execute("INSERT INTO messages (id, session_id, role, content, timestamp) VALUES (?, ?, 'user', ?, ?)",
+                                    (str(uuid.uuid4()), self.session_id, user_text, current_time)).lastrowid
+            self.assistant_seq = conn.execute(
+                """INSERT INTO messages (id, session_id, role, content, timestamp, status, owner, heartbeat_at)
+                   VALUES (?, ?, 'assistant', '', ?, ?, ?, ?)""",
+                (str(uuid.uuid4()), self.session_id, current_time, STATUS_STREAMING, self.owner, current_time)).lastrowid
+            conn.execute("UPDATE sessions SET last_updated_at = ? WHERE id = ?", (current_time, self.session_id))
+        self.assistant_timestamp = current_time
+        self._claim()
+        return user_seq, current_time
+
+    def resume(self, assistant_seq, assistant_timestamp, partial_text):
+        """Continue an interrupted assistant message in place; False if it was finished or is still streaming elsewhere."""
+        with _ACTIVE_LOCK:
+            if assistant_seq in _ACTIVE: return False
+            _ACTIVE[assistant_seq] = (self.pool, self.owner)  # Claimed before the write, so two tabs cannot both resume it
+        try:
+            # Compare-and-set: an interrupted message, or a streaming one whose owner stopped sending heartbeats.
+            now = int(time.time())
+            updated, _ = self.pool.execute(f"""
+                UPDATE messages SET status = '{STATUS_STREAMING}', owner = ?, heartbeat_at = ?
+                WHERE rowid = ? AND (status = '{STATUS_INTERRUPTED}' OR (status = '{STATUS_STREAMING}' AND COALESCE(heartbeat_at, 0) < ?))""",
+                (self.owner, now, assistant_seq, now - STALE_AFTER_SECONDS))
+        except Exception:
+            with _ACTIVE_LOCK: _ACTIVE.pop(assistant_seq, None)
+            raise
+        if not updated:
+            with _ACTIVE_LOCK: _ACTIVE.pop(assistant_seq, None)
+            return False
+        self.assistant_seq = assistant_seq; self.assistant_timestamp = assistant_timestamp
+        self._latest_text = partial_text or ""; self._checkpointed_chars = len(self._latest_text)
+        self._claim()
+        return True
+
+    def _claim(self):
+        with _ACTIVE_LOCK:
+            _ACTIVE[self.assistant_seq] = (self.pool, self.owner)
+        self._last_checkpoint_at = time.monotonic()
+        _ensure_writer()  # Sends the heartbeats
+
+    def _release(self):
+        with _ACTIVE_LOCK:
+            _ACTIVE.pop(self.assistant_seq, None)
+
+    def checkpoint(self, partial_text):
+        # Cheap enough to call on every chunk: only every few seconds / few hundred characters
+        # is the text handed to the background writer.
+        if self.assistant_seq is None or self.status is not None: return
+        self._latest_text = partial_text
+        if (len(partial_text) - self._checkpointed_chars < self.checkpoint_min_chars and
+                time.monotonic() - self._last_checkpoint_at < self.checkpoint_interval_seconds):
+            return
+        if len(partial_text) == self._checkpointed_chars: return
+        _enqueue_checkpoint(self.pool, self.assistant_seq, self.owner, partial_text)
+        self._checkpointed_chars = len(partial_text); self._last_checkpoint_at = time.monotonic()
+
+    def interrupt(self, partial_text):
+        """End the turn early (API error after part of the answer), keeping the text for a resume."""
+        self._finalize(partial_text, None, STATUS_INTERRUPTED)
+
+    def finish(self, text, grounding_metadata_json=None):
+        """Store the final answer unless interrupt() already ended the turn; returns the stored status."""
+        if self.status is None:
+            self._finalize(text, grounding_metadata_json, STATUS_COMPLETE)
+        return self.status
+
+    def close(self):
+        # For a finally block: a turn cut short by st.rerun()/st.stop() (or an unexpected error)
+        # keeps the text streamed so far as an interrupted answer.
+        if self.assistant_seq is not None and self.status is None:
+            self.interrupt(self._latest_text)
+
+    def _finalize(self, text, grounding_metadata_json, status):
+        _cancel_checkpoint(self.pool, self.assistant_seq)
+        try:
+            # Not stored if another process took the message over (this one stalled past STALE_AFTER_SECONDS).
+            self.pool.execute("""
+                UPDATE messages SET content = ?, gemini_grounding_metadata_json = ?, status = ?, owner = NULL, heartbeat_at = NULL
+                WHERE rowid = ? AND owner = ?""", (text, grounding_metadata_json, status, self.assistant_seq, self.owner))
+            self.final_text = text; self.status = status
+        finally:
+            self._release()